@@ -1,4 +1,7 @@
 from .graphs import *
+from .packed import *
 from .dataset import *
+from .memmap import *
+from .views import *
 from .loader import *
 from .crystals import *
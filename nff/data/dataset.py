@@ -5,7 +5,6 @@ are constructed to work with the NFF package.
 
 from __future__ import annotations
 
-import copy
 import numbers
 from collections import Counter
 from copy import deepcopy
@@ -24,6 +23,7 @@ import nff.utils.constants as const
 from nff.data.features import ATOM_FEAT_TYPES, BOND_FEAT_TYPES
 from nff.data.features import add_morgan as external_morgan
 from nff.data.features import featurize_rdkit as external_rdkit
+from nff.data.graph_cache import get_graph_cache, hash_geom, hash_graph
 from nff.data.graphs import (
     DISTANCETHRESHOLDICT_Z,
     add_ji_kj,
@@ -33,15 +33,20 @@ from nff.data.graphs import (
     make_dset_directed,
     reconstruct_atoms,
 )
+from nff.data.packed import PackedTensorList
 from nff.data.parallel import (
     NUM_PROCS,
     add_bond_idx_parallel,
     add_e3fp_parallel,
     add_kj_ji_parallel,
     featurize_parallel,
+    kj_ji_geom,
+    map_geoms,
 )
+from nff.data.sparse import get_image_shifts
 
 if TYPE_CHECKING:
+    from nff.data.graph_cache import GraphCache
     from nff.io.ase import AtomsBatch
 
 
@@ -70,6 +75,10 @@ class Dataset(TorchDataset):
                                         np.array([[0, 0, 1], [0.1, 0.5, 0.8]])],
                     'dipole_2': [3, None]
                 }
+            Properties can also be stored packed (see `pack`), in which case each list is
+                replaced by a `PackedTensorList`: one concatenated tensor plus an offsets
+                array. Packed properties behave like the original lists, but indexing
+                returns views and unit or dtype conversions act on a single tensor.
             Periodic boundary conditions must be specified through the 'offset' key in
                 props. Once the neighborlist is created, distances between
                 atoms are computed by subtracting their xyz coordinates
@@ -88,6 +97,7 @@ class Dataset(TorchDataset):
         check_props: bool = True,
         do_copy: bool = True,
         device: str = "cuda",
+        packed: bool = False,
     ) -> None:
         """Constructor for Dataset class.
 
@@ -101,6 +111,7 @@ class Dataset(TorchDataset):
             do_copy (bool): whether to copy the properties or
                 use the same dictionary.
             device (str): The device to execute computations on ('cpu', 'cuda' etc.)
+            packed (bool): whether to store the properties packed. See `pack`.
         """
         if check_props:
             if do_copy:
@@ -112,6 +123,8 @@ class Dataset(TorchDataset):
         self.units = units
         self.to_units(units)
         self.device = device
+        if packed:
+            self.pack()
 
     def __len__(self) -> int:
         """Length of the dataset.
@@ -133,32 +146,35 @@ class Dataset(TorchDataset):
         return {key: val[idx] for key, val in self.props.items()}
 
     def __add__(self, other: Dataset) -> Dataset:
-        """Add another dataset to the current one.
+        """Add another dataset to the current one. Properties that only one of
+        the datasets has are dropped. The new dataset shares the tensors of
+        both datasets instead of copying them; use `copy` on the result for an
+        independent dataset, or `nff.data.DatasetView` to not build new
+        property lists at all.
 
         Args:
-            other (Dataset): Description
+            other (Dataset): dataset to add
 
         Returns:
             Dataset: new dataset with the properties of both datasets
         """
         if other.units != self.units:
-            other = other.copy().to_units(self.units)
+            other = other.copy()
+            other.to_units(self.units)
 
-        new_props = self.props
-        keys = list(new_props.keys())
-        for key in keys:
+        new_props = {}
+        for key, old_val in self.props.items():
             if key not in other.props:
-                new_props.pop(key)
                 continue
             val = other.props[key]
-            if isinstance(val, list):
-                new_props[key] += val
+            if isinstance(val, PackedTensorList) or isinstance(old_val, PackedTensorList):
+                new_props[key] = PackedTensorList.cat([old_val, val])
+            elif isinstance(val, list):
+                new_props[key] = list(old_val) + val
             else:
-                old_val = new_props[key]
                 new_props[key] = torch.cat([old_val, val.to(old_val.dtype)])
-        self.props = new_props
 
-        return copy.deepcopy(self)
+        return Dataset(new_props, units=self.units, check_props=False, device=self.device)
 
     def _check_dictionary(self, props: dict) -> dict:
         """Check the dictionary or properties to see if it has the
@@ -183,6 +199,9 @@ class Dataset(TorchDataset):
             if val is None:
                 props[key] = to_tensor([np.nan] * n_geoms)
 
+            elif isinstance(val, PackedTensorList):
+                assert len(val) == n_geoms, f"length of {key} is not " f"compatible with {n_geoms} " "geometries"
+
             elif any(x is None for x in val):
                 bad_indices = [i for i, item in enumerate(val) if item is None]
                 good_indices = [index for index in range(len(val)) if index not in bad_indices]
@@ -201,12 +220,44 @@ class Dataset(TorchDataset):
 
         return props
 
+    @property
+    def is_packed(self) -> bool:
+        """Whether any of the properties are stored packed."""
+        return any(isinstance(val, PackedTensorList) for val in self.props.values())
+
+    def pack(self) -> None:
+        """Store every list of tensors as a `PackedTensorList`, i.e. one
+        concatenated tensor plus offsets. Properties with the same segments
+        (e.g. all per-atom or all per-edge quantities) share one offsets tensor.
+        Lists that can't be packed (strings, tensors of different shapes) are
+        left as they are. Modifies the dataset in place.
+        """
+        shared_offsets = {}
+        for key, val in self.props.items():
+            if not PackedTensorList.can_pack(val):
+                continue
+
+            packed = PackedTensorList.from_list(val)
+            lengths = tuple(packed.offsets.tolist())
+            packed.offsets = shared_offsets.setdefault(lengths, packed.offsets)
+            self.props[key] = packed
+
+    def unpack(self) -> None:
+        """Convert packed properties back to lists of tensors. The tensors
+        are views of the packed data. Modifies the dataset in place.
+        """
+        for key, val in self.props.items():
+            if isinstance(val, PackedTensorList):
+                self.props[key] = val.to_list()
+
     def generate_neighbor_list(
         self,
         cutoff: float,
         undirected: bool = True,
         key: str = "nbr_list",
         offset_key: str = "offsets",
+        cache: GraphCache | str | bool | None = None,
+        image_shifts: bool = False,
     ) -> list | tuple[list, list]:
         """Generates a neighbor list for each one of the atoms in the dataset.
         By default, does not consider periodic boundary conditions.
@@ -216,26 +267,73 @@ class Dataset(TorchDataset):
             undirected (bool, optional): Description
             key (str, optional): key for the neighbor list in the dictionary
             offset_key (str, optional): key for the offset list in the dictionary
+            cache (GraphCache | str | bool, optional): cache of neighbor lists, or
+                its path. Defaults to the cache set with `nff.data.graph_cache.set_graph_cache`,
+                if any. Use False to not use a cache.
+            image_shifts (bool, optional): whether to store periodic offsets as
+                integer image shifts (see `to_image_shifts`)
 
         Returns:
             TYPE: Description
         """
+        cache = get_graph_cache(cache)
         if "lattice" not in self.props:
-            self.props[key] = [get_neighbor_list(nxyz[:, 1:4], cutoff, undirected) for nxyz in self.props["nxyz"]]
+
+            def compute(idx):
+                nxyz = self.props["nxyz"]
+                return {"nbr_list": [get_neighbor_list(nxyz[i][:, 1:4], cutoff, undirected) for i in idx]}
+
+            if cache is None:
+                values = compute(range(len(self)))
+            else:
+                keys = [hash_geom(nxyz, cutoff, not undirected) for nxyz in self.props["nxyz"]]
+                values = cache.get_or_compute(keys, compute)
+
+            self.props[key] = values.get("nbr_list", [])
             self.props[offset_key] = [torch.sparse.FloatTensor(nbrlist.shape[0], 3) for nbrlist in self.props[key]]
         else:
-            self._get_periodic_neighbor_list(cutoff=cutoff, undirected=undirected, offset_key=offset_key, nbr_key=key)
+            self._get_periodic_neighbor_list(
+                cutoff=cutoff, undirected=undirected, offset_key=offset_key, nbr_key=key, cache=cache
+            )
+            if image_shifts:
+                self.to_image_shifts(offset_key=offset_key)
+                return self.props[key], self.props["image_shifts"]
             return self.props[key], self.props[offset_key]
 
         return self.props[key]
 
+    def to_image_shifts(self, offset_key: str = "offsets") -> None:
+        """Store the periodic offsets as `image_shifts`, the int8 multiples of
+        the cell vectors in `lattice`, instead of Cartesian coordinates. Models
+        rebuild the Cartesian offsets from the cell of each structure, so they
+        take a fraction of the memory and stay valid if the cell is deformed.
+
+        Args:
+            offset_key (str, optional): key of the Cartesian offsets
+
+        Raises:
+            ValueError: raised if the dataset doesn't have the cell of each structure
+        """
+        if "lattice" not in self.props:
+            raise ValueError("Image shifts need the cell of each structure in `lattice`")
+
+        self.props["image_shifts"] = [
+            get_image_shifts(offsets, lattice)
+            for offsets, lattice in zip(self.props[offset_key], self.props["lattice"])
+        ]
+        self.props.pop(offset_key)
+
     def make_all_directed(self):
         """Make everything in the dataset directed."""
         make_dset_directed(self)
 
-    def generate_angle_list(self) -> list:
+    def generate_angle_list(self, cache: GraphCache | str | bool | None = None) -> list:
         """Generate the angle list for the dataset.
 
+        Args:
+            cache (GraphCache | str | bool, optional): cache of angle lists, or its
+                path. Defaults to the default cache, if any. Use False to not use a cache.
+
         Raises:
             NotImplementedError: raised if the dataset has periodic boundary conditions
 
@@ -247,26 +345,52 @@ class Dataset(TorchDataset):
 
         self.make_all_directed()
 
-        angles, nbrs = get_angle_list(self.props["nbr_list"])
-        self.props["nbr_list"] = nbrs
-        self.props["angle_list"] = angles
+        def compute(idx):
+            angles, nbrs = get_angle_list([self.props["nbr_list"][i] for i in idx])
+            ji_idx, kj_idx = add_ji_kj(angles, nbrs)
+            return {"angle_list": angles, "ji_idx": ji_idx, "kj_idx": kj_idx}
 
-        ji_idx, kj_idx = add_ji_kj(angles, nbrs)
+        cache = get_graph_cache(cache)
+        if cache is None:
+            values = compute(range(len(self)))
+        else:
+            keys = [hash_graph("angle_list", nbr_list) for nbr_list in self.props["nbr_list"]]
+            values = cache.get_or_compute(keys, compute)
 
-        self.props["ji_idx"] = ji_idx
-        self.props["kj_idx"] = kj_idx
+        for key in ["angle_list", "ji_idx", "kj_idx"]:
+            self.props[key] = values.get(key, [])
 
-        return angles
+        return self.props["angle_list"]
 
-    def generate_kj_ji(self, num_procs: int = 1):
+    def generate_kj_ji(self, num_procs: int = 1, cache: GraphCache | str | bool | None = None):
         """Generate only the `ji_idx` and `kj_idx` without storing
         the full angle list.
 
         Args:
             num_procs (int): number of parallel processes to use
+            cache (GraphCache | str | bool, optional): cache of the indices, or its
+                path. Defaults to the default cache, if any. Use False to not use a cache.
         """
         self.make_all_directed()
-        add_kj_ji_parallel(self, num_procs=num_procs)
+
+        cache = get_graph_cache(cache)
+        if cache is None:
+            add_kj_ji_parallel(self, num_procs=num_procs)
+            return
+
+        input_keys = [key for key in ["nbr_list", "num_atoms", "mol_size"] if key in self.props]
+
+        def compute(idx):
+            inputs = {key: [self.props[key][i] for i in idx] for key in input_keys}
+            outputs = map_geoms(kj_ji_geom, inputs, num_procs=num_procs)
+            return {key: val.to_list() for key, val in outputs.items()}
+
+        keys = [hash_graph("kj_ji", *[self.props[key][i] for key in input_keys]) for i in range(len(self))]
+        values = cache.get_or_compute(keys, compute)
+
+        for key in ["ji_idx", "kj_idx"]:
+            val = values.get(key, [])
+            self.props[key] = PackedTensorList.from_list(val) if self.is_packed and val else val
 
     def _get_periodic_neighbor_list(
         self,
@@ -274,28 +398,43 @@ class Dataset(TorchDataset):
         undirected: bool = False,
         offset_key: str = "offsets",
         nbr_key: str = "nbr_list",
+        cache: GraphCache | None = None,
     ) -> None:
         from nff.io.ase import AtomsBatch
 
-        nbrlist = []
-        offsets = []
-        for nxyz, lattice in zip(self.props["nxyz"], self.props["lattice"]):
-            atoms = AtomsBatch(
-                nxyz[:, 0].long(),
-                props={"num_atoms": torch.LongTensor([len(nxyz[:, 0])])},
-                positions=nxyz[:, 1:],
-                cell=lattice,
-                pbc=True,
-                cutoff=cutoff,
-                directed=(not undirected),
-                device=self.device,
-            )
-            nbrs, offs = atoms.update_nbr_list()
-            nbrlist.append(nbrs)
-            offsets.append(offs)
-
-        self.props[nbr_key] = nbrlist
-        self.props[offset_key] = offsets
+        def compute(idx):
+            nbrlist = []
+            offsets = []
+            for i in idx:
+                nxyz = self.props["nxyz"][i]
+                atoms = AtomsBatch(
+                    nxyz[:, 0].long(),
+                    props={"num_atoms": torch.LongTensor([len(nxyz[:, 0])])},
+                    positions=nxyz[:, 1:],
+                    cell=self.props["lattice"][i],
+                    pbc=True,
+                    cutoff=cutoff,
+                    directed=(not undirected),
+                    device=self.device,
+                )
+                nbrs, offs = atoms.update_nbr_list()
+                nbrlist.append(nbrs)
+                offsets.append(offs)
+            return {"nbr_list": nbrlist, "offsets": offsets}
+
+        if cache is None:
+            values = compute(range(len(self)))
+        else:
+            keys = [
+                hash_geom(nxyz, cutoff, not undirected, lattice=lattice)
+                for nxyz, lattice in zip(self.props["nxyz"], self.props["lattice"])
+            ]
+            values = cache.get_or_compute(keys, compute)
+            # cached offsets are dense, so the computed ones are made dense too
+            values["offsets"] = [offs.to_dense() if offs.is_sparse else offs for offs in values.get("offsets", [])]
+
+        self.props[nbr_key] = values.get("nbr_list", [])
+        self.props[offset_key] = values.get("offsets", [])
         return
 
     def generate_bond_idx(self, num_procs: int = 1) -> None:
@@ -460,9 +599,11 @@ class Dataset(TorchDataset):
         Args:
             path (str): dir where you want to save the dataset
         """
-        # to deal with the fact that sparse tensors can't be pickled
+        # to deal with the fact that sparse tensors can't be pickled.
+        # The dense offsets go in a new list, so the old one doesn't
+        # have to be copied
         offsets = self.props.get("offsets", torch.LongTensor([0]))
-        old_offsets = copy.deepcopy(offsets)
+        old_offsets = offsets
 
         # check if it's a sparse tensor. The first two conditions
         # Are needed for backwards compatability in case it's a float
@@ -474,6 +615,17 @@ class Dataset(TorchDataset):
         if "offsets" in self.props:
             self.props["offsets"] = old_offsets
 
+    def save_memmap(self, path: str) -> None:
+        """Save the dataset in the memory-mapped format, which can be
+        opened lazily with `nff.data.memmap.MemmapDataset`.
+
+        Args:
+            path (str): directory where you want to save the dataset
+        """
+        from nff.data.memmap import save_memmap
+
+        save_memmap(self, path)
+
     def gen_bond_stats(self) -> dict:
         """Generate bond statistics for the dataset.
 
@@ -654,7 +806,7 @@ class Dataset(TorchDataset):
                 "float" (torch.float32) or "double" (torch.float64)
         """
         for key in self.props:
-            if isinstance(self.props[key], torch.Tensor):
+            if isinstance(self.props[key], (torch.Tensor, PackedTensorList)):
                 if dtype == "float":
                     self.props[key] = self.props[key].float()
                 elif dtype == "double":
@@ -763,7 +915,7 @@ def to_tensor(x: list, stack: bool = False) -> list | torch.Tensor:
     if isinstance(x, str):
         return [x]
 
-    if isinstance(x, torch.Tensor):
+    if isinstance(x, (torch.Tensor, PackedTensorList)):
         return x
 
     if isinstance(x, list) and not isinstance(x[0], (str, torch.sparse.FloatTensor)):
@@ -984,6 +1136,7 @@ def split_train_test(
     stratified: bool = False,
     targ_name: str | None = None,
     seed: int | None = None,
+    view: bool = False,
     **kwargs,
 ) -> tuple[Dataset, Dataset]:
     """Splits the current dataset in two, one for training and
@@ -999,6 +1152,8 @@ def split_train_test(
         targ_name (str, optional): name of the binary label to use
             in splitting.
         seed (int, optional): random seed for reproducibility
+        view (bool, optional): whether to return views (`nff.data.DatasetView`)
+            that share the properties of `dataset` instead of copies
         kwargs: additional arguments for the stratified split
 
     Returns:
@@ -1018,12 +1173,22 @@ def split_train_test(
         idx = list(range(len(dataset)))
         idx_train, idx_test = train_test_split(idx, test_size=test_size, random_state=seed)
 
+    if view:
+        from nff.data.views import DatasetView
+
+        return DatasetView([dataset], idx_train), DatasetView([dataset], idx_test)
+
+    def subset(val, idx):
+        if isinstance(val, PackedTensorList):
+            return val[idx]
+        return [val[i] for i in idx]
+
     train = Dataset(
-        props={key: [val[i] for i in idx_train] for key, val in dataset.props.items()},
+        props={key: subset(val, idx_train) for key, val in dataset.props.items()},
         units=dataset.units,
     )
     test = Dataset(
-        props={key: [val[i] for i in idx_test] for key, val in dataset.props.items()},
+        props={key: subset(val, idx_test) for key, val in dataset.props.items()},
         units=dataset.units,
     )
 
@@ -1035,6 +1200,7 @@ def split_train_validation_test(
     val_size: float = 0.2,
     test_size: float = 0.2,
     seed: int | None = None,
+    view: bool = False,
     **kwargs,
 ) -> tuple[Dataset, Dataset, Dataset]:
     """Split the dataset into training, validation and test sets.
@@ -1044,16 +1210,18 @@ def split_train_validation_test(
         val_size (float, optional): fraction of the dataset for the validation set
         test_size (float, optional): fraction of the dataset for the test set
         seed (int, optional): random seed for reproducibility
+        view (bool, optional): whether to return views (`nff.data.DatasetView`)
+            that share the properties of `dataset` instead of copies
         kwargs: additional arguments for the split
 
     Returns:
         tuple[Dataset, Dataset, Dataset]: train, validation and test datasets
     """
     if np.isclose(val_size, 0.0):  # for no validation set
-        train, test = split_train_test(dataset, test_size=test_size, seed=seed, **kwargs)
+        train, test = split_train_test(dataset, test_size=test_size, seed=seed, view=view, **kwargs)
         validation = None
     else:
-        train, validation = split_train_test(dataset, test_size=val_size, seed=seed, **kwargs)
-        train, test = split_train_test(train, test_size=test_size / (1 - val_size), seed=seed, **kwargs)
+        train, validation = split_train_test(dataset, test_size=val_size, seed=seed, view=view, **kwargs)
+        train, test = split_train_test(train, test_size=test_size / (1 - val_size), seed=seed, view=view, **kwargs)
 
     return train, validation, test
@@ -0,0 +1,277 @@
+"""
+Content-addressed on-disk cache of neighbor lists, offsets and triplet
+indices, so that graphs are built only once for the same geometries, cell,
+cutoff and directedness, e.g. across hyperparameter sweeps or when a dataset
+is split differently.
+
+Layout of the directory:
+    index.jsonl             one line per cached item: its hash and, for each
+                            property, the dtype, start and shape in the data file
+    <key>.<dtype>.bin       raw data of all the cached values of a property,
+                            appended in order and read with `numpy.memmap`
+    cache.lock              lock file held while data and index lines are appended
+
+Both files are only ever appended to, and an item is added to the index only
+after its data have been written, so an interrupted write never leaves a
+corrupted entry. Writers hold an exclusive `fcntl.flock` on the lock file, so
+several processes on a POSIX file system can share a cache. Readers don't
+need the lock.
+
+`Dataset.generate_neighbor_list`, `Dataset.generate_angle_list` and
+`Dataset.generate_kj_ji` use the cache given to them, or the default cache set
+with `set_graph_cache` or the `NFF_GRAPH_CACHE` environment variable.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+INDEX_FILE = "index.jsonl"
+LOCK_FILE = "cache.lock"
+CACHE_VERSION = 1
+ENV_VAR = "NFF_GRAPH_CACHE"
+
+DEFAULT_CACHE = {"cache": None}
+
+
+def to_bytes(tensor):
+    array = np.ascontiguousarray(tensor.detach().cpu().numpy() if torch.is_tensor(tensor) else np.asarray(tensor))
+    return array.dtype.str.encode() + str(array.shape).encode() + array.tobytes()
+
+
+def make_hash(kind, *values):
+    """
+    Hash of a kind of graph and the inputs from which it's computed.
+    Args:
+        kind (str): kind of graph, e.g. "nbr_list"
+        *values: tensors, arrays, numbers or None
+    Returns:
+        str: hexadecimal hash
+    """
+
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(f"{CACHE_VERSION}:{kind}".encode())
+    for val in values:
+        hasher.update(b"|")
+        if val is None:
+            hasher.update(b"none")
+        elif isinstance(val, (bool, int, float, str)):
+            hasher.update(repr(val).encode())
+        else:
+            hasher.update(to_bytes(val))
+
+    return hasher.hexdigest()
+
+
+def hash_geom(nxyz, cutoff, directed, lattice=None):
+    """Hash of the neighbor list of a geometry."""
+    return make_hash("nbr_list", nxyz, lattice, float(cutoff), bool(directed))
+
+
+def hash_graph(kind, nbr_list, *values):
+    """Hash of a quantity computed from a neighbor list (e.g. the triplets)."""
+    return make_hash(kind, nbr_list, *values)
+
+
+class GraphCache:
+    """Append-only, memory-mapped store of graph properties keyed by hash.
+
+    Attributes:
+        path (str): directory of the cache
+        index (dict): location of the properties of each cached item
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index = {}
+        self.index_pos = 0
+        self.maps = {}
+        self.refresh()
+
+    def refresh(self):
+        """Read the entries that were added to the index since it was last read,
+        e.g. by another process."""
+
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+
+        with open(index_path, "r") as f:
+            f.seek(self.index_pos)
+            for line in f:
+                # a line without a newline is still being written
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                self.index[entry["hash"]] = entry["values"]
+                self.index_pos += len(line.encode())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    @contextmanager
+    def lock(self):
+        """Hold the write lock of the cache."""
+
+        with open(os.path.join(self.path, LOCK_FILE), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def data_file(self, name, dtype):
+        return os.path.join(self.path, f"{name}.{np.dtype(dtype).name}.bin")
+
+    def read(self, name, dtype, start, shape):
+        size = int(np.prod(shape))
+        if size == 0:
+            return torch.from_numpy(np.zeros(shape, dtype=dtype))
+
+        path = self.data_file(name, dtype)
+        array = self.maps.get(path)
+        if array is None or len(array) < start + size:
+            array = np.memmap(path, dtype=dtype, mode="r")
+            self.maps[path] = array
+
+        return torch.from_numpy(np.array(array[start : start + size]).reshape(shape))
+
+    def get(self, key, refresh=True):
+        """
+        Get the cached properties of an item.
+        Args:
+            key (str): hash of the item
+            refresh (bool): whether to look for new entries in the index if
+                the item isn't cached
+        Returns:
+            values (dict or None): tensor of each property, or None if the
+                item isn't cached
+        """
+
+        if refresh and key not in self.index:
+            self.refresh()
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+
+        return {name: self.read(name, dtype, start, shape) for name, (dtype, start, shape) in entry.items()}
+
+    def put_many(self, items):
+        """
+        Add several items to the cache.
+        Args:
+            items (list[tuple[str, dict]]): hash and tensor of each property
+                of every item
+        """
+
+        with self.lock():
+            # skip the items that other processes have added in the meantime
+            self.refresh()
+            items = [(key, values) for key, values in items if key not in self.index]
+            if items:
+                self.append(items)
+
+    def append(self, items):
+        """Write the data and index entries of new items. The caller must hold
+        the lock."""
+
+        # write the data of every property with one call
+        entries = [{} for _ in items]
+        arrays = {}
+        for entry, (_, values) in zip(entries, items):
+            for name, val in values.items():
+                if val.is_sparse:
+                    val = val.to_dense()
+                array = np.ascontiguousarray(val.detach().cpu().numpy())
+                arrays.setdefault((name, array.dtype.name), []).append((entry, array))
+
+        for (name, dtype), pairs in arrays.items():
+            with open(self.data_file(name, dtype), "ab") as f:
+                start = f.tell() // np.dtype(dtype).itemsize
+                for entry, array in pairs:
+                    entry[name] = [dtype, start, list(array.shape)]
+                    start += array.size
+                f.write(b"".join(array.tobytes() for _, array in pairs))
+
+        lines = "".join(json.dumps({"hash": key, "values": entry}) + "\n" for (key, _), entry in zip(items, entries))
+        with open(os.path.join(self.path, INDEX_FILE), "a") as f:
+            f.write(lines)
+
+        for (key, _), entry in zip(items, entries):
+            self.index[key] = entry
+
+    def put(self, key, values):
+        self.put_many([(key, values)])
+
+    def get_or_compute(self, keys, compute):
+        """
+        Get the properties of several items, computing and caching the
+        ones that aren't in the cache.
+        Args:
+            keys (list[str]): hash of each item
+            compute (callable): function that takes the positions of the
+                missing items and returns a dictionary with a list of values
+                of each property for those items
+        Returns:
+            values (dict): list of values of each property for all the items
+        """
+
+        self.refresh()
+        cached = [self.get(key, refresh=False) for key in keys]
+        missing = [i for i, val in enumerate(cached) if val is None]
+
+        if missing:
+            computed = compute(missing)
+            new_items = []
+            for j, i in enumerate(missing):
+                cached[i] = {name: val[j] for name, val in computed.items()}
+                new_items.append((keys[i], cached[i]))
+            self.put_many(new_items)
+
+        if not cached:
+            return {}
+
+        return {name: [val[name] for val in cached] for name in cached[0].keys()}
+
+
+def set_graph_cache(cache):
+    """
+    Set the cache used by datasets when none is given explicitly.
+    Args:
+        cache (GraphCache, str or None): cache, path of a cache, or None to
+            not use a cache by default
+    """
+
+    DEFAULT_CACHE["cache"] = GraphCache(cache) if isinstance(cache, str) else cache
+
+
+def get_graph_cache(cache=None):
+    """
+    Get the cache to use.
+    Args:
+        cache (GraphCache, str, bool or None): cache or path of a cache. With
+            None the default cache is used, and with False no cache is used.
+    Returns:
+        GraphCache or None: cache
+    """
+
+    if cache is False:
+        return None
+    if isinstance(cache, GraphCache):
+        return cache
+    if isinstance(cache, str):
+        return GraphCache(cache)
+
+    if DEFAULT_CACHE["cache"] is None and os.environ.get(ENV_VAR):
+        set_graph_cache(os.environ[ENV_VAR])
+
+    return DEFAULT_CACHE["cache"]
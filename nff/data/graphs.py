@@ -4,7 +4,7 @@ import torch
 from ase import Atoms
 from tqdm import tqdm
 
-from nff.utils.misc import tqdm_enum
+from nff.utils.cell_list import CELL_LIST_MIN_ATOMS, cell_list_nbr_list
 
 DISTANCETHRESHOLDICT_SYMBOL = {
     ("H", "H"): 1.00,
@@ -116,12 +116,19 @@ def get_neighbor_list(xyz, cutoff=5, undirected=True):
     Returns:
         nbr_list (torch.Tensor): (num_edges, 2) array with the
             indices of connected atoms.
+
+    Large systems use a linked-cell search instead of the dense
+    distance matrix.
     """
 
     if not torch.is_tensor(xyz):
         xyz = torch.Tensor(xyz)
     n = xyz.size(0)
 
+    if n >= CELL_LIST_MIN_ATOMS:
+        nbr_list, _ = cell_list_nbr_list(xyz, cutoff, directed=(not undirected), inclusive=True, device=xyz.device)
+        return nbr_list
+
     # calculating distances
     dist = (xyz.expand(n, n, 3) - xyz.expand(n, n, 3).transpose(0, 1)).pow(2).sum(dim=2).sqrt()
 
@@ -332,6 +339,143 @@ def make_nbr_dic(nbr_list):
     return nbr_dic
 
 
+def edges_by_atom(atom_idx, num_atoms):
+    """
+    CSR layout of a neighbor list column.
+    Args:
+        atom_idx (torch.LongTensor): one column of the neighbor list
+        num_atoms (int): number of atoms
+    Returns:
+        order (torch.LongTensor): edge indices sorted by atom, keeping
+            the original order of edges that share an atom
+        starts (torch.LongTensor): position in `order` of the first edge
+            of each atom
+        counts (torch.LongTensor): number of edges of each atom
+    """
+
+    order = torch.argsort(atom_idx, stable=True)
+    counts = torch.bincount(atom_idx, minlength=num_atoms)
+    starts = torch.cumsum(counts, 0) - counts
+
+    return order, starts, counts
+
+
+def expand_csr(starts, counts):
+    """
+    Expand a set of CSR segments into the positions they cover.
+    Args:
+        starts (torch.LongTensor): first position of each segment
+        counts (torch.LongTensor): length of each segment
+    Returns:
+        seg_idx (torch.LongTensor): which segment each position belongs to
+        pos (torch.LongTensor): the positions
+    """
+
+    seg_idx = torch.repeat_interleave(torch.arange(len(counts), device=counts.device), counts)
+    first = torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+    within = torch.arange(len(seg_idx), device=counts.device) - first
+    pos = starts[seg_idx] + within
+
+    return seg_idx, pos
+
+
+def lookup_edges(nbr_list, pairs, num_atoms):
+    """
+    Find the index in the neighbor list of each pair of atoms.
+    Args:
+        nbr_list (torch.LongTensor): neighbor list
+        pairs (torch.LongTensor): (M, 2) pairs to look up
+        num_atoms (int): number of atoms
+    Returns:
+        idx (torch.LongTensor): index of each pair in `nbr_list`
+        found (torch.BoolTensor): whether each pair is in `nbr_list`
+    """
+
+    keys = nbr_list[:, 0] * num_atoms + nbr_list[:, 1]
+    sorted_keys, perm = torch.sort(keys, stable=True)
+    query = pairs[:, 0] * num_atoms + pairs[:, 1]
+
+    pos = torch.searchsorted(sorted_keys, query).clamp(max=max(len(keys) - 1, 0))
+    if len(keys) == 0:
+        return pos, torch.zeros_like(query, dtype=torch.bool)
+
+    found = sorted_keys[pos] == query
+    return perm[pos], found
+
+
+def get_batch_angle_list(nbr_list, num_atoms=None):
+    """
+    Get the angle list and the ji and kj indices of a directed neighbor
+    list in O(E log E) and without Python loops. Since angles never connect
+    different geometries, this works directly on a collated batch, so the
+    triplets can be generated on the fly.
+    Args:
+        nbr_list (torch.LongTensor): directed neighbor list
+        num_atoms (int, optional): total number of atoms. Inferred from
+            the neighbor list if not given.
+    Returns:
+        angle_list (torch.LongTensor): angles [i, j, k], ordered
+            in the same way as `get_angle_list`
+        ji_idx (torch.LongTensor): index of the j,i pair of each angle
+            in the neighbor list
+        kj_idx (torch.LongTensor): index of the k,j pair of each angle
+            in the neighbor list
+    """
+
+    if num_atoms is None:
+        num_atoms = int(nbr_list.max()) + 1 if len(nbr_list) > 0 else 0
+
+    src = nbr_list[:, 0]
+    dst = nbr_list[:, 1]
+
+    # for each edge i -> j, every edge j -> k
+    order, starts, counts = edges_by_atom(src, num_atoms)
+    ij_idx, pos = expand_csr(starts[dst], counts[dst])
+    jk_idx = order[pos]
+
+    # take out angles of the form [i, j, i], which aren't really angles
+    mask = src[ij_idx] != dst[jk_idx]
+    ij_idx = ij_idx[mask]
+    jk_idx = jk_idx[mask]
+
+    angle_list = torch.stack([src[ij_idx], dst[ij_idx], dst[jk_idx]], dim=1)
+
+    # the ji and kj pairs are the reverse of the ij and jk pairs
+    rev_idx, found = lookup_edges(nbr_list, nbr_list.flip(1), num_atoms)
+    if not found[torch.cat([ij_idx, jk_idx])].all():
+        raise ValueError("Neighbor list must be directed to get ji and kj indices.")
+
+    ji_idx = rev_idx[ij_idx]
+    kj_idx = rev_idx[jk_idx]
+
+    return angle_list, ji_idx, kj_idx
+
+
+def concat_graphs(nbr_lists):
+    """
+    Concatenate neighbor lists of different geometries into one graph.
+    Args:
+        nbr_lists (list[torch.LongTensor]): neighbor lists
+    Returns:
+        nbr_list (torch.LongTensor): combined neighbor list
+        atom_shift (torch.LongTensor): atom index shift of each geometry
+        edge_shift (torch.LongTensor): edge index shift of each geometry
+        num_atoms (int): total number of atoms
+    """
+
+    device = nbr_lists[0].device if nbr_lists else "cpu"
+    sizes = torch.LongTensor([int(nbrs.max()) + 1 if len(nbrs) > 0 else 0 for nbrs in nbr_lists]).to(device)
+    num_edges = torch.LongTensor([len(nbrs) for nbrs in nbr_lists]).to(device)
+
+    atom_shift = torch.cumsum(sizes, 0) - sizes
+    edge_shift = torch.cumsum(num_edges, 0) - num_edges
+
+    nbr_list = torch.cat([nbrs.reshape(-1, 2).long() for nbrs in nbr_lists]) if nbr_lists else torch.zeros(0, 2).long()
+    nbr_list = nbr_list + torch.repeat_interleave(atom_shift, num_edges)[:, None]
+
+    return nbr_list, atom_shift, edge_shift, int(sizes.sum())
+
+
 def get_angle_list(nbr_lists):
     """
     Get angle lists from neighbor lists.
@@ -345,30 +489,18 @@ def get_angle_list(nbr_lists):
             already).
     """
 
-    new_nbrs = []
-    angles = []
-    num = []
+    new_nbrs = [make_directed(nbr_list)[0] for nbr_list in nbr_lists]
+    if not new_nbrs:
+        return [], []
 
-    for nbr_list in tqdm(nbr_lists):
-        nbr_list, _ = make_directed(nbr_list)
+    nbr_list, atom_shift, edge_shift, num_atoms = concat_graphs(new_nbrs)
+    angle_tens, _, _ = get_batch_angle_list(nbr_list, num_atoms)
 
-        these_angles = []
-        nbr_dic = make_nbr_dic(nbr_list)
-        for nbr in nbr_list:
-            nbr_1 = nbr[1].item()
-            nbr_1_nbrs = torch.LongTensor(nbr_dic[nbr_1]).reshape(-1, 1)
-            nbr_repeat = nbr.repeat(len(nbr_1_nbrs), 1)
-            these_angles += [torch.cat([nbr_repeat, nbr_1_nbrs], dim=-1)]
-        these_angles = torch.cat(these_angles)
-
-        new_nbrs.append(nbr_list)
-        angles.append(these_angles)
-        num.append(these_angles.shape[0] - len(nbr_list))
-
-    # take out angles of the form [i, j, i], which aren't really angles
-    angle_tens = torch.cat(angles)
-    mask = angle_tens[:, 0] != angle_tens[:, 2]
-    angles = list(torch.split(angle_tens[mask], num))
+    # every angle belongs to the geometry of its i -> j edge
+    geom_idx = torch.searchsorted(atom_shift, angle_tens[:, 0].contiguous(), right=True) - 1
+    num = torch.bincount(geom_idx, minlength=len(new_nbrs)).tolist()
+    angle_tens = angle_tens - atom_shift[geom_idx][:, None]
+    angles = list(torch.split(angle_tens, num))
 
     return angles, new_nbrs
 
@@ -421,26 +553,11 @@ def m_idx_of_angles(angle_list, nbr_list, angle_start, angle_end):
 
     """
 
-    # expand nbr_list[:, 0] so it's repeated once
-    # for every element of `angle_list`.
-    repeated_nbr = nbr_list[:, 0].repeat(angle_list.shape[0], 1)
-    reshaped_angle = angle_list[:, angle_start].reshape(-1, 1)
-    # gives you a matrix that shows you where each angle is equal
-    # to nbr_list[:, 0]
-    mask = repeated_nbr == reshaped_angle
-
-    # same idea, but with nbr_list[:, 1] and angle_list[:, angle_end]
-
-    repeated_nbr = nbr_list[:, 1].repeat(angle_list.shape[0], 1)
-    reshaped_angle = angle_list[:, angle_end].reshape(-1, 1)
+    num_atoms = int(max(nbr_list.max(), angle_list.max())) + 1 if len(nbr_list) > 0 and len(angle_list) > 0 else 0
+    pairs = angle_list[:, [angle_start, angle_end]]
+    idx, found = lookup_edges(nbr_list, pairs, num_atoms)
 
-    # the full mask is the product of both
-    mask *= repeated_nbr == reshaped_angle
-
-    # get the indices where everything is true
-    idx = mask.nonzero(as_tuple=False)[:, 1]
-
-    return idx
+    return idx[found]
 
 
 def add_ji_kj(angle_lists, nbr_lists):
@@ -466,15 +583,21 @@ def add_ji_kj(angle_lists, nbr_lists):
     # at index 2, and m_21 occurs at index 5. So
     # ji_idx = 2 and kj_idx = 5.
 
-    ji_idx_list = []
-    kj_idx_list = []
-    for i, nbr_list in tqdm_enum(nbr_lists):
-        angle_list = angle_lists[i]
-        ji_idx = m_idx_of_angles(angle_list=angle_list, nbr_list=nbr_list, angle_start=1, angle_end=0)
+    if not nbr_lists:
+        return [], []
+
+    nbr_list, atom_shift, edge_shift, _ = concat_graphs(nbr_lists)
+    num_angles = [len(angle_list) for angle_list in angle_lists]
+    angle_shift = torch.repeat_interleave(atom_shift, torch.LongTensor(num_angles).to(atom_shift.device))
+    angle_list = torch.cat([angles.reshape(-1, 3).long() for angles in angle_lists]) + angle_shift[:, None]
+
+    ji_idx = m_idx_of_angles(angle_list=angle_list, nbr_list=nbr_list, angle_start=1, angle_end=0)
+    kj_idx = m_idx_of_angles(angle_list=angle_list, nbr_list=nbr_list, angle_start=2, angle_end=1)
 
-        kj_idx = m_idx_of_angles(angle_list=angle_list, nbr_list=nbr_list, angle_start=2, angle_end=1)
-        ji_idx_list.append(ji_idx)
-        kj_idx_list.append(kj_idx)
+    # map back to the edge indices of each geometry
+    edge_geom = torch.searchsorted(edge_shift, ji_idx, right=True) - 1
+    ji_idx_list = list(torch.split(ji_idx - edge_shift[edge_geom], num_angles))
+    kj_idx_list = list(torch.split(kj_idx - edge_shift[edge_geom], num_angles))
 
     return ji_idx_list, kj_idx_list
 
@@ -520,9 +643,8 @@ def make_dset_directed(dset):
 def batch_angle_idx(nbrs):
     """
     Given a neighbor list, find the sets of indices in the neighbor list
-    corresponding to the kj and ji indices. Usually you can only do this
-    for one conformer without running out of memory -- to do it for multiple
-    conformers, use `full_angle_idx` below.
+    corresponding to the kj and ji indices. This is done with a sort over
+    the neighbor list, so it also works for a batch of several conformers.
     Args:
         nbrs (torch.LongTensor): neighbor list
     Returns:
@@ -532,12 +654,16 @@ def batch_angle_idx(nbrs):
             value of n.
     """
 
-    all_idx = torch.stack([torch.arange(len(nbrs))] * len(nbrs)).long()
-    mask = (nbrs[:, 1] == nbrs[:, 0, None]) * (nbrs[:, 0] != nbrs[:, 1, None])
-    ji_idx = all_idx[mask]
-    kj_idx = mask.nonzero(as_tuple=False)[:, 0]
+    num_atoms = int(nbrs.max()) + 1 if len(nbrs) > 0 else 0
 
-    return ji_idx, kj_idx
+    # for each pair v -> w, every pair k -> v with k != w
+    order, starts, counts = edges_by_atom(nbrs[:, 1], num_atoms)
+    kj_idx, pos = expand_csr(starts[nbrs[:, 0]], counts[nbrs[:, 0]])
+    ji_idx = order[pos]
+
+    mask = nbrs[ji_idx, 0] != nbrs[kj_idx, 1]
+
+    return ji_idx[mask], kj_idx[mask]
 
 
 def full_angle_idx(batch):
@@ -555,31 +681,14 @@ def full_angle_idx(batch):
     nbr_list = batch["nbr_list"]
     num_atoms = batch["num_atoms"]
     mol_size = batch.get("mol_size", num_atoms)
-    num_confs = num_atoms // mol_size
-
-    all_ji_idx = []
-    all_kj_idx = []
-
-    for i in range(num_confs):
-        max_idx = (i + 1) * mol_size
-        min_idx = i * mol_size
-
-        # get only the indices for this conformer
-        conf_mask = (nbr_list[:, 0] < max_idx) * (nbr_list[:, 0] >= min_idx)
-        nbrs = nbr_list[conf_mask]
-        # map from indices of these sub-neighbors
-        # to indices in full neighbor list
-        ji_idx, kj_idx = batch_angle_idx(nbrs)
-
-        # map to these indices
-        map_indices = conf_mask.nonzero(as_tuple=False).reshape(-1)
-        all_ji_idx.append(map_indices[ji_idx])
-        all_kj_idx.append(map_indices[kj_idx])
 
-    all_ji_idx = torch.cat(all_ji_idx)
-    all_kj_idx = torch.cat(all_kj_idx)
+    # pairs never connect different conformers, so we can do them all at
+    # once and then group them by conformer
+    all_ji_idx, all_kj_idx = batch_angle_idx(nbr_list)
+    conf_idx = torch.div(nbr_list[all_kj_idx, 0], mol_size, rounding_mode="floor")
+    order = torch.argsort(conf_idx, stable=True)
 
-    return all_ji_idx, all_kj_idx
+    return all_ji_idx[order], all_kj_idx[order]
 
 
 def kj_ji_to_dset(dataset, track):
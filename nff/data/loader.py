@@ -1,8 +1,11 @@
 import copy
+import functools
 
 import numpy as np
 import torch
-from torch.utils.data.sampler import BatchSampler, Sampler
+from torch.utils.data.sampler import BatchSampler, RandomSampler, Sampler, SequentialSampler
+
+from nff.data.views import ViewColumn
 
 REINDEX_KEYS = ["atoms_nbr_list", "nbr_list", "bonded_nbr_list", "angle_list", "mol_nbrs"]
 NBR_LIST_KEYS = ["bond_idx", "kj_idx", "ji_idx"]
@@ -18,15 +21,56 @@ TYPE_KEYS = {
     "angle_list": torch.long,
     "ji_idx": torch.long,
     "kj_idx": torch.long,
+    "image_shifts": torch.int8,
 }
 
 
-def collate_dicts(dicts):
+def get_shifts(dicts, key, shifts):
+    """Repeat the per-item index shift of every item once for
+    each row of its value of `key`.
+
+    Args:
+        dicts (list of dict): each element of the dataset
+        key (str): key to reindex
+        shifts (torch.LongTensor): index shift of each item
+
+    Returns:
+        torch.LongTensor: shift of every row of the batched `key`
+    """
+    lengths = torch.LongTensor([len(d[key]) for d in dicts])
+    return torch.repeat_interleave(shifts, lengths)
+
+
+def cat_values(values, buffers=None, key=None):
+    """Concatenate the values of a key, optionally into a preallocated buffer.
+
+    Args:
+        values (list of torch.Tensor): values to concatenate
+        buffers (CollateBuffers, optional): preallocated buffers
+        key (str, optional): name of the key, used to choose the buffer
+
+    Returns:
+        torch.Tensor: concatenated values
+    """
+    if buffers is None or any(val.is_sparse for val in values):
+        return torch.cat(values, dim=0)
+
+    dtype = functools.reduce(torch.promote_types, [val.dtype for val in values])
+    shape = (sum(len(val) for val in values), *values[0].shape[1:])
+    return torch.cat(values, dim=0, out=buffers.get(key, shape, dtype))
+
+
+def collate_dicts(dicts, buffers=None):
     """Collates dictionaries within a single batch. Automatically reindexes
         neighbor lists and periodic boundary conditions to deal with the batch.
+        The atom and edge offsets of every item are computed once, every key
+        is reindexed with a single vectorized add, and the input dictionaries
+        are never modified, so cached items can be collated more than once.
 
     Args:
         dicts (list of dict): each element of the dataset
+        buffers (CollateBuffers, optional): preallocated (and possibly pinned)
+            buffers to write the batch into
 
     Returns:
         batch (dict)
@@ -35,27 +79,20 @@ def collate_dicts(dicts):
     # new indices for the batch: the first one is zero and the
     # last does not matter
 
-    cumulative_atoms = np.cumsum([0] + [d["num_atoms"] for d in dicts])[:-1]
+    num_atoms = torch.stack([torch.as_tensor(d["num_atoms"]).reshape(-1).sum() for d in dicts]).long()
+    cumulative_atoms = torch.cumsum(num_atoms, 0) - num_atoms
 
-    for n, d in zip(cumulative_atoms, dicts):
-        for key in REINDEX_KEYS:
-            if key in d:
-                d[key] = d[key] + int(n)
+    shifts = {key: cumulative_atoms for key in REINDEX_KEYS}
 
     if all("nbr_list" in d for d in dicts):
         # same idea, but for quantities whose maximum value is the length of
         # the nbr list in each batch
-        cumulative_nbrs = np.cumsum([0] + [len(d["nbr_list"]) for d in dicts])[:-1]
-        for n, d in zip(cumulative_nbrs, dicts):
-            for key in NBR_LIST_KEYS:
-                if key in d:
-                    d[key] = d[key] + int(n)
-
-    for key in MOL_IDX_KEYS:
-        if key not in dicts[0]:
-            continue
-        for i, d in enumerate(dicts):
-            d[key] += i
+        num_nbrs = torch.LongTensor([len(d["nbr_list"]) for d in dicts])
+        cumulative_nbrs = torch.cumsum(num_nbrs, 0) - num_nbrs
+        shifts.update({key: cumulative_nbrs for key in NBR_LIST_KEYS})
+
+    # molecule indices are shifted by the position of the item in the batch
+    shifts.update({key: torch.arange(len(dicts)) for key in MOL_IDX_KEYS})
 
     # batching the data
     batch = {}
@@ -65,7 +102,12 @@ def collate_dicts(dicts):
         if isinstance(val, str):
             batch[key] = [data[key] for data in dicts]
         elif hasattr(val, "shape") and len(val.shape) > 0:
-            batch[key] = torch.cat([data[key] for data in dicts], dim=0)
+            values = [data[key] for data in dicts]
+            batch[key] = cat_values(values, buffers=buffers, key=key)
+            if key in shifts and all(key in d for d in dicts):
+                # `batch[key]` is a new tensor, so it can be shifted in place
+                row_shifts = get_shifts(dicts, key, shifts[key]).to(batch[key].device)
+                batch[key].add_(row_shifts.reshape(-1, *[1] * (batch[key].dim() - 1)))
         else:
             batch[key] = torch.stack([data[key] for data in dicts], dim=0)
 
@@ -77,6 +119,54 @@ def collate_dicts(dicts):
     return batch
 
 
+class CollateBuffers:
+    """Preallocated buffers that `collate_dicts` can write batches into. The
+    buffers grow as needed and are reused, so batches of similar size don't
+    allocate new memory. With `pin_memory=True` they are page-locked, which
+    makes host to GPU copies faster and allows `non_blocking` transfers.
+
+    Several sets of buffers are used in rotation, so a batch stays valid until
+    `num_sets` more batches have been collated. Use it as the `collate_fn` of a
+    `DataLoader` through `functools.partial(collate_dicts, buffers=buffers)`,
+    and don't keep references to old batches.
+    """
+
+    def __init__(self, pin_memory=False, num_sets=2):
+        """
+        Args:
+            pin_memory (bool): whether to allocate pinned memory
+            num_sets (int): number of sets of buffers used in rotation
+        """
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.num_sets = num_sets
+        self.sets = [{} for _ in range(num_sets)]
+        self.counts = {}
+
+    def get(self, key, shape, dtype):
+        """Get a buffer with a given shape and dtype for a key.
+
+        Args:
+            key (str): name of the key
+            shape (tuple): shape of the buffer
+            dtype (torch.dtype): data type of the buffer
+
+        Returns:
+            torch.Tensor: view of the buffer with the requested shape
+        """
+        # rotate to the next set of buffers every time a key is requested again
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        buffers = self.sets[count % self.num_sets]
+
+        numel = int(np.prod(shape))
+        buffer = buffers.get(key)
+        if buffer is None or buffer.dtype != dtype or buffer.numel() < numel:
+            buffer = torch.empty(max(numel, 1), dtype=dtype, pin_memory=self.pin_memory)
+            buffers[key] = buffer
+
+        return buffer[:numel].view(shape)
+
+
 class ImbalancedDatasetSampler(Sampler):
     """
 
@@ -221,3 +311,216 @@ class BalancedBatchedSpecies(BatchSampler):
 
     def __len__(self):
         return len(self.sampler) // self.batch_size
+
+
+def get_lengths(values):
+    """Length of every item of a per-geometry property along its first
+    dimension. Packed and memory-mapped properties are measured from their
+    offsets, without reading the data, and views from the properties they're
+    built on.
+
+    Args:
+        values (list, PackedTensorList, MemmapColumn or ViewColumn): values of the property
+
+    Returns:
+        torch.LongTensor: length of each item
+    """
+    if isinstance(values, ViewColumn):
+        return values.gather([get_lengths(column) for column in values.columns])
+
+    offsets = getattr(values, "offsets", None)
+    if offsets is not None:
+        offsets = torch.as_tensor(np.asarray(offsets), dtype=torch.long)
+        return offsets[1:] - offsets[:-1]
+    return torch.LongTensor([len(val) for val in values])
+
+
+def get_item_sizes(dataset):
+    """Number of atoms and neighbor-list edges of every item of a dataset.
+
+    Args:
+        dataset (nff.data.Dataset, MemmapDataset or torch Dataset): dataset.
+            Datasets without `props` are read item by item.
+
+    Returns:
+        num_atoms (torch.LongTensor): number of atoms of each item
+        num_edges (torch.LongTensor or None): number of edges in the neighbor
+            list of each item, or None if the items don't have neighbor lists
+    """
+    props = getattr(dataset, "props", None)
+    if props is None:
+        items = [dataset[i] for i in range(len(dataset))]
+        props = {key: [item[key] for item in items] for key in ["num_atoms", "nxyz", "nbr_list"] if key in items[0]}
+
+    if "num_atoms" in props:
+        num_atoms = torch.LongTensor([int(torch.as_tensor(n).sum()) for n in props["num_atoms"]])
+    else:
+        num_atoms = get_lengths(props["nxyz"])
+
+    num_edges = get_lengths(props["nbr_list"]) if "nbr_list" in props else None
+
+    return num_atoms, num_edges
+
+
+class SizeBatchSampler(Sampler):
+    """Batch sampler that packs geometries into batches with at most `max_atoms`
+    atoms and `max_edges` neighbor-list edges, instead of a fixed number of
+    geometries. This keeps the memory of a batch roughly constant when the
+    dataset has geometries of very different sizes.
+
+    Indices are drawn from `sampler`, so the sampling probabilities of weighted
+    samplers such as `ImbalancedDatasetSampler` and `BalancedFFSampler` are
+    kept. They are grouped in buckets of `bucket_size` indices and sorted by
+    size within each bucket, so that geometries of similar size end up in the
+    same batch. The batches of a bucket are yielded in random order, and the
+    last, partly filled batch of a bucket is carried over to the next one.
+
+    Each epoch is planned when it starts (or when `len` is called before it
+    starts), so the number of batches is exact.
+
+    Use it as the `batch_sampler` of a `DataLoader`.
+    """
+
+    def __init__(
+        self,
+        sampler,
+        num_atoms,
+        num_edges=None,
+        max_atoms=None,
+        max_edges=None,
+        max_size=None,
+        bucket_size=1024,
+        shuffle=True,
+        drop_last=False,
+        generator=None,
+    ):
+        """
+        Args:
+            sampler (Sampler or iterable): sampler of dataset indices
+            num_atoms (torch.LongTensor): number of atoms of each item
+            num_edges (torch.LongTensor, optional): number of neighbor-list
+                edges of each item. Needed for `max_edges`.
+            max_atoms (int, optional): maximum number of atoms in a batch
+            max_edges (int, optional): maximum number of edges in a batch
+            max_size (int, optional): maximum number of geometries in a batch
+            bucket_size (int): number of sampled indices that are sorted by
+                size and packed together
+            shuffle (bool): whether to yield the batches of a bucket in
+                random order
+            drop_last (bool): whether to drop the last batch if it isn't full
+            generator (torch.Generator, optional): random number generator
+                for shuffling the batches
+        """
+        if max_atoms is None and max_edges is None and max_size is None:
+            raise ValueError("At least one of max_atoms, max_edges and max_size must be given")
+        if max_edges is not None and num_edges is None:
+            raise ValueError("max_edges needs the number of edges of each item")
+
+        self.sampler = sampler
+        self.num_atoms = torch.as_tensor(num_atoms, dtype=torch.long)
+        self.num_edges = None if num_edges is None else torch.as_tensor(num_edges, dtype=torch.long)
+        self.max_atoms = max_atoms
+        self.max_edges = max_edges
+        self.max_size = max_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.batches = None
+
+    @classmethod
+    def from_dataset(cls, dataset, sampler=None, shuffle=True, **kwargs):
+        """Make a batch sampler with the sizes of the items of a dataset.
+
+        Args:
+            dataset (Dataset): dataset
+            sampler (Sampler, optional): sampler of dataset indices. Defaults to
+                a random sampler if `shuffle`, and a sequential one otherwise.
+            shuffle (bool): whether to shuffle the indices and batches
+            **kwargs: keyword arguments for `SizeBatchSampler`
+
+        Returns:
+            SizeBatchSampler: batch sampler
+        """
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        num_atoms, num_edges = get_item_sizes(dataset)
+        return cls(sampler, num_atoms, num_edges=num_edges, shuffle=shuffle, **kwargs)
+
+    def is_full(self, num_atoms, num_edges, size):
+        return (
+            (self.max_atoms is not None and num_atoms > self.max_atoms)
+            or (self.max_edges is not None and num_edges > self.max_edges)
+            or (self.max_size is not None and size > self.max_size)
+        )
+
+    def pack(self, indices):
+        """Pack indices into batches. Items that are larger than the budget on
+        their own get a batch of their own.
+
+        Args:
+            indices (torch.LongTensor): indices to pack
+
+        Returns:
+            list[list[int]]: batches
+        """
+        # sort by the size that's most likely to limit the batches
+        sizes = self.num_edges if self.max_edges is not None else self.num_atoms
+        indices = indices[torch.argsort(sizes[indices], stable=True)]
+
+        num_atoms = self.num_atoms[indices].tolist()
+        num_edges = [0] * len(indices) if self.num_edges is None else self.num_edges[indices].tolist()
+
+        batches = []
+        batch = []
+        batch_atoms = batch_edges = 0
+        for idx, atoms, edges in zip(indices.tolist(), num_atoms, num_edges):
+            if batch and self.is_full(batch_atoms + atoms, batch_edges + edges, len(batch) + 1):
+                batches.append(batch)
+                batch = []
+                batch_atoms = batch_edges = 0
+            batch.append(idx)
+            batch_atoms += atoms
+            batch_edges += edges
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def plan(self):
+        """Draw the indices of an epoch and pack them into batches.
+
+        Returns:
+            list[list[int]]: batches
+        """
+        batches = []
+        leftover = []
+        indices = list(iter(self.sampler))
+
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = torch.LongTensor(leftover + indices[start : start + self.bucket_size])
+            bucket_batches = self.pack(bucket)
+
+            # the last batch is the only one that may not be full
+            if start + self.bucket_size < len(indices):
+                leftover = bucket_batches.pop(-1)
+            elif self.drop_last:
+                bucket_batches.pop(-1)
+
+            if self.shuffle:
+                order = torch.randperm(len(bucket_batches), generator=self.generator).tolist()
+                bucket_batches = [bucket_batches[i] for i in order]
+            batches += bucket_batches
+
+        return batches
+
+    def __iter__(self):
+        batches = self.batches if self.batches is not None else self.plan()
+        self.batches = None
+        yield from batches
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.plan()
+        return len(self.batches)
@@ -0,0 +1,242 @@
+"""
+Out-of-core dataset format. A dataset is written to a directory with one
+binary `.npy` array per property (plus an offsets array for properties that
+have a different length for each geometry) and a JSON index. `MemmapDataset`
+opens these arrays with `numpy.memmap`, so geometries are only read from disk
+when they are requested.
+
+Layout of the directory:
+    index.json              units, number of geometries and how each key is stored
+    <key>.npy               packed data of each property
+    <key>.offsets.npy       CSR offsets of packed properties (shared offsets
+                            are only written once)
+    objects.pt              properties that aren't tensors or strings
+"""
+
+import json
+import os
+from collections.abc import Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset as TorchDataset
+
+from nff.data.dataset import Dataset
+from nff.data.packed import PackedTensorList
+
+INDEX_FILE = "index.json"
+OBJECTS_FILE = "objects.pt"
+FORMAT_VERSION = 1
+
+
+def to_numpy(tensor):
+    """Convert a tensor to a numpy array that can be written with `np.save`."""
+    if tensor.is_sparse:
+        tensor = tensor.to_dense()
+    return tensor.detach().cpu().numpy()
+
+
+def get_packed(val):
+    """
+    Get the packed version of a property, if it can be packed.
+    Args:
+        val: property of the dataset
+    Returns:
+        packed (PackedTensorList or None): packed property
+    """
+
+    if isinstance(val, PackedTensorList):
+        return val
+    if isinstance(val, list) and len(val) > 0 and all(isinstance(x, torch.Tensor) and x.dim() > 0 for x in val):
+        # sparse offsets are densified one at a time, without copying the dataset
+        val = [x.to_dense() if x.is_sparse else x for x in val]
+        if PackedTensorList.can_pack(val):
+            return PackedTensorList.from_list(val)
+    return None
+
+
+def save_memmap(dataset, path):
+    """
+    Write a dataset in the memory-mapped format.
+    Args:
+        dataset (nff.data.Dataset): dataset to write
+        path (str): directory in which to write it
+    Returns:
+        None
+    """
+
+    os.makedirs(path, exist_ok=True)
+    num_geoms = len(dataset)
+    index = {"version": FORMAT_VERSION, "units": dataset.units, "length": num_geoms, "keys": {}}
+    objects = {}
+    written_offsets = {}
+
+    for key, val in dataset.props.items():
+        packed = get_packed(val)
+
+        if packed is not None:
+            offsets = to_numpy(packed.offsets)
+            offsets_key = offsets.tobytes()
+            if offsets_key not in written_offsets:
+                offsets_file = f"{key}.offsets.npy"
+                np.save(os.path.join(path, offsets_file), offsets)
+                written_offsets[offsets_key] = offsets_file
+
+            np.save(os.path.join(path, f"{key}.npy"), to_numpy(packed.data))
+            index["keys"][key] = {
+                "kind": "packed",
+                "file": f"{key}.npy",
+                "offsets": written_offsets[offsets_key],
+            }
+
+        elif isinstance(val, torch.Tensor) and len(val) == num_geoms:
+            np.save(os.path.join(path, f"{key}.npy"), to_numpy(val))
+            index["keys"][key] = {"kind": "tensor", "file": f"{key}.npy"}
+
+        elif isinstance(val, list) and all(isinstance(x, str) for x in val):
+            index["keys"][key] = {"kind": "strings", "values": val}
+
+        else:
+            objects[key] = val
+            index["keys"][key] = {"kind": "object"}
+
+    if objects:
+        torch.save(objects, os.path.join(path, OBJECTS_FILE))
+
+    with open(os.path.join(path, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+
+
+class MemmapColumn(Sequence):
+    """Lazy, read-only view of one property of a `MemmapDataset`. Indexing
+    reads only the requested geometry from disk.
+    """
+
+    def __init__(self, data, offsets=None):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        if self.offsets is not None:
+            return len(self.offsets) - 1
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("MemmapColumn index out of range")
+
+        if self.offsets is None:
+            return torch.from_numpy(np.array(self.data[idx]))
+
+        start, stop = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return torch.from_numpy(np.array(self.data[start:stop]))
+
+
+class MemmapDataset(TorchDataset):
+    """Dataset whose properties live on disk and are paged in with `numpy.memmap`.
+    Items are dictionaries with the same keys and types as those of
+    `nff.data.Dataset`, so they work with `collate_dicts` and the samplers.
+
+    Attributes:
+        path (str): directory of the dataset
+        units (str): units of the energies, forces etc.
+        props (dict): lazy columns (`MemmapColumn`) for array properties, and
+            lists for string or other properties
+    """
+
+    def __init__(self, path, units=None):
+        """
+        Args:
+            path (str): directory written by `save_memmap`
+            units (str, optional): expected units. Conversion of memory-mapped
+                data isn't supported, so this must match the units on disk.
+        """
+
+        with open(os.path.join(path, INDEX_FILE), "r") as f:
+            index = json.load(f)
+
+        if units is not None and units != index["units"]:
+            raise NotImplementedError(
+                f"Dataset at {path} is stored in {index['units']}; convert it before writing it in {units}"
+            )
+
+        self.path = path
+        self.units = index["units"]
+        self.length = index["length"]
+        self.props = {}
+
+        objects = None
+        for key, info in index["keys"].items():
+            kind = info["kind"]
+            if kind == "packed":
+                data = np.load(os.path.join(path, info["file"]), mmap_mode="r")
+                offsets = np.load(os.path.join(path, info["offsets"]), mmap_mode="r")
+                self.props[key] = MemmapColumn(data, offsets)
+            elif kind == "tensor":
+                data = np.load(os.path.join(path, info["file"]), mmap_mode="r")
+                self.props[key] = MemmapColumn(data)
+            elif kind == "strings":
+                self.props[key] = info["values"]
+            else:
+                if objects is None:
+                    objects = torch.load(os.path.join(path, OBJECTS_FILE))
+                self.props[key] = objects[key]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        return {key: val[idx] for key, val in self.props.items()}
+
+    def to_dataset(self, packed=True):
+        """Load the whole dataset into memory.
+
+        Args:
+            packed (bool): whether to return a packed dataset
+
+        Returns:
+            nff.data.Dataset: in-memory dataset
+        """
+        props = {}
+        for key, val in self.props.items():
+            if isinstance(val, MemmapColumn) and val.offsets is not None:
+                data = torch.from_numpy(np.array(val.data))
+                offsets = torch.from_numpy(np.array(val.offsets))
+                props[key] = PackedTensorList(data, offsets)
+            elif isinstance(val, MemmapColumn):
+                props[key] = torch.from_numpy(np.array(val.data))
+            else:
+                props[key] = val
+
+        dataset = Dataset(props, units=self.units, check_props=False)
+        if not packed:
+            dataset.unpack()
+        return dataset
+
+
+def convert_to_memmap(dataset_path, path, units=None):
+    """
+    Convert a dataset saved with `Dataset.save` (e.g. a `.pth.tar` file)
+    to the memory-mapped format.
+    Args:
+        dataset_path (str): path to the saved dataset
+        path (str): output directory
+        units (str, optional): units to convert to before writing
+    Returns:
+        dataset (MemmapDataset): the converted dataset
+    """
+
+    obj = torch.load(dataset_path)
+    if not isinstance(obj, Dataset):
+        raise TypeError(f"{dataset_path} is not an instance of {Dataset}")
+    if units is not None:
+        obj.to_units(units)
+
+    save_memmap(obj, path)
+    return MemmapDataset(path)
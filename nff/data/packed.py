@@ -0,0 +1,190 @@
+"""
+Packed (CSR-like) storage for dataset properties. Instead of a Python list of
+small per-geometry tensors, each property is stored as one concatenated tensor
+plus an offsets array, so that indexing returns views and unit or dtype
+conversions are a single tensor operation.
+"""
+
+from collections.abc import Sequence
+
+import numpy as np
+import torch
+
+
+class PackedTensorList(Sequence):
+    """A list of tensors stored as one concatenated tensor.
+
+    Element `i` is the view `data[offsets[i]:offsets[i + 1]]`. Elements may have
+    different lengths along the first dimension (e.g. per-atom or per-edge
+    quantities), but must agree in all other dimensions and in dtype.
+
+    Attributes:
+        data (torch.Tensor): concatenation of all elements along dim 0
+        offsets (torch.LongTensor): (n + 1,) start of each element in `data`.
+            The same offsets tensor can be shared by several properties with
+            the same segments (e.g. all per-atom properties).
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self._bounds = offsets.tolist()
+
+    @classmethod
+    def from_list(cls, tensors, offsets=None):
+        """Pack a list of tensors.
+
+        Args:
+            tensors (list[torch.Tensor]): tensors with the same trailing
+                dimensions and dtype
+            offsets (torch.LongTensor, optional): precomputed offsets, for
+                sharing between properties with the same segments
+
+        Returns:
+            PackedTensorList: packed version of `tensors`
+        """
+        if offsets is None:
+            lengths = torch.LongTensor([len(tensor) for tensor in tensors])
+            offsets = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(lengths, 0)])
+        data = torch.cat(list(tensors), dim=0)
+
+        return cls(data, offsets)
+
+    @classmethod
+    def cat(cls, items):
+        """Concatenate several packed (or unpacked) lists of tensors.
+
+        Args:
+            items (list): PackedTensorList objects or lists of tensors
+
+        Returns:
+            PackedTensorList: the concatenation
+        """
+        items = [item if isinstance(item, cls) else cls.from_list(item) for item in items]
+        dtype = items[0].data.dtype
+        data = torch.cat([item.data.to(dtype) for item in items], dim=0)
+
+        shifts = np.cumsum([0] + [len(item.data) for item in items])[:-1]
+        offsets = torch.cat(
+            [items[0].offsets[:1]] + [item.offsets[1:] + int(shift) for item, shift in zip(items, shifts)]
+        )
+
+        return cls(data, offsets)
+
+    @staticmethod
+    def can_pack(values):
+        """Whether a list of values can be packed.
+
+        Args:
+            values (list): list of properties
+
+        Returns:
+            bool: True if all values are tensors of at least one dimension
+                with the same trailing dimensions and dtype
+        """
+        if not isinstance(values, list) or len(values) == 0:
+            return False
+        if not all(isinstance(val, torch.Tensor) and not val.is_sparse and val.dim() > 0 for val in values):
+            return False
+
+        first = values[0]
+        return all(val.shape[1:] == first.shape[1:] and val.dtype == first.dtype for val in values)
+
+    @property
+    def lengths(self):
+        """Length of each element along its first dimension."""
+        return self.offsets[1:] - self.offsets[:-1]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def device(self):
+        return self.data.device
+
+    def __len__(self):
+        return len(self._bounds) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)) or (isinstance(idx, torch.Tensor) and idx.dim() == 0):
+            idx = int(idx)
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError("PackedTensorList index out of range")
+            return self.data[self._bounds[idx] : self._bounds[idx + 1]]
+
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                stop = max(stop, start)
+                offsets = self.offsets[start : stop + 1]
+                return self.__class__(self.data[self._bounds[start] : self._bounds[stop]], offsets - offsets[0])
+            idx = range(start, stop, step)
+
+        # gather an arbitrary set of elements
+        idx = torch.as_tensor(np.asarray(idx, dtype=np.int64).reshape(-1))
+        idx = torch.where(idx < 0, idx + len(self), idx)
+
+        starts = self.offsets[idx]
+        counts = self.lengths[idx]
+        first = torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+        pos = torch.repeat_interleave(starts, counts) + torch.arange(int(counts.sum())) - first
+        offsets = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(counts, 0)])
+
+        return self.__class__(self.data[pos.to(self.data.device)], offsets)
+
+    def __setitem__(self, idx, value):
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        start, stop = self._bounds[idx], self._bounds[idx + 1]
+        value = torch.as_tensor(value)
+        if value.shape[0] != stop - start:
+            raise ValueError("Cannot change the length of an element of a PackedTensorList.")
+        self.data[start:stop] = value
+
+    def __iter__(self):
+        for start, stop in zip(self._bounds[:-1], self._bounds[1:]):
+            yield self.data[start:stop]
+
+    def __add__(self, other):
+        return self.__class__.cat([self, other])
+
+    def __mul__(self, other):
+        return self.__class__(self.data * other, self.offsets)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        return self.__class__(self.data / other, self.offsets)
+
+    def __neg__(self):
+        return self.__class__(-self.data, self.offsets)
+
+    def __repr__(self):
+        return f"PackedTensorList(num={len(self)}, data={tuple(self.data.shape)}, dtype={self.data.dtype})"
+
+    def __getstate__(self):
+        return {"data": self.data, "offsets": self.offsets}
+
+    def __setstate__(self, state):
+        self.__init__(state["data"], state["offsets"])
+
+    def to(self, *args, **kwargs):
+        """Apply `torch.Tensor.to` to the packed data."""
+        return self.__class__(self.data.to(*args, **kwargs), self.offsets)
+
+    def float(self):
+        return self.to(torch.float)
+
+    def double(self):
+        return self.to(torch.double)
+
+    def long(self):
+        return self.to(torch.long)
+
+    def to_list(self):
+        """Unpack into a list of tensors. The tensors are views of `data`."""
+        return list(self)
@@ -3,16 +3,25 @@ Tools for applying functions in parallel to the dataset
 """
 
 import copy
+import hashlib
+import itertools
+import os
 from concurrent import futures
 
 import numpy as np
 import torch
+from tqdm import tqdm
 
 from nff.data.features import ATOM_FEAT_TYPES, BOND_FEAT_TYPES, add_e3fp, featurize_atoms, featurize_bonds, make_rd_mols
-from nff.data.graphs import add_bond_idx, kj_ji_to_dset
+from nff.data.graphs import full_angle_idx, get_bond_idx
+from nff.data.packed import PackedTensorList
 from nff.utils import fprint
 
 NUM_PROCS = 5
+CHUNK_SIZE = 256
+
+# inputs of the geometry-wise function, set once in each worker process
+WORKER_STATE = {}
 
 
 def split_dataset(dataset, num):
@@ -45,23 +54,26 @@ def split_dataset(dataset, num):
 def rejoin_props(datasets):
     """
     Rejoin properties from datasets into one dictionary of
-    properties.
+    properties. Each property is concatenated once, without
+    modifying the properties of the smaller datasets.
     Args:
         datasets (list): list of smaller datasets
     Returns:
         new_props (dict): combined properties
     """
-    new_props = {}
+    values = {}
     for dataset in datasets:
         for key, val in dataset.props.items():
-            if key not in new_props:
-                new_props[key] = val
-                continue
+            values.setdefault(key, []).append(val)
 
-            if type(val) is list:
-                new_props[key] += val
-            else:
-                new_props[key] = torch.cat([new_props[key], val], dim=0)
+    new_props = {}
+    for key, vals in values.items():
+        if any(isinstance(val, PackedTensorList) for val in vals):
+            new_props[key] = PackedTensorList.cat(vals)
+        elif type(vals[0]) is list:
+            new_props[key] = list(itertools.chain.from_iterable(vals))
+        else:
+            new_props[key] = torch.cat(vals, dim=0)
 
     return new_props
 
@@ -92,6 +104,209 @@ def gen_parallel(func, kwargs_list):
     return result_dsets
 
 
+def share_inputs(inputs):
+    """
+    Put the inputs of a geometry-wise function in shared memory. Lists of
+    tensors are packed into one tensor, so that they can be shared with the
+    workers without being pickled.
+    Args:
+        inputs (dict): per-geometry properties (lists of tensors, packed lists
+            or tensors whose first dimension indexes the geometries)
+    Returns:
+        shared (dict): the same properties in shared memory
+    """
+
+    shared = {}
+    for key, val in inputs.items():
+        if isinstance(val, list) and PackedTensorList.can_pack(val):
+            val = PackedTensorList.from_list(val)
+        if isinstance(val, PackedTensorList):
+            val = PackedTensorList(val.data.share_memory_(), val.offsets.share_memory_())
+        elif isinstance(val, torch.Tensor):
+            val = val.share_memory_()
+        shared[key] = val
+
+    return shared
+
+
+def init_worker(func, inputs, num_threads=None):
+    # the work is already split between processes
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    WORKER_STATE["func"] = func
+    WORKER_STATE["inputs"] = inputs
+
+
+def map_chunk(start, stop):
+    """
+    Apply the function of this worker to the geometries `start` to `stop`.
+    Returns:
+        outputs (dict): packed output of each key, as (data, lengths)
+    """
+
+    func = WORKER_STATE["func"]
+    inputs = WORKER_STATE["inputs"]
+    results = [func({key: val[i] for key, val in inputs.items()}) for i in range(start, stop)]
+
+    outputs = {}
+    for key in results[0].keys():
+        values = [result[key] for result in results]
+        lengths = torch.LongTensor([len(val) for val in values])
+        outputs[key] = (torch.cat(values, dim=0), lengths)
+
+    return outputs
+
+
+def hash_run(func, inputs):
+    """
+    Hash of a geometry-wise function and its inputs. It's part of the names of
+    the checkpoints of `map_geoms`, so that chunks computed with another
+    function or from other data are never loaded.
+    Args:
+        func (callable): geometry-wise function
+        inputs (dict): per-geometry properties
+    Returns:
+        str: hexadecimal hash
+    """
+
+    hasher = hashlib.blake2b(digest_size=10)
+    name = getattr(func, "__qualname__", None)
+    hasher.update((f"{func.__module__}.{name}" if name is not None else repr(func)).encode())
+
+    for key in sorted(inputs.keys()):
+        val = inputs[key]
+        hasher.update(f"|{key}".encode())
+        # lists and packed lists of the same tensors have the same hash
+        if isinstance(val, list) and PackedTensorList.can_pack(val):
+            val = PackedTensorList.from_list(val)
+        if isinstance(val, PackedTensorList):
+            val = [val.data, val.offsets]
+        elif not isinstance(val, (list, tuple)):
+            val = [val]
+
+        for item in val:
+            if isinstance(item, torch.Tensor):
+                item = item.to_dense() if item.is_sparse else item
+                array = np.ascontiguousarray(item.detach().cpu().numpy())
+                hasher.update(f"{array.dtype.str}{array.shape}".encode())
+                hasher.update(array)
+            else:
+                hasher.update(repr(item).encode())
+
+    return hasher.hexdigest()
+
+
+def load_chunk(path):
+    return torch.load(path, weights_only=True) if os.path.exists(path) else None
+
+
+def save_chunk(outputs, path):
+    # write to a temporary file first, so a chunk is either complete or absent
+    torch.save(outputs, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def map_geoms(func, inputs, num_procs, chunk_size=CHUNK_SIZE, checkpoint_dir=None, track=True):
+    """
+    Apply a function to every geometry in parallel. The inputs are put in
+    shared memory once, so that workers read them without any pickling, and
+    the workers take chunks of `chunk_size` geometries as soon as they're
+    free. The outputs of each chunk are sent back through shared memory and
+    packed into one tensor per key.
+    Args:
+        func (callable): picklable function that takes a dictionary with the
+            inputs of one geometry and returns a dictionary of tensors
+        inputs (dict): per-geometry properties (lists of tensors, packed lists
+            or tensors whose first dimension indexes the geometries)
+        num_procs (int): number of parallel processes
+        chunk_size (int): number of geometries in each chunk of work
+        checkpoint_dir (str, optional): directory in which the outputs of
+            every chunk are saved. Chunks that are already there are loaded
+            instead of computed, so an interrupted run can be resumed. The
+            names of the chunks contain a hash of `func` and `inputs`, so
+            a directory can be shared by different runs.
+        track (bool): whether to show a progress bar
+    Returns:
+        outputs (dict): PackedTensorList of each output key
+    """
+
+    num_geoms = len(next(iter(inputs.values())))
+    bounds = [(start, min(start + chunk_size, num_geoms)) for start in range(0, num_geoms, chunk_size)]
+    chunks = {}
+
+    shared = share_inputs(inputs)
+
+    def get_path(start, stop):
+        return os.path.join(checkpoint_dir, f"chunk_{run_hash}_{start}_{stop}.pt")
+
+    if checkpoint_dir is not None:
+        run_hash = hash_run(func, shared)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        for start, stop in bounds:
+            outputs = load_chunk(get_path(start, stop))
+            if outputs is not None:
+                chunks[start] = outputs
+
+    todo = [(start, stop) for start, stop in bounds if start not in chunks]
+    progress = tqdm(total=len(bounds), initial=len(chunks), disable=not track)
+
+    def finish(start, stop, outputs):
+        if checkpoint_dir is not None:
+            save_chunk(outputs, get_path(start, stop))
+        chunks[start] = outputs
+        progress.update(1)
+
+    if num_procs == 1 or len(todo) <= 1:
+        init_worker(func, shared)
+        for start, stop in todo:
+            finish(start, stop, map_chunk(start, stop))
+        WORKER_STATE.clear()
+
+    else:
+        # with the default fork context the workers inherit the shared inputs,
+        # and otherwise only their shared memory handles are pickled
+        executor = futures.ProcessPoolExecutor(
+            max_workers=num_procs, initializer=init_worker, initargs=(func, shared, 1)
+        )
+        with executor:
+            future_objs = {executor.submit(map_chunk, start, stop): (start, stop) for start, stop in todo}
+            for future in futures.as_completed(future_objs):
+                start, stop = future_objs[future]
+                finish(start, stop, future.result())
+
+    progress.close()
+
+    outputs = {}
+    ordered = [chunks[start] for start, _ in bounds]
+    for key in ordered[0].keys() if ordered else []:
+        data = torch.cat([chunk[key][0] for chunk in ordered], dim=0)
+        lengths = torch.cat([chunk[key][1] for chunk in ordered])
+        offsets = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(lengths, 0)])
+        outputs[key] = PackedTensorList(data, offsets)
+
+    return outputs
+
+
+def set_outputs(dataset, outputs):
+    """
+    Add the outputs of `map_geoms` to a dataset, packed if the dataset is
+    packed and as lists of tensors otherwise.
+    """
+
+    packed = dataset.is_packed
+    for key, val in outputs.items():
+        dataset.props[key] = val if packed else val.to_list()
+
+
+def kj_ji_geom(inputs):
+    ji_idx, kj_idx = full_angle_idx(inputs)
+    return {"ji_idx": ji_idx, "kj_idx": kj_idx}
+
+
+def bond_idx_geom(inputs):
+    return {"bond_idx": get_bond_idx(inputs["bonded_nbr_list"], inputs["nbr_list"])}
+
+
 def rd_parallel(datasets, check_smiles=False):
     """
     Generate RDKit mols for the dataset in parallel.
@@ -166,22 +381,6 @@ def e3fp_parallel(datasets, fp_length):
     return result_dsets
 
 
-def kj_ji_parallel(dsets):
-    kwargs_list = [{"dataset": dataset} for dataset in dsets]
-
-    result_dsets = gen_parallel(func=kj_ji_to_dset, kwargs_list=kwargs_list)
-
-    return result_dsets
-
-
-def bond_idx_parallel(dsets):
-    kwargs_list = [{"dataset": dataset} for dataset in dsets]
-
-    result_dsets = gen_parallel(func=add_bond_idx, kwargs_list=kwargs_list)
-
-    return result_dsets
-
-
 def summarize_rd(new_sets, first_set):
     """
     Summarize how many RDKit mols were successfully made.
@@ -276,19 +475,40 @@ def add_e3fp_parallel(dataset, fp_length, num_procs):
     dataset.props = new_props
 
 
-def add_kj_ji_parallel(dataset, num_procs):
+def add_kj_ji_parallel(dataset, num_procs, chunk_size=CHUNK_SIZE, checkpoint_dir=None):
+    """
+    Add the kj and ji indices to a dataset in parallel.
+    Args:
+         dataset (nff.data.dataset): NFF dataset
+         num_procs (int): number of parallel processes
+         chunk_size (int): number of geometries in each chunk of work
+         checkpoint_dir (str, optional): directory for resuming an interrupted run
+    Returns:
+        None
+    """
     fprint(f"Adding kj and ji indices with {num_procs} " "parallel processes")
 
-    datasets = split_dataset(dataset=dataset, num=num_procs)
-    datasets = kj_ji_parallel(datasets)
-    new_props = rejoin_props(datasets)
-    dataset.props = new_props
+    keys = ["nbr_list", "num_atoms", "mol_size"]
+    inputs = {key: dataset.props[key] for key in keys if key in dataset.props}
+    outputs = map_geoms(kj_ji_geom, inputs, num_procs=num_procs, chunk_size=chunk_size, checkpoint_dir=checkpoint_dir)
+    set_outputs(dataset, outputs)
 
 
-def add_bond_idx_parallel(dataset, num_procs):
+def add_bond_idx_parallel(dataset, num_procs, chunk_size=CHUNK_SIZE, checkpoint_dir=None):
+    """
+    Add the indices of the bonds in the neighbor list to a dataset in parallel.
+    Args:
+         dataset (nff.data.dataset): NFF dataset
+         num_procs (int): number of parallel processes
+         chunk_size (int): number of geometries in each chunk of work
+         checkpoint_dir (str, optional): directory for resuming an interrupted run
+    Returns:
+        None
+    """
     fprint(f"Adding bond indices with {num_procs} " "parallel processes")
 
-    datasets = split_dataset(dataset=dataset, num=num_procs)
-    datasets = bond_idx_parallel(datasets)
-    new_props = rejoin_props(datasets)
-    dataset.props = new_props
+    inputs = {key: dataset.props[key] for key in ["bonded_nbr_list", "nbr_list"]}
+    outputs = map_geoms(
+        bond_idx_geom, inputs, num_procs=num_procs, chunk_size=chunk_size, checkpoint_dir=checkpoint_dir
+    )
+    set_outputs(dataset, outputs)
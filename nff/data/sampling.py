@@ -5,10 +5,9 @@ Tools for balanced sampling of a dataset
 import torch
 from tqdm import tqdm
 
-from nff.data import Dataset
 from nff.train.loss import batch_zhu_p
 from nff.utils import constants as const
-from nff.utils.geom import compute_distances
+from nff.utils.geom import rmsd_matrix
 from nff.utils.misc import cat_props
 
 
@@ -172,13 +171,11 @@ def assign_clusters(ref_idx, spec_nxyz, ref_nxyzs, device, num_clusters, extra_c
     # to each reference nxyz and selecting the one with the smallest
     # distance
 
-    # we'll make datasets so we can use them as input to the torch
-    # parallelized distance computation
+    # the geoms and the reference geoms are stacked so that all their
+    # RMSDs are computed in batches
 
-    # the first is just the set of geom nxyz's
-    props_1 = {"nxyz": [i[ref_idx] for i in spec_nxyz]}
-    # the second is the reference dataset
-    props_0 = {"nxyz": []}
+    spec_xyz = torch.stack([i[ref_idx, 1:] for i in spec_nxyz]).to(device)
+    ref_xyz = []
 
     # use `cluster_idx` to keep track of which reference geoms belong
     # to which cluster, because  one cluster can have many reference
@@ -191,13 +188,12 @@ def assign_clusters(ref_idx, spec_nxyz, ref_nxyzs, device, num_clusters, extra_c
             cluster_idx[i] += cluster_idx[i - 1][-1] + 1
 
         for ref_nxyz in ref_nxyz_lst:
-            props_0["nxyz"].append(ref_nxyz[ref_idx])
+            ref_xyz.append(ref_nxyz[ref_idx, 1:])
 
     # compute the rmsds
-    dset_0 = Dataset(props=props_0)
-    dset_1 = Dataset(props=props_1)
-
-    rmsds, _ = compute_distances(dataset=dset_0, device=device, dataset_1=dset_1)
+    ref_xyz = torch.stack(ref_xyz).to(device=device, dtype=spec_xyz.dtype)
+    rmsds, _ = rmsd_matrix(ref_xyz, spec_xyz)
+    rmsds = rmsds.cpu()
 
     # take the minimum rmsd with respect to the set of reference
     # nxyz's in each cluster. Put infinity if a species is missing a
@@ -29,3 +29,66 @@ def sparsify_array(array):
         sparse (torch.sparse.Tensor)
     """
     return sparsify_tensor(torch.FloatTensor(array))
+
+
+def get_image_shifts(offsets, cell):
+    """Convert Cartesian offsets into the integer multiples of the cell
+    vectors that they're made of.
+
+    Args:
+        offsets (torch.Tensor): E x 3 offsets, dense or sparse
+        cell (torch.Tensor): 3 x 3 cell with the lattice vectors as rows
+
+    returns:
+        image_shifts (torch.Tensor): E x 3 int8 image shifts
+    """
+    if isinstance(offsets, torch.Tensor) and offsets.is_sparse:
+        offsets = offsets.to_dense()
+    cell = torch.as_tensor(cell, dtype=torch.float64).reshape(3, 3)
+    offsets = torch.as_tensor(offsets, dtype=torch.float64).reshape(-1, 3)
+
+    return to_image_shifts(offsets @ torch.linalg.inv(cell))
+
+
+def to_image_shifts(shifts):
+    """Round image shifts and store them as int8, which can't hold shifts
+    of more than 127 cells.
+
+    Args:
+        shifts (torch.Tensor or np.ndarray): E x 3 image shifts
+
+    returns:
+        image_shifts (torch.Tensor): E x 3 int8 image shifts
+    """
+    shifts = torch.round(torch.as_tensor(shifts, dtype=torch.float64)).reshape(-1, 3)
+    if len(shifts) > 0 and shifts.abs().max() > torch.iinfo(torch.int8).max:
+        raise ValueError("Image shifts don't fit in int8")
+
+    return shifts.to(torch.int8)
+
+
+def shifts_to_offsets(image_shifts, cell, nbr_list=None, num_atoms=None):
+    """Cartesian offsets from image shifts and the cell of each structure.
+
+    Args:
+        image_shifts (torch.Tensor): E x 3 integer image shifts
+        cell (torch.Tensor): 3 x 3 cell, or B x 3 x 3 (or 3B x 3) cells of
+            the structures in a batch
+        nbr_list (torch.LongTensor, optional): E x 2 neighbor list. Needed
+            for more than one cell.
+        num_atoms (torch.LongTensor, optional): number of atoms of each
+            structure. Needed for more than one cell.
+
+    returns:
+        offsets (torch.Tensor): E x 3 offsets
+    """
+    cell = cell.reshape(-1, 3, 3)
+    shifts = image_shifts.to(cell.dtype)
+    if len(cell) == 1:
+        return shifts @ cell[0]
+
+    num_atoms = torch.as_tensor(num_atoms, device=cell.device).reshape(-1)
+    mol_idx = torch.repeat_interleave(torch.arange(len(num_atoms), device=cell.device), num_atoms)
+    edge_mol = mol_idx[nbr_list[:, 0].to(cell.device)]
+
+    return torch.einsum("ei,eij->ej", shifts, cell[edge_mol])
@@ -1,17 +1,420 @@
-"""Module to deal with statistics of the datasets, removal of outliers and other statistical functions."""
+"""Module to deal with statistics of the datasets, removal of outliers and other statistical functions.
+
+`DatasetStats` computes the statistics needed to normalize a dataset or to
+initialize a model (moments of the energies and forces, composition
+regressions, neighbor counts and quantiles) in one pass over chunks of the
+dataset. The chunks are collated like batches, so datasets that don't fit in
+memory (`MemmapDataset`, `DatasetView`) and data loaders work the same way.
+"""
 
 import logging
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
+from ase.data import chemical_symbols
 from ase.formula import Formula
-from sklearn import linear_model
 
 from nff.data import Dataset
+from nff.data.loader import collate_dicts
 
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 1024
+SKETCH_SIZE = 2**16
+NUM_ELEMENTS = len(chemical_symbols)
+
+
+class RunningMoments:
+    """Mean, variance and extrema of a stream of values. Chunks are merged
+    with the parallel form of Welford's algorithm, which is numerically
+    stable even if the mean is large compared to the spread.
+
+    Attributes:
+        count (int): number of values
+        mean (float): mean of the values
+        m2 (float): sum of the squared deviations from the mean
+        min (float): smallest value
+        max (float): largest value
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: torch.Tensor) -> None:
+        values = torch.as_tensor(values).detach().reshape(-1).double()
+        if len(values) == 0:
+            return
+
+        mean = values.mean().item()
+        m2 = (values - mean).square().sum().item()
+        self.merge(len(values), mean, m2)
+        self.min = min(self.min, values.min().item())
+        self.max = max(self.max, values.max().item())
+
+    def merge(self, count: int, mean: float, m2: float) -> None:
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+
+    @property
+    def var(self) -> float:
+        """Population variance, as in `np.var`."""
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self) -> float:
+        return self.var**0.5
+
+    @property
+    def rms(self) -> float:
+        return (self.var + self.mean**2) ** 0.5
+
+
+class QuantileSketch:
+    """Uniform random sample of a stream of values, from which quantiles are
+    estimated. Every value gets a random priority and the `size` values with
+    the highest priorities are kept, so chunks of any size can be added. The
+    quantiles are exact while fewer than `size` values have been added, and
+    otherwise have an error of about `1 / sqrt(size)` in rank.
+
+    Attributes:
+        size (int): maximum number of values kept
+        count (int): number of values added
+    """
+
+    def __init__(self, size: int = SKETCH_SIZE, seed: int = 0):
+        self.size = size
+        self.count = 0
+        self.generator = torch.Generator().manual_seed(seed)
+        self.priorities = torch.zeros(0, dtype=torch.double)
+        self.values = torch.zeros(0, dtype=torch.double)
+
+    def update(self, values: torch.Tensor) -> None:
+        values = torch.as_tensor(values).detach().reshape(-1).double().cpu()
+        self.count += len(values)
+        priorities = torch.rand(len(values), generator=self.generator, dtype=torch.double)
+
+        self.values = torch.cat([self.values, values])
+        self.priorities = torch.cat([self.priorities, priorities])
+        if len(self.values) > self.size:
+            keep = torch.topk(self.priorities, self.size).indices
+            self.values = self.values[keep]
+            self.priorities = self.priorities[keep]
+
+    def quantile(self, q: Union[float, List[float]]) -> Union[float, np.ndarray]:
+        """Estimate quantiles of the values.
+
+        Args:
+            q (float or list[float]): quantiles, between 0 and 1
+
+        Returns:
+            float or np.ndarray: the estimated quantiles
+        """
+        return np.quantile(self.values.numpy(), q)
+
+
+def get_chunks(dataset, keys: Iterable[str], chunk_size: int = CHUNK_SIZE):
+    """Collate consecutive chunks of a dataset into batches with only the
+    given keys, so that only one chunk is in memory at a time.
+
+    Args:
+        dataset (nff.data.Dataset, MemmapDataset or DatasetView): dataset
+        keys (list[str]): properties to read. Missing ones are skipped.
+        chunk_size (int): number of geometries per chunk
+
+    Yields:
+        dict: batch of each chunk, as returned by `collate_dicts`
+    """
+    props = dataset.props
+    keys = [key for key in ["nxyz", "num_atoms", *keys] if key in props]
+    keys = list(dict.fromkeys(keys))
+
+    for start in range(0, len(dataset), chunk_size):
+        stop = min(start + chunk_size, len(dataset))
+        yield collate_dicts([{key: props[key][i] for key in keys} for i in range(start, stop)])
+
+
+def get_segment_extremes(values: torch.Tensor, segments: torch.Tensor, num_segments: int) -> torch.Tensor:
+    """Value with the largest magnitude in each segment, with its sign.
+
+    Args:
+        values (torch.Tensor): flat values
+        segments (torch.Tensor): segment of each value
+        num_segments (int): number of segments
+
+    Returns:
+        torch.Tensor: (num_segments,) extreme value of each segment
+    """
+    empty = torch.zeros(num_segments, dtype=values.dtype, device=values.device)
+    max_values = empty.scatter_reduce(0, segments, values, reduce="amax", include_self=False)
+    min_values = empty.scatter_reduce(0, segments, values, reduce="amin", include_self=False)
+    return torch.where(max_values >= -min_values, max_values, min_values)
+
+
+def get_geom_extremes(values: torch.Tensor, num_atoms: torch.Tensor) -> Optional[torch.Tensor]:
+    """Value with the largest magnitude of a per-geometry or per-atom property
+    in each geometry of a batch.
+
+    Args:
+        values (torch.Tensor): batched values, with one row per geometry or per atom
+        num_atoms (torch.Tensor): number of atoms of each geometry
+
+    Returns:
+        torch.Tensor or None: extreme value of each geometry, or None if the
+            property has neither one row per geometry nor one per atom
+    """
+    num_atoms = torch.as_tensor(num_atoms).reshape(-1).long().cpu()
+    num_geoms = len(num_atoms)
+    if len(values) == num_geoms:
+        rows = torch.arange(num_geoms)
+    elif len(values) == int(num_atoms.sum()):
+        rows = torch.repeat_interleave(torch.arange(num_geoms), num_atoms)
+    else:
+        return None
+
+    row_size = values[0].numel() if len(values) > 0 else 1
+    segments = torch.repeat_interleave(rows, row_size)
+    return get_segment_extremes(values.reshape(-1), segments, num_geoms)
+
+
+def solve_least_squares(
+    xtx: np.ndarray, xty: np.ndarray, x_sum: np.ndarray, y_sum: float, count: int, intercept: bool = True
+) -> Tuple[np.ndarray, float]:
+    """Solve a linear least-squares regression from its accumulated normal
+    equations. With an intercept, the equations are centered first, which
+    gives the same minimum-norm solution as `sklearn.linear_model.LinearRegression`
+    when some of the inputs are collinear.
+
+    Args:
+        xtx (np.ndarray): (D, D) sum of the outer products of the inputs
+        xty (np.ndarray): (D,) sum of the inputs times the targets
+        x_sum (np.ndarray): (D,) sum of the inputs
+        y_sum (float): sum of the targets
+        count (int): number of samples
+        intercept (bool): whether to fit an intercept
+
+    Returns:
+        coef (np.ndarray): (D,) coefficients
+        intercept (float): intercept, or 0 if it isn't fitted
+    """
+    if not intercept:
+        return np.linalg.lstsq(xtx, xty, rcond=None)[0], 0.0
+
+    x_mean = x_sum / count
+    y_mean = y_sum / count
+    centered_xtx = xtx - count * np.outer(x_mean, x_mean)
+    centered_xty = xty - count * x_mean * y_mean
+    coef = np.linalg.lstsq(centered_xtx, centered_xty, rcond=None)[0]
+
+    return coef, float(y_mean - x_mean @ coef)
+
+
+class DatasetStats:
+    """Statistics of a dataset accumulated in one pass over batches of it.
+
+    For every geometry, the atom counts of each element (the composition) are
+    accumulated into the normal equations of the regression of the energy on
+    the composition, together with the moments of the energies and of the
+    energies per atom. For each key in `keys`, the moments of all the values
+    and a sketch of the value with the largest magnitude in each geometry
+    (used for outlier removal) are kept. With neighbor lists in the batches,
+    the number of neighbors of the atoms is counted as well.
+
+    Attributes:
+        keys (list[str]): properties whose moments and quantiles are computed
+        energy_key (str): key of the energy
+        num_geoms (int): number of geometries
+        element_counts (np.ndarray): number of atoms of each element
+        moments (dict): `RunningMoments` of each key
+        sketches (dict): `QuantileSketch` of the extreme value of each key in
+            each geometry
+        energy_per_atom (RunningMoments): moments of the energy per atom
+        num_edges (int): number of distinct edges in the neighbor lists
+        num_receivers (int): number of atoms with at least one neighbor
+    """
+
+    def __init__(
+        self,
+        keys: Iterable[str] = ("energy", "energy_grad"),
+        energy_key: str = "energy",
+        sketch_size: int = SKETCH_SIZE,
+        seed: int = 0,
+    ):
+        self.keys = list(keys)
+        self.energy_key = energy_key
+        self.num_geoms = 0
+        self.element_counts = np.zeros(NUM_ELEMENTS, dtype=np.int64)
+
+        self.moments = {key: RunningMoments() for key in self.keys}
+        self.sketches = {key: QuantileSketch(sketch_size, seed=seed) for key in self.keys}
+        self.energy_per_atom = RunningMoments()
+
+        # normal equations of the regression of the energy on the composition
+        self.xtx = np.zeros((NUM_ELEMENTS, NUM_ELEMENTS))
+        self.xty = np.zeros(NUM_ELEMENTS)
+        self.x_sum = np.zeros(NUM_ELEMENTS)
+        self.y_sum = 0.0
+        self.num_energies = 0
+
+        # mean of the composition divided by the number of atoms
+        self.x_per_atom_sum = np.zeros(NUM_ELEMENTS)
+
+        self.num_edges = 0
+        self.num_receivers = 0
+
+    @classmethod
+    def from_dataset(cls, dataset, chunk_size: int = CHUNK_SIZE, **kwargs) -> "DatasetStats":
+        """Compute the statistics of a dataset.
+
+        Args:
+            dataset (nff.data.Dataset, MemmapDataset or DatasetView): dataset
+            chunk_size (int): number of geometries read at a time
+            **kwargs: arguments of `DatasetStats`
+
+        Returns:
+            DatasetStats: the statistics
+        """
+        stats = cls(**kwargs)
+        for batch in get_chunks(dataset, [*stats.keys, stats.energy_key, "nbr_list"], chunk_size=chunk_size):
+            stats.update(batch)
+        return stats
+
+    @classmethod
+    def from_loader(cls, data_loader: Iterable[dict], **kwargs) -> "DatasetStats":
+        """Compute the statistics of the batches of a data loader.
+
+        Args:
+            data_loader (iterable): batches collated with `collate_dicts`
+            **kwargs: arguments of `DatasetStats`
+
+        Returns:
+            DatasetStats: the statistics
+        """
+        stats = cls(**kwargs)
+        for batch in data_loader:
+            stats.update(batch)
+        return stats
+
+    def update(self, batch: dict) -> None:
+        """Add a batch of geometries to the statistics.
+
+        Args:
+            batch (dict): batch collated with `collate_dicts`
+        """
+        num_atoms = torch.as_tensor(batch["num_atoms"]).reshape(-1).long().cpu()
+        num_geoms = len(num_atoms)
+        mol_idx = torch.repeat_interleave(torch.arange(num_geoms), num_atoms)
+
+        zs = batch["nxyz"][:, 0].detach().long().cpu()
+        composition = torch.zeros(num_geoms, NUM_ELEMENTS, dtype=torch.double)
+        composition.index_put_((mol_idx, zs), torch.ones(len(zs), dtype=torch.double), accumulate=True)
+        composition = composition.numpy()
+
+        self.num_geoms += num_geoms
+        self.element_counts += composition.sum(0).astype(np.int64)
+
+        for key in self.keys:
+            if key not in batch:
+                continue
+            values = torch.as_tensor(batch[key]).detach().cpu().double()
+            self.moments[key].update(values)
+            extremes = get_geom_extremes(values, num_atoms)
+            if extremes is not None:
+                self.sketches[key].update(extremes)
+
+        if self.energy_key in batch:
+            energies = torch.as_tensor(batch[self.energy_key]).detach().cpu().double().reshape(-1).numpy()
+            self.xtx += composition.T @ composition
+            self.xty += composition.T @ energies
+            self.x_sum += composition.sum(0)
+            self.y_sum += energies.sum()
+            self.num_energies += len(energies)
+
+            per_atom = num_atoms.double().numpy()
+            self.energy_per_atom.update(torch.from_numpy(energies / per_atom))
+            self.x_per_atom_sum += (composition / per_atom[:, None]).sum(0)
+
+        if "nbr_list" in batch:
+            nbr_list = torch.unique(batch["nbr_list"].detach().cpu(), dim=0)
+            counts = torch.bincount(nbr_list[:, 1], minlength=len(zs))
+            self.num_edges += int(counts.sum())
+            self.num_receivers += int((counts > 0).sum())
+
+    @property
+    def elements(self) -> List[int]:
+        """Atomic numbers of the elements in the dataset."""
+        return np.flatnonzero(self.element_counts).tolist()
+
+    @property
+    def avg_num_neighbors(self) -> float:
+        """Average number of neighbors of the atoms that have neighbors."""
+        return self.num_edges / self.num_receivers if self.num_receivers else np.nan
+
+    def mean(self, key: str) -> float:
+        return self.moments[key].mean
+
+    def std(self, key: str) -> float:
+        return self.moments[key].std
+
+    def rms(self, key: str) -> float:
+        return self.moments[key].rms
+
+    def quantile(self, key: str, q: Union[float, List[float]]) -> Union[float, np.ndarray]:
+        """Estimate quantiles of the value with the largest magnitude of
+        `key` in each geometry, e.g. to choose a cutoff for outliers.
+        """
+        return self.sketches[key].quantile(q)
+
+    def fit_composition(
+        self, elements: Optional[Iterable[int]] = None, intercept: bool = True
+    ) -> Tuple[Dict[int, float], float]:
+        """Fit the energy as a sum of per-element energies, from the
+        accumulated normal equations.
+
+        Args:
+            elements (list[int], optional): atomic numbers to fit. Defaults to
+                the elements in the dataset.
+            intercept (bool): whether to fit a constant offset
+
+        Returns:
+            coefs (dict): energy of each element
+            intercept (float): constant offset, or 0 if it isn't fitted
+        """
+        elements = self.elements if elements is None else list(elements)
+        idx = np.array(elements, dtype=np.int64)
+        coef, offset = solve_least_squares(
+            self.xtx[np.ix_(idx, idx)],
+            self.xty[idx],
+            self.x_sum[idx],
+            self.y_sum,
+            self.num_energies,
+            intercept=intercept,
+        )
+        return dict(zip(elements, coef.tolist())), offset
+
+    def mean_atomic_energy(self, atomic_energies: Dict[int, float]) -> float:
+        """Mean over geometries of the energy per atom after subtracting the
+        given energy of each element. It's linear in the energies, so it's
+        computed from the accumulated sums for any `atomic_energies`.
+
+        Args:
+            atomic_energies (dict): energy of each atomic number
+
+        Returns:
+            float: the mean
+        """
+        reference = np.zeros(NUM_ELEMENTS)
+        for z, energy in atomic_energies.items():
+            reference[z] = energy
+        return self.energy_per_atom.mean - (self.x_per_atom_sum @ reference) / self.num_energies
+
 
 def remove_outliers(
     array: Union[List, np.ndarray, torch.Tensor],
@@ -74,6 +477,7 @@ def remove_dataset_outliers(
     reference_std: Optional[float] = None,
     std_away: float = 3.0,
     max_value: float = np.inf,
+    chunk_size: int = CHUNK_SIZE,
 ) -> Tuple[Dataset, float, float]:
     """Remove outliers from given dataset using both a number of standard
         deviations and a hard cutoff.
@@ -91,21 +495,27 @@ def remove_dataset_outliers(
         max_value (float): cutoff for the values of array. Values higher than
             this cutoff will be considered outliers and thus removed from the
             array.
+        chunk_size (int): number of geometries read at a time
 
     Returns:
         new_dset (nff.data.Dataset): new dataset with the bad data removed.
     """
-    array = dset.props[reference_key]
-    if isinstance(array, torch.Tensor):
-        array = array.cpu().numpy()
+    # moments and the extreme value of each geometry, in one pass over chunks
+    moments = RunningMoments()
+    extremes = []
+    for batch in get_chunks(dset, [reference_key], chunk_size=chunk_size):
+        values = torch.as_tensor(batch[reference_key]).detach().cpu().double()
+        moments.update(values)
+        extremes.append(get_geom_extremes(values, batch["num_atoms"]))
+    max_values = torch.cat(extremes).numpy()
+
+    mean = reference_mean if reference_mean else moments.mean
+    std = reference_std if reference_std else moments.std
+    non_outlier = np.bitwise_and(np.abs(max_values - mean) < std_away * std, max_values < max_value)
+
+    idx = np.arange(len(dset))[non_outlier]
+    logging.info("removed %d outliers", len(dset) - len(idx))
 
-    _, idx, mean, std = remove_outliers(
-        array,
-        std_away=std_away,
-        reference_mean=reference_mean,
-        reference_std=reference_std,
-        max_value=max_value,
-    )
     new_props = {key: [val[i] for i in idx] for key, val in dset.props.items()}
     logging.info("reference_mean: %s", mean)
     logging.info("reference_std: %s", std)
@@ -205,35 +615,39 @@ def get_stoich_dict(dset: Dataset, formula_key: str = "formula", energy_key: str
     logging.debug("formulas: %s", formulas)
     logging.debug("energies: %s", energies)
 
-    unique_formulas = list(set(formulas))
+    # Find the ground state energy for each formula/stoichiometry in one pass.
+    ground_en_dict = {}
+    for formula, energy in zip(formulas, energies):
+        energy = float(energy)
+        if formula not in ground_en_dict or energy < ground_en_dict[formula]:
+            ground_en_dict[formula] = energy
+
+    unique_formulas = list(ground_en_dict.keys())
+    ground_en = list(ground_en_dict.values())
     logging.debug("unique formulas: %s", unique_formulas)
-    # Find the ground state energy for each formula/stoichiometry.
-    ground_en = [
-        min([energies[i] for i in range(len(formulas)) if formulas[i] == formula]) for formula in unique_formulas
-    ]
-    unique_atoms = all_atoms(unique_formulas)
+    unique_atoms = list(all_atoms(unique_formulas))
 
     logging.debug("ground_en: %s", ground_en)
     logging.debug("unique atoms: %s", unique_atoms)
 
-    x_in = np.stack([reg_atom_count(formula, unique_atoms) for formula in unique_formulas])
+    x_in = np.stack([reg_atom_count(formula, unique_atoms) for formula in unique_formulas]).astype(float)
     y_out = np.array(ground_en)
 
     logging.debug("x_in: %s", x_in)
     logging.debug("y_out: %s", y_out)
 
-    clf = linear_model.LinearRegression()
-    clf.fit(x_in, y_out)
+    coef, intercept = solve_least_squares(x_in.T @ x_in, x_in.T @ y_out, x_in.sum(0), y_out.sum(), len(y_out))
 
-    pred = (clf.coef_ * x_in).sum(-1) + clf.intercept_
-    logging.info("coef: %s", clf.coef_)
-    logging.info("intercept: %s", clf.intercept_)
+    pred = x_in @ coef + intercept
+    logging.info("coef: %s", coef)
+    logging.info("intercept: %s", intercept)
     logging.debug("pred: %s", pred)
     err = abs(pred - y_out).mean()  # in kcal/mol
     logging.info("MAE between target energy and stoich energy is %.3f kcal/mol", err)
-    logging.info("R : %s", clf.score(x_in, y_out))
-    fit_dic = dict(zip(unique_atoms, clf.coef_.reshape(-1)))
-    stoich_dict = {**fit_dic, "offset": clf.intercept_.item()}
+    total = np.square(y_out - y_out.mean()).sum()
+    logging.info("R : %s", 1 - np.square(pred - y_out).sum() / total if total > 0 else np.nan)
+    fit_dic = dict(zip(unique_atoms, coef.reshape(-1)))
+    stoich_dict = {**fit_dic, "offset": intercept}
     logging.info(stoich_dict)
 
     return stoich_dict
@@ -260,16 +674,17 @@ def perform_energy_offset(
     formulas = dset.props[formula_key]
     energies = dset.props[energy_key]
 
-    new_energies = energies.clone() if isinstance(energies, torch.Tensor) else energies.copy()
-
-    for i, formula in enumerate(formulas):
+    # the reference energy only depends on the formula
+    ref_dict = {}
+    for formula in set(formulas):
         dictio = get_atom_count(formula)
-        ref_en = 0
-        for ele, num in dictio.items():
-            ref_en += num * stoic_dict[ele]
-        ref_en += stoic_dict["offset"]
+        ref_dict[formula] = sum(num * stoic_dict[ele] for ele, num in dictio.items()) + stoic_dict["offset"]
+    ref_en = [ref_dict[formula] for formula in formulas]
 
-        new_energies[i] -= ref_en
+    if isinstance(energies, torch.Tensor):
+        new_energies = energies - torch.tensor(ref_en, dtype=torch.double).to(energies).reshape(energies.shape)
+    else:
+        new_energies = [energy - ref for energy, ref in zip(energies, ref_en)]
 
     logging.info("new_energies: %s", new_energies)
     new_dset = dset.copy()
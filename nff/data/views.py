@@ -0,0 +1,227 @@
+"""
+Lightweight views of datasets. A `DatasetView` is the union of several
+datasets, or a subset of their geometries, that shares their storage instead
+of copying it. Only the index arrays that map each item of the view to a
+geometry of one of the underlying datasets are new, so splitting and merging
+take O(1) memory in the size of the data. The properties are only copied when
+the view is materialized with `to_dataset`, e.g. when it's saved.
+
+Views of views are flattened, so that indexing a view always reads directly
+from the underlying datasets.
+"""
+
+from collections.abc import Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset as TorchDataset
+
+from nff.data.dataset import Dataset
+from nff.data.packed import PackedTensorList
+
+
+class ViewColumn(Sequence):
+    """Lazy, read-only view of one property over several datasets.
+
+    Attributes:
+        columns (list): the property in each underlying dataset
+        source (np.ndarray): underlying dataset of each item
+        index (np.ndarray): index of each item in its dataset
+    """
+
+    def __init__(self, columns, source, index):
+        self.columns = columns
+        self.source = source
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("ViewColumn index out of range")
+
+        return self.columns[self.source[idx]][int(self.index[idx])]
+
+    def __iter__(self):
+        for source, index in zip(self.source.tolist(), self.index.tolist()):
+            yield self.columns[source][index]
+
+    def gather(self, values):
+        """Put values computed for every item of each underlying column in the
+        order of the view.
+
+        Args:
+            values (list): tensor or `PackedTensorList` for each column, with
+                one entry per item of that column
+
+        Returns:
+            torch.Tensor or PackedTensorList: one entry per item of the view
+        """
+        if len(self) == 0:
+            return values[0][:0]
+
+        sources = [int(source) for source in np.unique(self.source)]
+        positions = [np.flatnonzero(self.source == source) for source in sources]
+        pieces = [values[source][torch.as_tensor(self.index[pos])] for source, pos in zip(sources, positions)]
+
+        if isinstance(pieces[0], PackedTensorList):
+            gathered = PackedTensorList.cat(pieces)
+        else:
+            gathered = torch.cat([piece.to(pieces[0].dtype) for piece in pieces])
+
+        # the pieces are grouped by dataset, so restore the order of the view
+        order = np.concatenate(positions)
+        if np.array_equal(order, np.arange(len(order))):
+            return gathered
+        return gathered[torch.as_tensor(np.argsort(order))]
+
+    def materialize(self):
+        """Copy the items of the view into a new property. Packed and tensor
+        properties are gathered with one operation per underlying dataset,
+        and other properties become lists.
+
+        Returns:
+            PackedTensorList, torch.Tensor or list: the property
+        """
+        if len(self) == 0:
+            return []
+        if all(isinstance(column, PackedTensorList) for column in self.columns):
+            return self.gather(self.columns)
+        if all(isinstance(column, torch.Tensor) for column in self.columns):
+            return self.gather(self.columns)
+        return list(self)
+
+
+class DatasetView(TorchDataset):
+    """Union of several datasets, or of a subset of their geometries, that
+    shares their storage. Items are dictionaries with the keys that all the
+    datasets have, so views work with `collate_dicts` and the samplers.
+
+    Attributes:
+        datasets (list): underlying datasets (`nff.data.Dataset`,
+            `MemmapDataset` or any dataset with `props`)
+        source (np.ndarray): underlying dataset of each item
+        index (np.ndarray): index of each item in its dataset
+        keys (list[str]): properties of the items
+        units (str): units of the energies, forces etc.
+    """
+
+    def __init__(self, datasets, idx=None):
+        """
+        Args:
+            datasets (list): datasets to join. Views are flattened into the
+                datasets they're built on.
+            idx (list[int] or np.ndarray, optional): indices of the union that
+                are in the view, in the order in which they're given. Defaults
+                to all the items.
+        """
+
+        self.datasets = []
+        sources = []
+        indices = []
+        for dataset in datasets:
+            if isinstance(dataset, DatasetView):
+                sources.append(dataset.source + len(self.datasets))
+                indices.append(dataset.index)
+                self.datasets += dataset.datasets
+            else:
+                sources.append(np.full(len(dataset), len(self.datasets), dtype=np.int64))
+                indices.append(np.arange(len(dataset), dtype=np.int64))
+                self.datasets.append(dataset)
+
+        self.source = np.concatenate(sources) if sources else np.zeros(0, dtype=np.int64)
+        self.index = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        if idx is not None:
+            idx = np.asarray(idx, dtype=np.int64).reshape(-1)
+            self.source = self.source[idx]
+            self.index = self.index[idx]
+
+        units = {dataset.units for dataset in self.datasets}
+        if len(units) > 1:
+            raise NotImplementedError(
+                f"Datasets in different units ({', '.join(sorted(units))}) can't share a view; "
+                "convert them with `to_units` first"
+            )
+        self.units = units.pop() if units else None
+
+        # like `Dataset.__add__`, only keep the properties that all datasets have
+        self.keys = list(self.datasets[0].props.keys()) if self.datasets else []
+        for dataset in self.datasets[1:]:
+            self.keys = [key for key in self.keys if key in dataset.props]
+
+    @property
+    def props(self):
+        """Lazy columns (`ViewColumn`) of the properties of the view."""
+        return {
+            key: ViewColumn([dataset.props[key] for dataset in self.datasets], self.source, self.index)
+            for key in self.keys
+        }
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        dataset = self.datasets[self.source[idx]]
+        props = dataset.props
+        idx = int(self.index[idx])
+        return {key: props[key][idx] for key in self.keys}
+
+    def __add__(self, other):
+        return DatasetView([self, other])
+
+    def subset(self, idx):
+        """View of some of the items of this view.
+
+        Args:
+            idx (list[int] or np.ndarray): indices of the items
+
+        Returns:
+            DatasetView: the subset
+        """
+        return DatasetView([self], idx)
+
+    def to_dataset(self):
+        """Copy the items of the view into a new dataset. Properties that are
+        lists in the underlying datasets aren't deep-copied, so the new
+        dataset shares their tensors.
+
+        Returns:
+            nff.data.Dataset: the materialized dataset
+        """
+        props = {key: column.materialize() for key, column in self.props.items()}
+        return Dataset(props, units=self.units, check_props=False, device=getattr(self.datasets[0], "device", "cpu"))
+
+    def save(self, path):
+        """Materialize the view and save it with `Dataset.save`.
+
+        Args:
+            path (str): path of the file
+        """
+        self.to_dataset().save(path)
+
+    def save_memmap(self, path):
+        """Materialize the view and save it in the memory-mapped format.
+
+        Args:
+            path (str): directory where you want to save the dataset
+        """
+        self.to_dataset().save_memmap(path)
+
+
+def concatenate_datasets(*datasets):
+    """
+    Join datasets without copying their properties.
+    Args:
+        *datasets: datasets or views to join
+    Returns:
+        DatasetView: view of all the items of the datasets
+    """
+
+    return DatasetView(list(datasets))
@@ -0,0 +1,282 @@
+"""
+Append-only logs of arrays, e.g. embeddings or ensemble predictions written
+at every MD step.
+
+A log is an ordinary `.npy` file whose header has a fixed size. Appending
+writes the new rows at the end of the file and rewrites the shape in the
+header, so the cost of a step doesn't grow with the length of the trajectory.
+Rows are buffered and written in chunks by a background thread, and the file
+can be read at any time with `np.load(path, mmap_mode="r")` (or
+`load_array_log`), which gives the whole series as one memory-mapped array.
+
+Logs are shared by path through `open_array_log`, and all open logs are
+flushed when the interpreter exits.
+"""
+
+import atexit
+import os
+import queue
+import threading
+
+import numpy as np
+
+HEADER_SIZE = 256
+MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def make_header(dtype, shape):
+    """
+    Make a version 1.0 `.npy` header of `HEADER_SIZE` bytes, so that it can be
+    rewritten in place when the shape changes.
+    Args:
+        dtype (np.dtype): dtype of the array
+        shape (tuple): shape of the array
+    Returns:
+        header (bytes): header
+    """
+
+    text = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), tuple(shape))
+    length = HEADER_SIZE - len(MAGIC) - 2
+    if len(text) + 1 > length:
+        raise ValueError(f"Shape {shape} doesn't fit in the header of an array log")
+
+    text = text.ljust(length - 1) + "\n"
+    return MAGIC + np.uint16(length).astype("<u2").tobytes() + text.encode("latin1")
+
+
+def read_header(path):
+    """
+    Read the header of a `.npy` file.
+    Args:
+        path (str): path of the file
+    Returns:
+        shape (tuple): shape of the array
+        dtype (np.dtype): dtype of the array
+        fortran_order (bool): whether the array is in Fortran order
+        offset (int): number of bytes before the data
+    """
+
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return shape, dtype, fortran_order, offset
+
+
+def load_array_log(path, mmap_mode="r"):
+    """
+    Load everything that has been written to an array log.
+    Args:
+        path (str): path of the log
+        mmap_mode (str, optional): mode for memory-mapping the file. Use
+            None to read it into memory.
+    Returns:
+        log (np.ndarray): logged rows, stacked along the first axis
+    """
+
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+class ArrayLog:
+    """Append-only `.npy` file of rows with the same shape and dtype.
+
+    Attributes:
+        path (str): path of the file
+        chunk_size (int): number of rows that are buffered before they're written
+        asynchronous (bool): whether chunks are written by a background thread
+        dtype (np.dtype): dtype of the rows, set by the first row
+        item_shape (tuple): shape of each row, set by the first row
+        num_rows (int): number of rows appended, including the ones that
+            haven't been written yet
+        num_written (int): number of rows in the file
+    """
+
+    def __init__(self, path, chunk_size=16, asynchronous=True):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.asynchronous = asynchronous
+
+        self.dtype = None
+        self.item_shape = None
+        self.num_rows = 0
+        self.num_written = 0
+        self.buffer = []
+        self.num_buffered = 0
+
+        self.lock = threading.Lock()
+        self.chunks = None
+        self.writer = None
+        self.error = None
+
+        if os.path.exists(path):
+            self.open_existing()
+
+    def open_existing(self):
+        """Take over an existing `.npy` file, rewriting it once if its header
+        can't be updated in place."""
+
+        shape, dtype, fortran_order, offset = read_header(self.path)
+        if len(shape) == 0:
+            raise ValueError(f"Can't append to the 0-dimensional array in {self.path}")
+
+        if fortran_order or offset != HEADER_SIZE:
+            array = np.ascontiguousarray(np.load(self.path))
+            with open(self.path, "wb") as f:
+                f.write(make_header(array.dtype, array.shape))
+                f.write(array.tobytes())
+
+        self.dtype = dtype
+        self.item_shape = tuple(shape[1:])
+        self.num_written = shape[0]
+        self.num_rows = shape[0]
+
+    def __len__(self):
+        return self.num_rows
+
+    def check(self, rows):
+        if self.dtype is None:
+            self.dtype = rows.dtype
+            self.item_shape = rows.shape[1:]
+
+        if rows.shape[1:] != self.item_shape:
+            raise ValueError(
+                f"Can't append rows of shape {rows.shape[1:]} to {self.path}, whose rows have shape {self.item_shape}"
+            )
+
+        return np.ascontiguousarray(rows, dtype=self.dtype)
+
+    def append(self, rows):
+        """
+        Append rows to the log.
+        Args:
+            rows (np.ndarray): array whose first axis indexes the rows
+        """
+
+        rows = self.check(np.asarray(rows))
+        self.buffer.append(rows)
+        self.num_buffered += len(rows)
+        self.num_rows += len(rows)
+        if self.num_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self, wait=False):
+        """
+        Write the buffered rows.
+        Args:
+            wait (bool): whether to wait until the rows are on disk
+        """
+
+        if self.buffer:
+            chunk = np.concatenate(self.buffer)
+            self.buffer = []
+            self.num_buffered = 0
+
+            if self.asynchronous:
+                self.start_writer()
+                self.chunks.put(chunk)
+            else:
+                self.write(chunk)
+
+        if wait and self.chunks is not None:
+            self.chunks.join()
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def start_writer(self):
+        if self.writer is not None:
+            return
+        self.chunks = queue.Queue()
+        self.writer = threading.Thread(target=self.work, daemon=True)
+        self.writer.start()
+
+    def work(self):
+        while True:
+            chunk = self.chunks.get()
+            try:
+                if chunk is None:
+                    return
+                self.write(chunk)
+            except Exception as err:
+                self.error = err
+            finally:
+                self.chunks.task_done()
+
+    def write(self, chunk):
+        """Write a chunk at the end of the file, and then update the header so
+        that readers never see rows that aren't complete."""
+
+        with self.lock:
+            num_rows = self.num_written + len(chunk)
+            header = make_header(self.dtype, (num_rows, *self.item_shape))
+            if not os.path.exists(self.path):
+                with open(self.path, "wb") as f:
+                    f.write(make_header(self.dtype, (0, *self.item_shape)))
+
+            with open(self.path, "r+b") as f:
+                f.seek(HEADER_SIZE + self.num_written * chunk[0].nbytes)
+                f.write(chunk.tobytes())
+                f.flush()
+                f.seek(0)
+                f.write(header)
+
+            self.num_written = num_rows
+
+    def close(self):
+        """Write the buffered rows and stop the background thread."""
+
+        self.flush()
+        if self.writer is not None:
+            self.chunks.put(None)
+            self.writer.join()
+            self.writer = None
+            self.chunks = None
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def read(self, mmap_mode="r"):
+        self.flush(wait=True)
+        return load_array_log(self.path, mmap_mode=mmap_mode)
+
+
+OPEN_LOGS = {}
+OPEN_LOGS_LOCK = threading.Lock()
+
+
+def open_array_log(path, **kwargs):
+    """
+    Get the open log of a file, or open a new one. Calculators that are
+    copied or unpickled during a simulation then keep appending to the same log.
+    Args:
+        path (str): path of the log
+        **kwargs: keyword arguments for `ArrayLog`
+    Returns:
+        log (ArrayLog): log
+    """
+
+    key = os.path.abspath(path)
+    with OPEN_LOGS_LOCK:
+        if key not in OPEN_LOGS:
+            OPEN_LOGS[key] = ArrayLog(path, **kwargs)
+        return OPEN_LOGS[key]
+
+
+def close_array_logs():
+    """Flush and close all logs opened with `open_array_log`."""
+
+    with OPEN_LOGS_LOCK:
+        logs = list(OPEN_LOGS.values())
+        OPEN_LOGS.clear()
+
+    for log in logs:
+        log.close()
+
+
+atexit.register(close_array_logs)
@@ -9,7 +9,7 @@ from ase.neighborlist import neighbor_list
 from typing_extensions import Self
 
 import nff.utils.constants as const
-from nff.data.sparse import sparsify_array
+from nff.data.sparse import shifts_to_offsets, sparsify_array, to_image_shifts
 from nff.nn.graphop import split_and_sum
 from nff.nn.utils import clean_matrix, lattice_points_in_supercell, torch_nbr_list
 
@@ -42,7 +42,9 @@ class AtomsBatch(Atoms):
         cutoff (TYPE, optional): Description
         cutoff_skin (float): extra distance added to cutoff
                         to ensure we don't miss neighbors between nbr
-                        list updates.
+                        list updates. The neighbor list is only rebuilt
+                        when an atom has moved more than half the skin
+                        or the cell has changed too much (see `requires_nbr_update`).
         **kwargs: Description
         """
         super().__init__(*args, **kwargs)
@@ -53,6 +55,10 @@ class AtomsBatch(Atoms):
         self.props = props
         self.nbr_list = props.get("nbr_list", None)
         self.offsets = props.get("offsets", None)
+        # integer image shifts of the periodic neighbor list, and the cell
+        # of the Cartesian `offsets` computed from them
+        self.image_shifts = props.get("image_shifts", None)
+        self.offsets_cell = None
         self.directed = directed
         self.num_atoms = props.get("num_atoms", torch.LongTensor([len(self)])).reshape(-1)
         self.props["num_atoms"] = self.num_atoms
@@ -60,6 +66,9 @@ class AtomsBatch(Atoms):
         self.cutoff_skin = cutoff_skin
         self.device = device
         self.requires_large_offsets = requires_large_offsets
+        # positions and cell at the last neighbor list build
+        self.nbr_ref_positions = None
+        self.nbr_ref_cell = None
         if dense_nbrs:
             self.mol_nbrs, self.mol_idx = self.get_mol_nbrs()
         else:
@@ -242,9 +251,15 @@ class AtomsBatch(Atoms):
         """
         if self.nbr_list is None or self.offsets is None:
             self.update_nbr_list()
+        elif self.nbr_ref_positions is None:
+            # neighbor list was given through `props`, so take the
+            # current geometry as its reference
+            self.set_nbr_reference()
+        else:
+            self.update_nbr_list_if_needed()
 
         self.props["nbr_list"] = self.nbr_list
-        self.props["offsets"] = self.offsets
+        self.props["offsets"] = self.update_offsets()
         if self.pbc.any():
             self.props["cell"] = torch.Tensor(np.array(self.cell))
             self.props["lattice"] = self.cell.tolist()
@@ -332,6 +347,7 @@ class AtomsBatch(Atoms):
 
         ensemble_nbr_list = []
         ensemble_offsets_list = []
+        ensemble_shifts_list = []
 
         for i, atoms in enumerate(Atoms_list):
             edge_from, edge_to, offsets = torch_nbr_list(
@@ -351,6 +367,7 @@ class AtomsBatch(Atoms):
 
             ensemble_nbr_list.append(self.props["num_atoms"][:i].sum() + nbr_list)
             ensemble_offsets_list.append(these_offsets)
+            ensemble_shifts_list.append(to_image_shifts(offsets))
 
         ensemble_nbr_list = torch.cat(ensemble_nbr_list)
 
@@ -361,9 +378,90 @@ class AtomsBatch(Atoms):
 
         self.nbr_list = ensemble_nbr_list
         self.offsets = ensemble_offsets_list
+        self.image_shifts = torch.cat(ensemble_shifts_list) if self.pbc.any() else None
+        self.offsets_cell = np.array(self.get_cell())
+        self.set_nbr_reference()
 
         return ensemble_nbr_list, ensemble_offsets_list
 
+    def update_offsets(self):
+        """Recompute the Cartesian offsets from the image shifts if the cell has
+        changed since they were computed, e.g. in NPT simulations. The neighbor
+        list itself stays valid, because it's stored in multiples of the
+        cell vectors.
+
+        Returns:
+            torch.Tensor: offsets for the current cell
+        """
+        if self.image_shifts is None or self.offsets_cell is None:
+            return self.offsets
+
+        cell = np.array(self.get_cell())
+        if not np.array_equal(cell, self.offsets_cell):
+            self.offsets = shifts_to_offsets(self.image_shifts, torch.Tensor(cell))
+            self.offsets_cell = cell
+
+        return self.offsets
+
+    def set_nbr_reference(self):
+        """Record the positions and cell for which the current neighbor
+        list was built.
+        """
+        self.nbr_ref_positions = self.get_positions().copy()
+        self.nbr_ref_cell = np.array(self.get_cell())
+
+    def requires_nbr_update(self):
+        """Whether the neighbor list has to be rebuilt. Since the list is built
+        with `cutoff + cutoff_skin`, it is still exact until some atom has moved
+        by more than half the skin. A change of the number of atoms also
+        requires a rebuild.
+
+        Periodic neighbor lists are stored as image shifts, so they follow
+        changes of the cell. The displacement of the periodic images is then
+        counted against the skin as well. Without image shifts, any change of
+        the cell requires a rebuild.
+
+        Returns:
+            bool: True if the neighbor list is missing or out of date.
+        """
+        if self.nbr_list is None or self.offsets is None or self.nbr_ref_positions is None:
+            return True
+
+        if len(self) != len(self.nbr_ref_positions):
+            return True
+
+        displacement = np.linalg.norm(self.get_positions() - self.nbr_ref_positions, axis=-1).max(initial=0)
+        cell_change = np.array(self.get_cell()) - self.nbr_ref_cell
+        if np.allclose(cell_change, 0, rtol=0, atol=1e-10):
+            return displacement > 0.5 * self.cutoff_skin
+
+        if self.image_shifts is None:
+            return True
+
+        # bound on the displacement of any image that could enter the cutoff
+        max_shift = int(self.image_shifts.abs().max()) if len(self.image_shifts) > 0 else 0
+        image_displacement = (max_shift + 1) * np.linalg.norm(cell_change, axis=-1).sum()
+
+        return 2 * displacement + image_displacement > self.cutoff_skin
+
+    def update_nbr_list_if_needed(self, update_atoms=False):
+        """Rebuild the neighbor list only if `requires_nbr_update` says so.
+
+        Args:
+            update_atoms (bool, optional): Whether to update the number of atoms in the system.
+                Defaults to False.
+
+        Returns:
+            tuple: A tuple containing the neighbor list and offsets.
+        """
+        if update_atoms:
+            self.update_num_atoms()
+
+        if self.requires_nbr_update():
+            return self.update_nbr_list()
+
+        return self.nbr_list, self.offsets
+
     def get_embedding(self):
         """Get the embedding of the molecule.
 
@@ -8,6 +8,7 @@ given geometry. Both calculators are used to perform molecular dynamics simulati
 and geometry optimizations using NFF AtomsBatch objects.
 """
 
+import math
 import os
 import sys
 from collections import Counter
@@ -21,8 +22,9 @@ from ase.stress import full_3x3_to_voigt_6_stress
 from torch.autograd import grad
 
 import nff.utils.constants as const
-from nff.data import Dataset, collate_dicts
+from nff.io.array_log import open_array_log
 from nff.io.ase import DEFAULT_DIRECTED, AtomsBatch
+from nff.nn.ensemble import EnsembleExecutor
 from nff.nn.models.cp3d import OnlyBondUpdateCP3D
 from nff.nn.models.hybridgraph import HybridGraphConv
 from nff.nn.models.mace import NffScaleMACE
@@ -31,8 +33,8 @@ from nff.nn.models.schnet_features import SchNetFeatures
 from nff.train.builders.model import load_model
 from nff.utils.constants import EV_TO_KCAL_MOL, HARTREE_TO_KCAL_MOL
 from nff.utils.cuda import batch_detach, batch_to
-from nff.utils.geom import batch_compute_distance, compute_distances
-from nff.utils.scatter import compute_grad
+from nff.utils.geom import RMSDReferences
+from nff.utils.scatter import inference_mode
 
 HARTREE_TO_EV = HARTREE_TO_KCAL_MOL / EV_TO_KCAL_MOL
 
@@ -92,22 +94,66 @@ class NeuralFF(Calculator):
         self.device = device
         self.model.to(device)
 
+    def get_model_kwargs(self):
+        kwargs = {}
+        if "embedding" in self.properties:
+            kwargs["requires_embedding"] = True
+        if "stress" in self.properties:
+            kwargs["requires_stress"] = True
+        kwargs["grimme_disp"] = False
+        if getattr(self, "model_kwargs", None) is not None:
+            kwargs.update(self.model_kwargs)
+
+        return kwargs
+
+    def predict(self, batch):
+        """Energies and forces of a batch that is already on the device of the model.
+        Unlike `calculate`, the results stay tensors on that device and aren't
+        stored, which lets integrators call the model without going through ASE.
+
+        Args:
+            batch (dict): batch of data
+
+        Returns:
+            energy (torch.Tensor): energy of each structure in the prediction units
+            forces (torch.Tensor): forces in the prediction units
+        """
+        grad_key = self.en_key + "_grad"
+        batch[self.en_key] = []
+        batch[grad_key] = []
+
+        kwargs = self.get_model_kwargs()
+        kwargs.pop("requires_stress", None)
+        kwargs.pop("requires_embedding", None)
+        with inference_mode():
+            prediction = self.model(batch, **kwargs)
+
+        conversion_factor = const.conversion_factors.get((self.model_units, self.prediction_units), const.DEFAULT)
+        energy_factor = math.prod(val for key, val in conversion_factor.items() if key in self.en_key)
+        grad_factor = math.prod(val for key, val in conversion_factor.items() if key in grad_key)
+
+        energy = prediction[self.en_key].detach().reshape(-1) * energy_factor
+        if "/atom" in self.model_units:
+            energy = energy * batch["num_atoms"].to(energy.device)
+
+        if grad_key in prediction:
+            forces = -prediction[grad_key].detach().reshape(-1, 3) * grad_factor
+        else:
+            forces = prediction["forces"].detach().reshape(-1, 3)
+
+        if "e_disp" in prediction:
+            energy = energy + torch.as_tensor(prediction["e_disp"], device=energy.device).reshape(-1)
+        if "forces_disp" in prediction:
+            forces = forces + torch.as_tensor(prediction["forces_disp"], device=forces.device).reshape(-1, 3)
+
+        return energy, forces
+
     def log_embedding(self, jobdir, log_filename, props):
         """For the purposes of logging the NN embedding on-the-fly, to help with
         sampling after calling NFF on geometries."""
 
-        log_file = os.path.join(jobdir, log_filename)
-        # ruff: noqa: SIM108
-        if os.path.exists(log_file):
-            log = np.load(log_file)
-        else:
-            log = None
-        if log is not None:
-            log = np.append(log, props[None, :, :, :], axis=0)
-        else:
-            log = props[None, :, :, :]
-
-        np.save(log_filename, log)
+        log = open_array_log(os.path.join(jobdir, log_filename))
+        log.append(props[None, :, :, :])
 
     def calculate(
         self,
@@ -146,18 +192,12 @@ class NeuralFF(Calculator):
         batch[self.en_key] = []
         batch[grad_key] = []
 
-        kwargs = {}
         requires_stress = "stress" in self.properties
         requires_embedding = "embedding" in self.properties
-        if requires_embedding:
-            kwargs["requires_embedding"] = True
-        if requires_stress:
-            kwargs["requires_stress"] = True
-        kwargs["grimme_disp"] = False
-        if getattr(self, "model_kwargs", None) is not None:
-            kwargs.update(self.model_kwargs)
+        kwargs = self.get_model_kwargs()
 
-        prediction = self.model(batch, **kwargs)
+        with inference_mode():
+            prediction = self.model(batch, **kwargs)
         # print(prediction.keys())
 
         # change energy and force to numpy array
@@ -247,6 +287,7 @@ class EnsembleNFF(Calculator):
         model_kwargs=None,
         model_units="kcal/mol",
         prediction_units="eV",
+        vectorized=True,
         **kwargs,
     ):
         """Creates a NeuralFF calculator.nff/io/ase.py
@@ -254,6 +295,8 @@ class EnsembleNFF(Calculator):
         Args:
         model(TYPE): Description
         device(str): device on which the calculations will be performed
+        vectorized(bool): whether to evaluate the members together with
+            `torch.func.vmap` when they share an architecture
         **kwargs: Description
         model(one of nff.nn.models)
 
@@ -263,6 +306,7 @@ class EnsembleNFF(Calculator):
         self.models = models
         for m in self.models:
             m.eval()
+        self.executor = EnsembleExecutor(self.models, vectorized=vectorized)
         self.device = device
         self.to(device)
         self.jobdir = jobdir
@@ -275,8 +319,7 @@ class EnsembleNFF(Calculator):
 
     def to(self, device):
         self.device = device
-        for m in self.models:
-            m.to(device)
+        self.executor.to(device)
 
     def offset_energy(self, atoms, energy: Union[float, np.ndarray]):
         """Offset the NFF energy to obtain the correct reference energy
@@ -306,20 +349,8 @@ class EnsembleNFF(Calculator):
 
         props = np.swapaxes(np.expand_dims(props, axis=-1), 0, -1)
 
-        log_file = os.path.join(jobdir, log_filename)
-        if os.path.exists(log_file):
-            log = np.load(log_file)
-        else:
-            log = None
-
-        if log is not None:
-            log = np.concatenate([log, props], axis=0)
-        else:
-            log = props
-
-        np.save(log_filename, log)
-
-        return
+        log = open_array_log(os.path.join(jobdir, log_filename))
+        log.append(props)
 
     def calculate(
         self,
@@ -351,8 +382,8 @@ class EnsembleNFF(Calculator):
         # run model
         # atomsbatch = AtomsBatch(atoms)
         # batch_to(atomsbatch.get_batch(), self.device)
-        # TODO update atoms only when necessary
-        atoms.update_nbr_list(update_atoms=True)
+        # only rebuilds once an atom has moved by more than half the skin
+        atoms.update_nbr_list_if_needed(update_atoms=True)
 
         kwargs = {}
         requires_stress = "stress" in self.properties
@@ -376,26 +407,12 @@ class EnsembleNFF(Calculator):
         gradients = []
         stresses = []
 
-        # do this in parallel, using the version here: https://pytorch.org/functorch/1.13/notebooks/ensembling.html
-
-        # fmodel, params, buffers = combine_state_for_ensemble(self.models)
-        # predictions_vmap = vmap(fmodel, in_dims=(0, 0, None))(params, buffers, batch)
-
-        # Construct a "stateless" version of one of the models. It is "stateless" in
-        # the sense that the parameters are meta Tensors and do not have storage.
-        # self.base_model = copy.deepcopy(self.models[0])
-        # self.base_model = self.base_model.to('meta')
-        # def fmodel(params, buffers, x):
-        #     return functional_call(self.base_model, (params, buffers), (x,))
-
-        # predictions_vmap = vmap(fmodel, in_dims=(0, 0, None))(params, buffers, batch)
-
-        # do this in parallel
-
-        for model in self.models:
-            # TODO can export to function and merge with NeuralFF class
-            prediction = model(batch, **kwargs)
+        # all members are evaluated together in one vectorized forward and
+        # backward pass when possible (see `nff.nn.ensemble.EnsembleExecutor`)
+        with inference_mode():
+            predictions = self.executor.members(batch, **kwargs)
 
+        for prediction in predictions:
             # change energy and force to numpy array
             conversion_factor: dict = const.conversion_factors.get(
                 (self.model_units, self.prediction_units), const.DEFAULT
@@ -484,7 +501,7 @@ class NeuralOptimizer:
 
         for _ in range(epochs):
             self.optimizer.run(fmax=fmax, steps=self.update_freq)
-            self.optimizer.atoms.update_nbr_list()
+            self.optimizer.atoms.update_nbr_list_if_needed()
 
 
 class NeuralMetadynamics(NeuralFF):
@@ -515,6 +532,9 @@ class NeuralMetadynamics(NeuralFF):
         self.exclude_atoms = torch.LongTensor(self.pushing_params.get("exclude_atoms", []))
         self.keep_idx = None
 
+        # centered reference geometries, built from `old_atoms` when they're first needed
+        self.references = None
+
     def get_keep_idx(self, atoms):
         # correct for atoms not in the biasing potential
 
@@ -526,17 +546,29 @@ class NeuralMetadynamics(NeuralFF):
         self.keep_idx = keep_idx
         return keep_idx
 
-    def make_dsets(self, atoms):
-        keep_idx = self.get_keep_idx(atoms)
-        # put the current atoms as the second dataset because that's the one
-        # that gets its positions rotated and its gradient computed
-        props_1 = {"nxyz": [torch.Tensor(atoms.get_nxyz())[keep_idx, :]]}
-        props_0 = {"nxyz": [torch.Tensor(old_atoms.get_nxyz())[keep_idx, :] for old_atoms in self.old_atoms]}
+    def get_max_ref(self):
+        max_ref = self.pushing_params.get("max_ref_structures")
+        if max_ref is None:
+            max_ref = 10
+        return max_ref
+
+    def get_ref_mol_idx(self, atoms, keep_idx):
+        return torch.zeros(len(keep_idx), dtype=torch.long)
 
-        dset_0 = Dataset(props_0, do_copy=False)
-        dset_1 = Dataset(props_1, do_copy=False)
+    def get_references(self, atoms):
+        if self.references is not None:
+            return self.references
 
-        return dset_0, dset_1
+        # note - this is done on CPU. It's a small RMSD and gradient calculation,
+        # so the dominant time is data transfer to GPU. Testing it out confirms
+        # that you get a big slowdown from doing it on GPU
+        keep_idx = self.get_keep_idx(atoms)
+        mol_idx = self.get_ref_mol_idx(atoms=atoms, keep_idx=keep_idx)
+        self.references = RMSDReferences(mol_idx=mol_idx, max_refs=self.get_max_ref(), device="cpu")
+        for old_atoms in self.old_atoms:
+            self.references.append(old_atoms.get_positions()[keep_idx])
+
+        return self.references
 
     def rmsd_prelims(self, atoms):
         num_atoms = len(atoms)
@@ -555,41 +587,26 @@ class NeuralMetadynamics(NeuralFF):
         # given in Bohr^(-2) in CREST paper
         alpha_i = self.pushing_params["alpha_i"] / units.Bohr**2
 
-        dsets = self.make_dsets(atoms)
-
-        return k_i, alpha_i, dsets, f_damp
+        return k_i, alpha_i, f_damp
 
     def rmsd_push(self, atoms):
         if not self.old_atoms:
             return np.zeros((len(atoms), 3)), 0.0
 
-        k_i, alpha_i, dsets, f_damp = self.rmsd_prelims(atoms)
-
-        delta_i, _, xyz_list = compute_distances(
-            dataset=dsets[0],
-            # do this on CPU - it's a small RMSD
-            # and gradient calculation, so the
-            # dominant time is data transfer to GPU.
-            # Testing it out confirms that you get a
-            # big slowdown from doing it on GPU
-            device="cpu",
-            # device=self.device,
-            dataset_1=dsets[1],
-            store_grad=True,
-            collate_dicts=collate_dicts,
-        )
+        k_i, alpha_i, f_damp = self.rmsd_prelims(atoms)
+        references = self.get_references(atoms)
+        keep_idx = self.get_keep_idx(atoms)
 
-        v_bias = (f_damp * k_i * torch.exp(-alpha_i * delta_i.reshape(-1) ** 2)).sum()
+        # one gaussian for each reference and molecule
+        heights = f_damp[-len(references) :].reshape(-1, 1) * torch.as_tensor(k_i).reshape(1, -1)
+        v_bias, f_bias = references.gaussian_bias(
+            xyz=atoms.get_positions()[keep_idx], heights=heights.double(), alpha=alpha_i
+        )
 
-        f_bias = -compute_grad(inputs=xyz_list[0], output=v_bias).sum(0)
+        final_f_bias = np.zeros((len(atoms), 3))
+        final_f_bias[keep_idx] = f_bias.numpy()
 
-        keep_idx = self.get_keep_idx(atoms)
-        final_f_bias = torch.zeros(len(atoms), 3)
-        final_f_bias[keep_idx] = f_bias.detach().cpu()
-        nan_idx = torch.bitwise_not(torch.isfinite(final_f_bias))
-        final_f_bias[nan_idx] = 0
-
-        return final_f_bias.detach().numpy(), v_bias.detach().numpy()
+        return final_f_bias, v_bias.sum().numpy()
 
     def get_bias(self, atoms):
         bias_type = self.pushing_params["bias_type"]
@@ -603,11 +620,10 @@ class NeuralMetadynamics(NeuralFF):
     def append_atoms(self, atoms):
         self.old_atoms.append(atoms)
         self.steps_from_old.append(0)
+        if self.references is not None:
+            self.references.append(atoms.get_positions()[self.keep_idx])
 
-        max_ref = self.pushing_params.get("max_ref_structures")
-        if max_ref is None:
-            max_ref = 10
-
+        max_ref = self.get_max_ref()
         if len(self.old_atoms) >= max_ref:
             self.old_atoms = self.old_atoms[-max_ref:]
             self.steps_from_old = self.steps_from_old[-max_ref:]
@@ -658,7 +674,6 @@ class BatchNeuralMetadynamics(NeuralMetadynamics):
             **kwargs,
         )
 
-        self.query_nxyz = None
         self.mol_idx = None
 
     def rmsd_prelims(self, atoms):
@@ -680,89 +695,32 @@ class BatchNeuralMetadynamics(NeuralMetadynamics):
 
         return k_i, alpha_i, f_damp
 
-    def get_query_nxyz(self, keep_idx):
-        if self.query_nxyz is not None:
-            return self.query_nxyz
-
-        query_nxyz = torch.stack([torch.Tensor(old_atoms.get_nxyz())[keep_idx, :] for old_atoms in self.old_atoms])
-        self.query_nxyz = query_nxyz
-
-        return query_nxyz
-
-    def append_atoms(self, atoms):
-        super().append_atoms(atoms)
-        self.query_nxyz = None
-
-    def make_nxyz(self, atoms):
-        keep_idx = self.get_keep_idx(atoms)
-        ref_nxyz = torch.Tensor(atoms.get_nxyz())[keep_idx, :]
-        query_nxyz = self.get_query_nxyz(keep_idx)
-
-        return ref_nxyz, query_nxyz, keep_idx
-
     def get_mol_idx(self, atoms, keep_idx):
         if self.mol_idx is not None:
             assert self.mol_idx.max() + 1 == len(atoms.num_atoms)
             return self.mol_idx
 
         num_atoms = atoms.num_atoms
-        counter = 0
-
-        mol_idx = []
-
-        for i, num in enumerate(num_atoms):
-            mol_idx.append(torch.ones(num).long() * i)
-            counter += num
-
-        mol_idx = torch.cat(mol_idx)[keep_idx]
+        mol_idx = torch.arange(len(num_atoms)).repeat_interleave(torch.as_tensor(num_atoms).long())
+        mol_idx = mol_idx[keep_idx]
         self.mol_idx = mol_idx
 
         return mol_idx
 
-    def get_num_atoms_tensor(self, mol_idx, atoms):
-        num_atoms = torch.LongTensor([(mol_idx == i).nonzero().shape[0] for i in range(len(atoms.num_atoms))])
-
-        return num_atoms
-
-    def get_v_f_bias(self, rmsd, ref_xyz, k_i, alpha_i, f_damp):
-        v_bias = (f_damp.reshape(-1, 1) * k_i * torch.exp(-alpha_i * rmsd**2)).sum()
-
-        f_bias = -compute_grad(inputs=ref_xyz, output=v_bias)
-
-        output = [v_bias.reshape(-1).detach().cpu(), f_bias.detach().cpu()]
-
-        return output
+    def get_ref_mol_idx(self, atoms, keep_idx):
+        return self.get_mol_idx(atoms=atoms, keep_idx=keep_idx)
 
     def rmsd_push(self, atoms):
         if not self.old_atoms:
             return np.zeros((len(atoms), 3)), np.zeros(len(atoms.num_atoms))
 
-        k_i, alpha_i, f_damp = self.rmsd_prelims(atoms)
-
-        ref_nxyz, query_nxyz, keep_idx = self.make_nxyz(atoms=atoms)
-        mol_idx = self.get_mol_idx(atoms=atoms, keep_idx=keep_idx)
-        num_atoms_tensor = self.get_num_atoms_tensor(mol_idx=mol_idx, atoms=atoms)
-
         # note - everything is done on CPU, which is much faster than GPU. E.g. for
         # 30 molecules in a batch, each around 70 atoms, it's 4 times faster to do
         # this on CPU than GPU
 
-        rmsd, ref_xyz = batch_compute_distance(
-            ref_nxyz=ref_nxyz,
-            query_nxyz=query_nxyz,
-            mol_idx=mol_idx,
-            num_atoms_tensor=num_atoms_tensor,
-            store_grad=True,
-        )
-
-        v_bias, f_bias = self.get_v_f_bias(rmsd=rmsd, ref_xyz=ref_xyz, k_i=k_i, alpha_i=alpha_i, f_damp=f_damp)
-
-        final_f_bias = torch.zeros(len(atoms), 3)
-        final_f_bias[keep_idx] = f_bias
-        nan_idx = torch.bitwise_not(torch.isfinite(final_f_bias))
-        final_f_bias[nan_idx] = 0
+        final_f_bias, v_bias = super().rmsd_push(atoms)
 
-        return final_f_bias.numpy(), v_bias.numpy()
+        return final_f_bias, v_bias.reshape(-1)
 
 
 class NeuralGAMD(NeuralFF):
@@ -1183,7 +1141,8 @@ class NeuralRestraint(Calculator):
         requires_stress = "stress" in self.properties
         if requires_stress:
             kwargs["requires_stress"] = True
-        prediction = self.model(batch, **kwargs)
+        with inference_mode():
+            prediction = self.model(batch, **kwargs)
 
         # change energy and force to kcal/mol
         energy = prediction[self.en_key] * (1 / const.EV_TO_KCAL_MOL)
@@ -17,6 +17,7 @@ DEFAULT_CUTOFF = 5.0
 DEFAULT_DIRECTED = False
 DEFAULT_SKIN = 1.0
 UNDIRECTED = [SchNet, SchNetDiabat, HybridGraphConv, SchNetFeatures, OnlyBondUpdateCP3D]
+HILL_BUFFER_SIZE = 1024
 
 
 class BiasBase(NeuralFF):
@@ -130,6 +131,7 @@ class BiasBase(NeuralFF):
         pass
 
     def _check_boundaries(self, xi: np.ndarray):
+        xi = xi.reshape(-1)
         in_bounds = (xi <= self.ranges[:, 1]).all() and (xi >= self.ranges[:, 0]).all()
         return in_bounds
 
@@ -157,6 +159,23 @@ class BiasBase(NeuralFF):
 
         return diff
 
+    def diff_cvs(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """get difference of the values of all CVs at once, wrapping the angles
+        Args:
+            a: array whose first axis indexes the CVs
+            b: array whose first axis indexes the CVs
+        Returns:
+            diff: element-wise difference (a-b)
+        """
+        diff = np.asarray(a - b, dtype=float)
+        is_angle = np.array([cv_def["type"] == "angle" for cv_def in self.cv_defs])
+        is_angle = is_angle.reshape(-1, *([1] * (diff.ndim - 1)))
+
+        diff = np.where(is_angle & (diff > np.pi), diff - 2 * np.pi, diff)
+        diff = np.where(is_angle & (diff < -np.pi), diff + 2 * np.pi, diff)
+
+        return diff
+
     def step_bias(
         self,
         xi: np.ndarray,
@@ -472,32 +491,43 @@ class eABF(BiasBase):
         Returns:
             bin_x (list):
         """
-        bin_x = np.zeros(shape=xi.shape, dtype=np.int64)
-        for i in range(self.num_cv):
-            bin_x[i] = int(np.floor(np.abs(xi[i] - self.ranges[i, 0]) / self.ext_binwidth[i]))
-        return tuple(bin_x.reshape(1, -1)[0])
+        bin_x = np.floor(np.abs(xi.reshape(-1) - self.ranges[:, 0]) / self.ext_binwidth.reshape(-1))
+        return tuple(bin_x.astype(np.int64))
 
-    def _update_bias(self, xi: np.ndarray):
-        if self._check_boundaries(self.ext_coords):
-            bink = self.get_index(self.ext_coords)
-            self.ext_hist[bink] += 1
+    def _update_abf(self, xi: np.ndarray) -> Tuple[tuple, float]:
+        """update the running average of the force on the extended system
+        in the current bin, for all CVs at once
+        Args:
+            xi: current value of the CVs
+        Returns:
+            bink: index of the bin
+            ramp: factor with which the average force is applied
+        """
+        bink = self.get_index(self.ext_coords)
+        self.ext_hist[bink] += 1
+
+        # linear ramp function
+        ramp = 1.0 if self.ext_hist[bink] > self.nfull else self.ext_hist[bink] / self.nfull
+
+        cv_bink = (slice(None), *bink)
+        (
+            self.bias[cv_bink],
+            self.m2_force[cv_bink],
+            self.var_force[cv_bink],
+        ) = welford_var(
+            self.ext_hist[bink],
+            self.bias[cv_bink],
+            self.m2_force[cv_bink],
+            self.ext_k * self.diff_cvs(xi, self.ext_coords).reshape(-1),
+        )
 
-            # linear ramp function
-            ramp = 1.0 if self.ext_hist[bink] > self.nfull else self.ext_hist[bink] / self.nfull
+        return bink, ramp
 
-            for i in range(self.num_cv):
-                # apply bias force on extended system
-                (
-                    self.bias[i][bink],
-                    self.m2_force[i][bink],
-                    self.var_force[i][bink],
-                ) = welford_var(
-                    self.ext_hist[bink],
-                    self.bias[i][bink],
-                    self.m2_force[i][bink],
-                    self.ext_k[i] * self.diff(xi[i], self.ext_coords[i], self.cv_defs[i]["type"]),
-                )
-                self.ext_forces[i] -= ramp * self.bias[i][bink]
+    def _update_bias(self, xi: np.ndarray):
+        if self._check_boundaries(self.ext_coords):
+            bink, ramp = self._update_abf(xi)
+            # apply bias force on extended system
+            self.ext_forces -= ramp * self.bias[(slice(None), *bink)].reshape(-1, 1)
 
         """
         Not sure how this can be dumped/printed to work with the rest
@@ -834,7 +864,12 @@ class WTMeABF(eABF):
         self.hill_var = np.zeros(shape=(self.num_cv))
         self.well_tempered_temp = well_tempered_temp
         self.call_count = 0
-        self.center = []
+
+        # centers and heights of the deposited hills, in arrays that double
+        # in size when they're full
+        self.num_hills = 0
+        self.hill_centers = np.zeros(shape=(HILL_BUFFER_SIZE, self.num_cv))
+        self.hill_heights = np.zeros(shape=(HILL_BUFFER_SIZE,))
 
         for ii, cv in enumerate(self.cv_defs):
             if "hill_std" in cv:
@@ -847,30 +882,33 @@ class WTMeABF(eABF):
         self.metapot = np.zeros_like(self.histogram)
         self.metaforce = np.zeros_like(self.bias)
 
+    @property
+    def center(self) -> np.ndarray:
+        """centers of the deposited hills"""
+        return self.hill_centers[: self.num_hills]
+
     def _update_bias(self, xi: np.ndarray):
         mtd_forces = self.get_wtm_force(self.ext_coords)
         self.call_count += 1
 
         if self._check_boundaries(self.ext_coords):
-            bink = self.get_index(self.ext_coords)
-            self.ext_hist[bink] += 1
+            bink, ramp = self._update_abf(xi)
+            # apply bias force on extended system
+            self.ext_forces -= ramp * self.bias[(slice(None), *bink)].reshape(-1, 1) + mtd_forces.reshape(-1, 1)
 
-            # linear ramp function
-            ramp = 1.0 if self.ext_hist[bink] > self.nfull else self.ext_hist[bink] / self.nfull
+    def add_hill(self, center: np.ndarray, height: float):
+        """store a new hill, growing the buffers if they're full
+        Args:
+            center: state of collective variable at which the hill is deposited
+            height: height of the hill after well-tempered scaling
+        """
+        if self.num_hills == len(self.hill_heights):
+            self.hill_centers = np.concatenate([self.hill_centers, np.zeros_like(self.hill_centers)])
+            self.hill_heights = np.concatenate([self.hill_heights, np.zeros_like(self.hill_heights)])
 
-            for i in range(self.num_cv):
-                # apply bias force on extended system
-                (
-                    self.bias[i][bink],
-                    self.m2_force[i][bink],
-                    self.var_force[i][bink],
-                ) = welford_var(
-                    self.ext_hist[bink],
-                    self.bias[i][bink],
-                    self.m2_force[i][bink],
-                    self.ext_k[i] * self.diff(xi[i], self.ext_coords[i], self.cv_defs[i]["type"]),
-                )
-                self.ext_forces[i] -= ramp * self.bias[i][bink] + mtd_forces[i]
+        self.hill_centers[self.num_hills] = center.reshape(-1)
+        self.hill_heights[self.num_hills] = height
+        self.num_hills += 1
 
     def get_wtm_force(self, xi: np.ndarray) -> np.ndarray:
         """compute well-tempered metadynamics bias force from superposition of gaussian hills
@@ -880,21 +918,16 @@ class WTMeABF(eABF):
             bias_force: bias force from metadynamics
         """
 
-        is_in_bounds = self._check_boundaries(xi)
-
-        if (self.call_count % self.hill_drop_freq == 0) and is_in_bounds:
-            self.center.append(np.copy(xi.reshape(-1)))
-
-        if is_in_bounds and self.num_cv == 1:
+        if self._check_boundaries(xi):
             bias_force, _ = self._accumulate_wtm_force(xi)
         else:
             bias_force, _ = self._analytic_wtm_force(xi)
 
         return bias_force
 
-    def _accumulate_wtm_force(self, xi: np.ndarray) -> Tuple[list, float]:
-        """compute numerical WTM bias force from a grid
-        Right now this works only for 1D CVs
+    def _accumulate_wtm_force(self, xi: np.ndarray) -> Tuple[np.ndarray, float]:
+        """compute numerical WTM bias force from a grid, on which new hills are
+        accumulated, so that the cost of a step doesn't depend on the number of hills
         Args:
             xi: state of collective variable
         Returns:
@@ -904,17 +937,25 @@ class WTMeABF(eABF):
         bink = self.get_index(xi)
         if self.call_count % self.hill_drop_freq == 0:
             w = self.hill_height * np.exp(-self.metapot[bink] / (units.kB * self.well_tempered_temp))
+            self.add_hill(xi, w)
+
+            # the hill is a product of 1D gaussians, one for each CV
+            epot = w
+            dxs = []
+            for i in range(self.num_cv):
+                shape = [1] * self.num_cv
+                shape[i] = -1
+                dx = self.diff(self.grid[i], xi[i], self.cv_defs[i]["type"]).reshape(shape)
+                epot = epot * np.exp(-(dx * dx) / (2.0 * self.hill_var[i]))
+                dxs.append(dx)
 
-            dx = self.diff(self.grid[0], xi[0], self.cv_defs[0]["type"]).reshape(
-                -1,
-            )
-            epot = w * np.exp(-(dx * dx) / (2.0 * self.hill_var[0]))
             self.metapot += epot
-            self.metaforce[0] -= epot * dx / self.hill_var[0]
+            for i, dx in enumerate(dxs):
+                self.metaforce[i] -= epot * dx / self.hill_var[i]
 
-        return self.metaforce[:, bink], self.metapot[bink]
+        return self.metaforce[(slice(None), *bink)].reshape(-1, 1), self.metapot[bink]
 
-    def _analytic_wtm_force(self, xi: np.ndarray) -> Tuple[list, float]:
+    def _analytic_wtm_force(self, xi: np.ndarray) -> Tuple[np.ndarray, float]:
         """compute analytic WTM bias force from sum of gaussians hills
         Args:
             xi: state of collective variable
@@ -922,35 +963,26 @@ class WTMeABF(eABF):
             bias_force: bias force from metadynamics
         """
 
-        local_pot = 0.0
-        bias_force = np.zeros(shape=(self.num_cv))
+        bias_force = np.zeros(shape=(self.num_cv, 1))
 
         # this should never be the case!
-        if len(self.center) == 0:
+        if self.num_hills == 0:
             print(" >>> Warning: no metadynamics hills stored")
-            return bias_force
-
-        ind = np.ma.indices((len(self.center),))[0]
-        ind = np.ma.masked_array(ind)
+            return bias_force, 0.0
 
-        dist_to_centers = np.array(
-            [self.diff(xi[ii], np.asarray(self.center)[:, ii], self.cv_defs[ii]["type"]) for ii in range(self.num_cv)]
-        )
-
-        if self.num_cv > 1:
-            ind[(abs(dist_to_centers) > 3 * self.hill_std.reshape(-1, 1)).all(axis=0)] = np.ma.masked
-        else:
-            ind[(abs(dist_to_centers) > 3 * self.hill_std.reshape(-1, 1)).all(axis=0)] = np.ma.masked
+        dist_to_centers = self.diff_cvs(xi.reshape(-1, 1), self.center.T)
 
-        # can get slow in long run, so only iterate over significant elements
-        for i in np.nditer(ind.compressed(), flags=["zerosize_ok"]):
-            w = self.hill_height * np.exp(-local_pot / (units.kB * self.well_tempered_temp))
+        # only hills within 3 standard deviations contribute
+        near = ~(abs(dist_to_centers) > 3 * self.hill_std.reshape(-1, 1)).all(axis=0)
+        dist_to_centers = dist_to_centers[:, near]
 
-            epot = w * np.exp(-np.power(dist_to_centers[:, i] / self.hill_std, 2).sum() / 2.0)
-            local_pot += epot
-            bias_force -= epot * dist_to_centers[:, i] / self.hill_var
+        epot = self.hill_heights[: self.num_hills][near] * np.exp(
+            -np.power(dist_to_centers / self.hill_std.reshape(-1, 1), 2).sum(0) / 2.0
+        )
+        local_pot = epot.sum()
+        bias_force -= (epot * dist_to_centers / self.hill_var.reshape(-1, 1)).sum(1, keepdims=True)
 
-        return bias_force.reshape(-1, 1), local_pot
+        return bias_force, local_pot
 
 
 class AttractiveBias(NeuralFF):
@@ -1262,7 +1294,8 @@ class AttractiveBias(NeuralFF):
 
 
 def welford_var(count: float, mean: float, M2: float, newValue: float) -> Tuple[float, float, float]:
-    """On-the-fly estimate of sample variance by Welford's online algorithm
+    """On-the-fly estimate of sample variance by Welford's online algorithm.
+    The mean, M2 and new sample can also be arrays, e.g. with one element per CV.
     Args:
         count: current number of samples (with new one)
         mean: current mean
@@ -1274,8 +1307,8 @@ def welford_var(count: float, mean: float, M2: float, newValue: float) -> Tuple[
         var: sample variance
     """
     delta = newValue - mean
-    mean += delta / count
+    mean = mean + delta / count
     delta2 = newValue - mean
-    M2 += delta * delta2
+    M2 = M2 + delta * delta2
     var = M2 / count if count > 2 else 0.0
     return mean, M2, var
@@ -1,15 +1,23 @@
 """Convert NFF Dataset to CHGNet StructureData"""
 
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import torch
 from chgnet.data.dataset import StructureData
+from chgnet.graph import CrystalGraph
 from pymatgen.core.structure import Structure
 from pymatgen.io.ase import AseAtomsAdaptor
 
 from nff.data import Dataset
+from nff.data.graphs import edges_by_atom, expand_csr
 from nff.io import AtomsBatch
 from nff.utils.cuda import batch_detach, detach
+from nff.utils.tools import make_directed, same_tensor
+
+try:
+    from chgnet.graph.crystalgraph import TORCH_DTYPE
+except ImportError:
+    TORCH_DTYPE = torch.float32
 
 
 def convert_nff_to_chgnet_structure_data(
@@ -233,3 +241,247 @@ def convert_data_batch(
         magmoms=magmoms,
         shuffle=shuffle,
     )
+
+
+def get_lattice(data_batch: Dict, dtype: torch.dtype = TORCH_DTYPE) -> torch.Tensor:
+    """
+    Get the (3 * num_structures, 3) lattice vectors of a batch.
+
+    Args:
+        data_batch (Dict): batch with a `lattice` or `cell` key
+        dtype (torch.dtype, optional): dtype of the lattice. Defaults to the CHGNet dtype.
+
+    Returns:
+        torch.Tensor: lattice vectors, or None if the batch has none
+    """
+    lattice = data_batch.get("lattice", data_batch.get("cell"))
+    if lattice is None:
+        return None
+    device = data_batch["nxyz"].device
+    return torch.as_tensor(lattice, dtype=dtype, device=device).detach().reshape(-1, 3)
+
+
+def get_chgnet_edges(
+    nbr_list: torch.Tensor,
+    offsets: Optional[torch.Tensor],
+    lattice: torch.Tensor,
+    num_atoms: torch.Tensor,
+) -> Dict[str, torch.Tensor]:
+    """
+    Pair each directed edge of an NFF neighbor list with its reverse, which
+    gives the undirected edges of the CHGNet atom graph. An edge (i, j) with
+    image S is the reverse of (j, i) with image -S.
+
+    Args:
+        nbr_list (torch.Tensor): directed or undirected neighbor list
+        offsets (torch.Tensor, optional): Cartesian periodic offsets of the
+            neighbor list, either dense or sparse
+        lattice (torch.Tensor): (3 * num_structures, 3) lattice vectors
+        num_atoms (torch.Tensor): number of atoms in each structure
+
+    Raises:
+        ValueError: raised if the reverse of an edge is missing
+
+    Returns:
+        Dict[str, torch.Tensor]: directed edges sorted by structure, with their
+            offsets, images, structure index and undirected edge index
+    """
+    nbrs, directed = make_directed(nbr_list)
+    if offsets is None:
+        offsets = torch.zeros(len(nbr_list), 3, dtype=lattice.dtype, device=lattice.device)
+    else:
+        offsets = (offsets.to_dense() if offsets.is_sparse else offsets).to(lattice.dtype).expand(len(nbr_list), 3)
+    if not directed:
+        offsets = torch.cat([offsets, -offsets], dim=0)
+
+    atom_graph = torch.repeat_interleave(torch.arange(len(num_atoms), device=nbrs.device), num_atoms)
+    edge_graph = atom_graph[nbrs[:, 0]]
+    order = torch.argsort(edge_graph, stable=True)
+    nbrs, offsets, edge_graph = nbrs[order], offsets[order], edge_graph[order]
+
+    inv_lattice = torch.linalg.inv(lattice.reshape(-1, 3, 3))
+    image = torch.einsum("ej,ejk->ek", offsets, inv_lattice[edge_graph]).round()
+
+    # canonical form of each pair, which is the same for an edge and its reverse
+    sign = torch.sign(image)
+    first_sign = torch.where(sign[:, 0] != 0, sign[:, 0], torch.where(sign[:, 1] != 0, sign[:, 1], sign[:, 2]))
+    swap = (nbrs[:, 0] > nbrs[:, 1]) | ((nbrs[:, 0] == nbrs[:, 1]) & (first_sign < 0))
+    canonical = torch.cat(
+        [
+            torch.where(swap[:, None], nbrs.flip(1), nbrs),
+            torch.where(swap[:, None], -image, image).long(),
+        ],
+        dim=1,
+    )
+    _, undirected, counts = torch.unique(canonical, dim=0, return_inverse=True, return_counts=True)
+    if (counts != 2).any():
+        raise ValueError("The neighbor list doesn't contain the reverse of every pair")
+
+    return {
+        "nbr_list": nbrs,
+        "offsets": offsets,
+        "image": image,
+        "edge_graph": edge_graph,
+        "undirected": undirected,
+        "num_undirected": len(counts),
+    }
+
+
+def get_bond_graph(
+    center: torch.Tensor, undirected: torch.Tensor, dist: torch.Tensor, cutoff: float, num_atoms: int
+) -> torch.Tensor:
+    """
+    Get the CHGNet bond graph, whose rows are
+    [center, undirected edge 1, directed edge 1, undirected edge 2, directed edge 2].
+    Each directed edge within the cutoff is paired with every other edge of
+    its center atom within the cutoff.
+
+    Args:
+        center (torch.Tensor): center atom of each directed edge
+        undirected (torch.Tensor): undirected edge of each directed edge
+        dist (torch.Tensor): length of each directed edge
+        cutoff (float): bond graph cutoff
+        num_atoms (int): number of atoms
+
+    Returns:
+        torch.Tensor: (num_angles, 5) bond graph
+    """
+    # same comparisons as `chgnet.graph.Graph.line_graph_adjacency_list`
+    first = torch.nonzero(dist <= cutoff).reshape(-1)
+    second = torch.nonzero(dist < cutoff).reshape(-1)
+    order, starts, counts = edges_by_atom(center[second], num_atoms)
+
+    seg_idx, pos = expand_csr(starts[center[first]], counts[center[first]])
+    first = first[seg_idx]
+    second = second[order[pos]]
+    keep = first != second
+    first, second = first[keep], second[keep]
+
+    return torch.stack([center[first], undirected[first], first, undirected[second], second], dim=1)
+
+
+def batch_to_crystal_graphs(
+    data_batch: Dict,
+    atom_graph_cutoff: float,
+    bond_graph_cutoff: float,
+    cache: Optional[Dict] = None,
+) -> List[CrystalGraph]:
+    """
+    Build CHGNet crystal graphs directly from the neighbor list of an NFF batch,
+    without converting the structures to pymatgen and recomputing their
+    neighbors. The neighbor list must have been built with a cutoff of at least
+    `atom_graph_cutoff`.
+
+    The pairing of the edges in the neighbor list is kept in `cache` and reused
+    as long as the atoms, neighbor list and lattice don't change, as is the
+    case between neighbor list updates in MD. Only the edges within the cutoffs
+    are recomputed at every call.
+
+    Args:
+        data_batch (Dict): NFF batch with `nxyz`, `num_atoms`, `nbr_list`,
+            optional `offsets`, and `lattice` or `cell`
+        atom_graph_cutoff (float): cutoff of the atom graph
+        bond_graph_cutoff (float): cutoff of the bond graph
+        cache (Dict, optional): dictionary in which to keep the static parts of
+            the graphs between calls. Defaults to None.
+
+    Raises:
+        ValueError: raised if no lattice is found in the batch
+
+    Returns:
+        List[CrystalGraph]: one graph for each structure in the batch
+    """
+    lattice = get_lattice(data_batch)
+    if lattice is None:
+        raise ValueError("No cell or lattice found in batch")
+
+    cache = {} if cache is None else cache
+    nxyz = data_batch["nxyz"].detach()
+    num_atoms = torch.atleast_1d(data_batch["num_atoms"]).long().to(nxyz.device)
+    nbr_list = data_batch["nbr_list"]
+    offsets = data_batch.get("offsets")
+
+    key = [nxyz[:, 0], num_atoms, nbr_list, offsets, lattice]
+    if "key" not in cache or not all(same_tensor(x, y) for x, y in zip(cache["key"], key)):
+        # copies, so that buffers refilled in place aren't mistaken for the cached inputs
+        cache["key"] = [None if x is None else x.detach().clone() for x in key]
+        cache["edges"] = get_chgnet_edges(nbr_list, offsets, lattice, num_atoms)
+    edges = cache["edges"]
+
+    xyz = nxyz[:, 1:].to(lattice.dtype)
+    nbrs = edges["nbr_list"]
+    dist = (xyz[nbrs[:, 1]] - xyz[nbrs[:, 0]] + edges["offsets"]).norm(dim=-1)
+    keep = dist <= atom_graph_cutoff
+    nbrs, dist, edge_graph = nbrs[keep], dist[keep], edges["edge_graph"][keep]
+
+    # renumber the undirected edges that are left
+    undirected = edges["undirected"][keep]
+    kept_undirected = torch.zeros(edges["num_undirected"], dtype=torch.bool, device=keep.device)
+    kept_undirected[undirected] = True
+    undirected = (torch.cumsum(kept_undirected, 0) - 1)[undirected]
+    num_undirected = int(kept_undirected.sum())
+    directed = torch.arange(len(nbrs), device=nbrs.device)
+    undirected2directed = torch.full((num_undirected,), len(nbrs), dtype=torch.long, device=nbrs.device)
+    undirected2directed = undirected2directed.scatter_reduce(0, undirected, directed, reduce="amin")
+
+    bond_graph = get_bond_graph(nbrs[:, 0], undirected, dist, bond_graph_cutoff, len(nxyz))
+
+    # split everything into the structures, with indices local to each structure
+    num_graphs = len(num_atoms)
+    atom_start = torch.cumsum(num_atoms, 0) - num_atoms
+    edge_counts = torch.bincount(edge_graph, minlength=num_graphs)
+    edge_start = torch.cumsum(edge_counts, 0) - edge_counts
+    undirected_graph = edge_graph[undirected2directed]
+    undirected_counts = torch.bincount(undirected_graph, minlength=num_graphs)
+    undirected_start = torch.cumsum(undirected_counts, 0) - undirected_counts
+    angle_graph = edge_graph[bond_graph[:, 2]]
+    angle_counts = torch.bincount(angle_graph, minlength=num_graphs)
+
+    atom_graph = nbrs - atom_start[edge_graph, None]
+    directed2undirected = undirected - undirected_start[edge_graph]
+    undirected2directed = undirected2directed - edge_start[undirected_graph]
+    bond_graph = bond_graph - torch.stack(
+        [
+            atom_start[angle_graph],
+            undirected_start[angle_graph],
+            edge_start[angle_graph],
+            undirected_start[angle_graph],
+            edge_start[angle_graph],
+        ],
+        dim=1,
+    )
+
+    lattices = lattice.reshape(-1, 3, 3)
+    splits = [
+        torch.split(val, counts.tolist())
+        for val, counts in [
+            (xyz, num_atoms),
+            (nxyz[:, 0].to(torch.int32), num_atoms),
+            (atom_graph.to(torch.int32), edge_counts),
+            (edges["image"][keep], edge_counts),
+            (directed2undirected.to(torch.int32), edge_counts),
+            (undirected2directed.to(torch.int32), undirected_counts),
+            (bond_graph.to(torch.int32), angle_counts),
+        ]
+    ]
+
+    graphs = []
+    for i, (pos, numbers, graph, image, d2u, u2d, bonds) in enumerate(zip(*splits)):
+        frac_coord = pos @ torch.linalg.inv(lattices[i])
+        graphs.append(
+            CrystalGraph(
+                atomic_number=numbers,
+                atom_frac_coord=frac_coord.requires_grad_(True),
+                atom_graph=graph,
+                atom_graph_cutoff=atom_graph_cutoff,
+                neighbor_image=image,
+                directed2undirected=d2u,
+                undirected2directed=u2d,
+                bond_graph=bonds,
+                bond_graph_cutoff=bond_graph_cutoff,
+                lattice=lattices[i].clone().requires_grad_(True),
+                graph_id=str(i),
+            )
+        )
+
+    return graphs
@@ -0,0 +1,316 @@
+"""
+Micro-batching inference server for many concurrent ASE calculators.
+
+Independent workflows (NEB images, parallel optimizations, replica MD) each
+evaluate a small structure at a time. Instead of giving each of them its own
+`NeuralFF`, they can use a `RemoteNeuralFF` that sends its batch to an
+`InferenceServer`. The server gathers the requests that arrive within a short
+latency budget, collates them into one batch, runs a single forward and
+backward pass and sends each client its part of the results.
+
+The server listens on a Unix domain socket (or a TCP address) through
+`multiprocessing.connection`, so the clients can live in other processes.
+The neighbor lists are built by the clients, with the usual `AtomsBatch`
+skin, and only the model runs in the server.
+
+Messages are pickled, so anyone who can connect to the server can run code
+in it. A TCP server therefore always uses an authentication key, which is
+generated if none is given and must be passed to the clients. A Unix socket
+is only accessible to the user running the server (its permissions are set
+to 0600), so put it in a directory that other users can't write to, or give
+it an `authkey` as well.
+
+Example:
+    server = InferenceServer(model, address="/tmp/nff.sock", device="cuda")
+    server.start()
+    # in any process
+    atoms.calc = RemoteNeuralFF("/tmp/nff.sock")
+
+    server = InferenceServer(model, address=("0.0.0.0", 6000), device="cuda")
+    server.start()
+    # in any process that was given `server.authkey`
+    atoms.calc = RemoteNeuralFF(("server-host", 6000), authkey=authkey)
+"""
+
+import os
+import queue
+import secrets
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import torch
+from ase.calculators.calculator import Calculator, all_changes
+
+from nff.data import collate_dicts
+from nff.io.ase_calcs import UNDIRECTED, NeuralFF
+from nff.utils.cuda import batch_to
+
+DEFAULT_KEYS = ["nxyz", "nbr_list", "offsets", "num_atoms"]
+
+
+class Request:
+    """A batch sent by one client, and the connection to send the results to."""
+
+    def __init__(self, conn, lock, batch, directed):
+        self.conn = conn
+        self.lock = lock
+        self.batch = batch
+        self.directed = directed
+        self.num_atoms = int(batch["num_atoms"].sum())
+        self.num_structures = len(batch["num_atoms"])
+
+    def reply(self, result):
+        with self.lock:
+            self.conn.send(result)
+
+
+class InferenceServer:
+    """Serves energies and forces of a model to `RemoteNeuralFF` calculators,
+    evaluating the pending requests together.
+
+    Attributes:
+        calc (NeuralFF): calculator that runs the model and converts units
+        address (str or tuple): address of the listener
+        authkey (bytes or None): key that clients need to connect
+        max_wait (float): time in seconds for which requests are gathered
+            after the first one arrives
+        max_atoms (int): maximum number of atoms in one batch
+        num_batches (int): number of batches evaluated so far
+        num_requests (int): number of requests answered so far
+    """
+
+    def __init__(
+        self,
+        model,
+        address,
+        device="cpu",
+        max_wait=0.005,
+        max_atoms=20000,
+        authkey=None,
+        **kwargs,
+    ):
+        """
+        Args:
+            model (torch.nn.Module): model that predicts energies and their gradients
+            address (str or tuple): path of a Unix domain socket, or (host, port)
+            device (str): device of the model
+            max_wait (float): latency budget in seconds for gathering requests
+            max_atoms (int): maximum number of atoms in one batch
+            authkey (bytes, optional): key that clients need to connect.
+                Required for TCP addresses, so a random key is generated if
+                none is given.
+            **kwargs: keyword arguments for `NeuralFF` (e.g. units or model_kwargs)
+        """
+        self.calc = NeuralFF(model=model, device=device, **kwargs)
+        self.address = address
+        self.max_wait = max_wait
+        self.max_atoms = max_atoms
+        # pickled messages from unauthenticated clients could run any code
+        if authkey is None and isinstance(address, tuple):
+            authkey = secrets.token_bytes(32)
+        self.authkey = authkey
+
+        self.requests = queue.Queue()
+        self.listener = None
+        self.threads = []
+        self.stopped = threading.Event()
+        self.num_batches = 0
+        self.num_requests = 0
+
+    @classmethod
+    def from_file(cls, model_path, address, device="cuda", **kwargs):
+        calc = NeuralFF.from_file(model_path, device=device)
+        return cls(calc.model, address, device=device, **kwargs)
+
+    def start(self):
+        """Start listening and evaluating requests in background threads."""
+        self.listener = Listener(self.address, authkey=self.authkey)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.chmod(self.address, 0o600)
+        for target in [self.accept, self.work]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def serve_forever(self):
+        """Start the server and block until it's closed."""
+        self.start()
+        self.stopped.wait()
+
+    def close(self):
+        self.stopped.set()
+        self.requests.put(None)
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def accept(self):
+        while not self.stopped.is_set():
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                # a client with the wrong key
+                continue
+            except OSError:
+                # the listener was closed
+                return
+            thread = threading.Thread(target=self.receive, args=(conn,), daemon=True)
+            thread.start()
+
+    def receive(self, conn):
+        """Put the requests of one client in the queue until it disconnects."""
+        lock = threading.Lock()
+        with conn:
+            while not self.stopped.is_set():
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                self.requests.put(Request(conn=conn, lock=lock, batch=message["batch"], directed=message["directed"]))
+
+    def gather(self):
+        """
+        Wait for a request, and then gather more requests until the latency
+        budget is used up or the batch is full.
+        Returns:
+            requests (list[Request]): requests to evaluate together, or None if
+                the server was closed
+        """
+        first = self.requests.get()
+        if first is None:
+            return None
+
+        requests = [first]
+        num_atoms = first.num_atoms
+        deadline = time.monotonic() + self.max_wait
+
+        while num_atoms < self.max_atoms:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)
+                break
+            requests.append(request)
+            num_atoms += request.num_atoms
+
+        return requests
+
+    def check_directed(self, requests):
+        if isinstance(self.calc.model, tuple(UNDIRECTED)):
+            return
+        if not all(request.directed for request in requests):
+            raise AssertionError(f"{self.calc.model.__class__.__name__} needs a directed neighbor list")
+
+    def evaluate(self, requests):
+        """
+        Evaluate a list of requests in one batch.
+        Args:
+            requests (list[Request]): requests
+        Returns:
+            results (list[dict]): energy and forces of each request
+        """
+        self.check_directed(requests)
+        batch = batch_to(collate_dicts([request.batch for request in requests]), self.calc.device)
+        energy, forces = self.calc.predict(batch)
+        energy = energy.cpu().numpy()
+        forces = forces.cpu().numpy()
+
+        energy_split = np.cumsum([request.num_structures for request in requests])[:-1]
+        forces_split = np.cumsum([request.num_atoms for request in requests])[:-1]
+
+        return [
+            {"energy": en, "forces": frc}
+            for en, frc in zip(np.split(energy, energy_split), np.split(forces, forces_split))
+        ]
+
+    def work(self):
+        while not self.stopped.is_set():
+            requests = self.gather()
+            if requests is None:
+                return
+
+            try:
+                results = self.evaluate(requests)
+            except Exception as err:
+                results = [err] * len(requests)
+
+            self.num_batches += 1
+            self.num_requests += len(requests)
+
+            for request, result in zip(requests, results):
+                try:
+                    request.reply(result)
+                except (OSError, ValueError):
+                    # the client has disconnected
+                    continue
+
+
+class RemoteNeuralFF(Calculator):
+    """ASE calculator whose energies and forces come from an `InferenceServer`.
+    It needs an `AtomsBatch`, whose neighbor list is sent with the positions.
+    """
+
+    implemented_properties = ["energy", "forces"]
+
+    def __init__(self, address, authkey=None, keys=None, **kwargs):
+        """
+        Args:
+            address (str or tuple): address of the server
+            authkey (bytes, optional): key of the server
+            keys (list[str], optional): keys of the batch that the model needs
+            **kwargs: keyword arguments for `Calculator`
+        """
+        Calculator.__init__(self, **kwargs)
+        self.address = address
+        self.authkey = authkey
+        self.keys = keys if keys is not None else DEFAULT_KEYS
+        self.conn = None
+
+    def __getstate__(self):
+        # connections can't be pickled, so a copy opens its own
+        state = self.__dict__.copy()
+        state["conn"] = None
+        return state
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = Client(self.address, authkey=self.authkey)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get_request(self, atoms):
+        batch = atoms.get_batch()
+        request = {}
+        for key in self.keys:
+            val = batch[key]
+            if isinstance(val, torch.Tensor):
+                # sparse and dense offsets can't be collated together
+                val = val.to_dense() if val.is_sparse else val
+                val = val.detach().cpu()
+            request[key] = val
+
+        return {"batch": request, "directed": atoms.directed}
+
+    def calculate(self, atoms=None, properties=["energy", "forces"], system_changes=all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+
+        conn = self.connect()
+        conn.send(self.get_request(atoms))
+        result = conn.recv()
+        if isinstance(result, Exception):
+            raise result
+
+        self.results = {"energy": result["energy"].reshape(-1), "forces": result["forces"].reshape(-1, 3)}
+        atoms.results = self.results.copy()
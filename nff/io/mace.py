@@ -7,16 +7,16 @@ from typing import Dict, List, Optional, Tuple, Union
 import numpy as np
 import torch
 from mace.data.atomic_data import AtomicNumberTable
-from mace.modules.blocks import AtomicEnergiesBlock
 from mace.modules.models import MACE, ScaleShiftMACE
 from mace.modules.radial import BesselBasis, GaussianBasis
-from mace.tools.scatter import scatter_sum
 from mace.tools.torch_geometric.batch import Batch
 from mace.tools.torch_geometric.data import Data
 from torch import Tensor
 
+import nff.utils.constants as const
 from nff.data import Dataset
-from nff.utils.cuda import detach
+from nff.data.stats import DatasetStats
+from nff.utils.tools import make_directed, same_tensor
 
 # get the path to NFF models dir, which is the parent directory of this file
 module_dir = os.path.abspath(os.path.join(os.path.abspath(__file__), "..", "..", "..", "models"))
@@ -127,7 +127,21 @@ def get_atomic_number_table_from_zs(zs: Iterable[int]) -> AtomicNumberTable:
     return AtomicNumberTable(sorted(z_set))
 
 
-def compute_average_E0s(train_dset: Dataset, z_table: AtomicNumberTable, desired_units: str = "eV") -> Dict[int, float]:
+def get_energy_factor(units: str, desired_units: str) -> float:
+    """Factor that converts energies from `units` to `desired_units`."""
+    if units == desired_units:
+        return 1.0
+    if desired_units == "eV/atom":
+        raise NotImplementedError("Atomic energies can't be fitted to energies per atom")
+    return const.conversion_factors[(units, desired_units)]["energy"]
+
+
+def compute_average_E0s(
+    train_dset: Dataset,
+    z_table: AtomicNumberTable,
+    desired_units: str = "eV",
+    stats: Optional[DatasetStats] = None,
+) -> Dict[int, float]:
     """Function to compute the average interaction energy of each chemical element
     returns dictionary of E0s
 
@@ -135,40 +149,34 @@ def compute_average_E0s(train_dset: Dataset, z_table: AtomicNumberTable, desired
     train_dset (Dataset): dataset of training data
     z_table (AtomicNumberTable): table of atomic numbers
     desired_units (str, optional): units for atomic energies. Defaults to "eV".
+    stats (DatasetStats, optional): statistics of `train_dset`, if they were
+        already computed
 
     Returns:
     Dict[int, float]: dictionary of atomic energies
     """
-    original_units = train_dset.units
-    train_dset.to_units(desired_units)
-
-    len_train = len(train_dset)
-    len_zs = len(z_table)
-    A = np.zeros((len_train, len_zs))
-    B = np.zeros(len_train)
-    for i in range(len_train):
-        B[i] = train_dset[i]["energy"]
-        for j, z in enumerate(z_table.zs):
-            A[i, j] = np.count_nonzero(detach(train_dset[i]["nxyz"][:, 0], to_numpy=True).astype(int) == z)
+    if stats is None:
+        stats = DatasetStats.from_dataset(train_dset, keys=())
+
+    # the regression is linear in the energies, so it's converted afterwards
+    factor = get_energy_factor(train_dset.units, desired_units)
     try:
-        E0s = np.linalg.lstsq(A, B, rcond=None)[0]
-        atomic_energies_dict = {}
-        for i, z in enumerate(z_table.zs):
-            atomic_energies_dict[z] = E0s[i]
+        E0s, _ = stats.fit_composition(elements=z_table.zs, intercept=False)
+        atomic_energies_dict = {z: E0s[z] * factor for z in z_table.zs}
     except np.linalg.LinAlgError:
         logging.warning("Failed to compute E0s using least squares regression, using the same for all atoms")
         atomic_energies_dict = {}
         for z in z_table.zs:
             atomic_energies_dict[z] = 0.0
 
-    train_dset.to_units(original_units)
     return atomic_energies_dict
 
 
 def compute_mean_rms_energy_forces(
-    data_loader: torch.utils.data.DataLoader,
+    data_loader: Optional[torch.utils.data.DataLoader],
     atomic_energies: np.ndarray,
     z_table: AtomicNumberTable,
+    stats: Optional[DatasetStats] = None,
 ) -> Tuple[float, float]:
     """Compute the mean of atomic energies and RMS of forces for a dataset.
 
@@ -176,45 +184,17 @@ def compute_mean_rms_energy_forces(
     data_loader (torch.utils.data.DataLoader): data loader
     atomic_energies (np.ndarray): atomic energies
     z_table (AtomicNumberTable): table of atomic numbers
+    stats (DatasetStats, optional): statistics of the data, if they were
+        already computed. Then `data_loader` isn't used.
 
     Returns:
     Tuple[float, float]: mean and RMS of forces
     """
+    if stats is None:
+        stats = DatasetStats.from_loader(data_loader, keys=["energy_grad"])
 
-    atomic_energies_fn = AtomicEnergiesBlock(atomic_energies=atomic_energies)
-    atom_energy_list = []
-    forces_list = []
-
-    for batch in data_loader:
-        # obtain one hot encoded atoms based on z_table atom indices
-        zs = detach(batch["nxyz"][:, 0], to_numpy=True).astype(int)
-        one_hot_zs = torch.zeros((len(zs), len(z_table)), dtype=torch.get_default_dtype())
-        for i, z in enumerate(zs):
-            one_hot_zs[i, z_table.z_to_index(z)] = 1
-        # compute atomic energies
-        node_e0 = atomic_energies_fn(one_hot_zs)
-        graph_sizes = batch["num_atoms"]  # list of num atoms
-
-        # given graph_sizes, transform to list of indices
-        # index starts from 0, denoting the first graph
-        # each index is repeated by the number of atoms in the graph
-        counter = 0
-        batch_indices = torch.zeros(sum(graph_sizes), dtype=torch.long)
-        for i, size in enumerate(graph_sizes):
-            batch_indices[counter : counter + size] = i
-            counter += size
-
-        # get the graph energy
-        graph_e0s = scatter_sum(src=node_e0, index=batch_indices, dim=-1, dim_size=len(graph_sizes))
-        atom_energy_list.append((batch["energy"] - graph_e0s) / graph_sizes)  # {[n_graphs], }
-        forces_list.append(-batch["energy_grad"])  # {[n_graphs*n_atoms,3], }
-
-    atom_energies = torch.cat(atom_energy_list, dim=0)  # [total_n_graphs]
-    forces = torch.cat(forces_list, dim=0)  # {[total_n_graphs*n_atoms,3], }
-
-    mean = detach(torch.mean(atom_energies), to_numpy=True).item()
-    rms = detach(torch.sqrt(torch.mean(torch.square(forces))), to_numpy=True).item()
-    rms = _check_non_zero(rms)
+    mean = stats.mean_atomic_energy(dict(zip(z_table.zs, np.asarray(atomic_energies).tolist())))
+    rms = _check_non_zero(stats.rms("energy_grad"))
     return mean, rms
 
 
@@ -227,17 +207,7 @@ def compute_avg_num_neighbors(data_loader: torch.utils.data.DataLoader) -> float
     Returns:
     float: average number of neighbors
     """
-    num_neighbors = []
-
-    for batch in data_loader:
-        unique_neighbors_list = torch.unique(batch["nbr_list"], dim=0)  # remove repeated neighbors
-        receivers = unique_neighbors_list[:, 1]
-
-        _, counts = torch.unique(receivers, return_counts=True)
-        num_neighbors.append(counts)
-
-    avg_num_neighbors = torch.mean(torch.cat(num_neighbors, dim=0).type(torch.get_default_dtype()))
-    return detach(avg_num_neighbors, to_numpy=True).item()
+    return DatasetStats.from_loader(data_loader, keys=()).avg_num_neighbors
 
 
 def update_mace_init_params(
@@ -262,32 +232,35 @@ def update_mace_init_params(
     if not logger:
         logger = logging.getLogger(__name__)
 
+    # all the statistics of the training set come from one pass over it
+    train_stats = DatasetStats.from_dataset(train, keys=["energy_grad"])
+    val_stats = DatasetStats.from_dataset(val, keys=())
+
     # z_table
-    z_table = get_atomic_number_table_from_zs(
-        [
-            int(z)
-            for data_split in (train, val)
-            for data in data_split
-            for z in detach(data["nxyz"][:, 0], to_numpy=True)
-        ]
-    )
+    z_table = get_atomic_number_table_from_zs(train_stats.elements + val_stats.elements)
     logger.info("Z Table %s", z_table.zs)
 
     # avg_num_neighbors
     # Average number of neighbors: 41.22802734375
     # BUG: doesn't really match but might not matter!
-    avg_num_neighbors = compute_avg_num_neighbors(train_loader)
+    if train_stats.num_receivers > 0:
+        avg_num_neighbors = train_stats.avg_num_neighbors
+    else:
+        # the neighbor lists are only made by the loader
+        avg_num_neighbors = compute_avg_num_neighbors(train_loader)
     logger.info("Average number of neighbors: %s", avg_num_neighbors)
 
     # atomic_energies
     # {8: -4.930998234144857, 38: -5.8572783662579795, 77: -8.316066722236071}
-    atomic_energies_dict = compute_average_E0s(train, z_table)
+    atomic_energies_dict = compute_average_E0s(train, z_table, stats=train_stats)
     atomic_energies: np.ndarray = np.array([atomic_energies_dict[z] for z in z_table.zs])
     logger.info("Atomic energies: %s", atomic_energies.tolist())
 
     # mean & std
     # Mean and std of atomic energies: -0.0014447236899286509, 7.5926432609558105
-    atomic_inter_shift, atomic_inter_scale = compute_mean_rms_energy_forces(train_loader, atomic_energies, z_table)
+    atomic_inter_shift, atomic_inter_scale = compute_mean_rms_energy_forces(
+        train_loader, atomic_energies, z_table, stats=train_stats
+    )
     logger.info("Mean and std of atomic energies: %s, %s", atomic_inter_shift, atomic_inter_scale)
 
     model_params["atomic_inter_scale"] = atomic_inter_scale
@@ -354,3 +327,162 @@ class NffBatch(Batch):
             data.num_nodes = self.__num_nodes_list__[idx]
 
         return data
+
+
+def copy_key(tensor: Optional[Tensor]) -> Optional[Tensor]:
+    """Copy of an input that the cached graph is checked against, so that
+    buffers refilled in place aren't mistaken for the cached inputs."""
+    return None if tensor is None else tensor.detach().clone()
+
+
+def get_mace_nodes(numbers: Tensor, num_atoms: Tensor, z_table: AtomicNumberTable) -> Dict[str, Tensor]:
+    """Get the node inputs of MACE from the atomic numbers of a batch.
+
+    Args:
+    numbers (Tensor): atomic numbers of all atoms in the batch
+    num_atoms (Tensor): number of atoms in each structure
+    z_table (AtomicNumberTable): atomic number table of the model
+
+    Raises:
+    ValueError: raised if an element is not in the atomic number table
+
+    Returns:
+    Dict[str, Tensor]: one-hot node attributes, structure index of each atom and
+        pointers to the first atom of each structure
+    """
+    device = numbers.device
+    zs = torch.tensor(z_table.zs, dtype=torch.long, device=device)
+    lookup = torch.full((max(z_table.zs + [int(numbers.max())]) + 1,), -1, dtype=torch.long, device=device)
+    lookup[zs] = torch.arange(len(zs), device=device)
+
+    species = lookup[numbers]
+    if (species < 0).any():
+        missing = sorted(set(numbers[species < 0].tolist()))
+        raise ValueError(f"Atomic numbers {missing} are not in the atomic number table {z_table.zs}")
+
+    node_attrs = torch.nn.functional.one_hot(species, num_classes=len(zs)).to(torch.get_default_dtype())
+    batch = torch.repeat_interleave(torch.arange(len(num_atoms), device=device), num_atoms)
+    ptr = torch.cat([num_atoms.new_zeros(1), torch.cumsum(num_atoms, 0)])
+
+    return {
+        "numbers": copy_key(numbers),
+        "num_atoms": copy_key(num_atoms),
+        "node_attrs": node_attrs,
+        "batch": batch,
+        "ptr": ptr,
+    }
+
+
+def get_mace_edges(
+    nbr_list: Tensor, offsets: Optional[Tensor], cell: Tensor, batch: Tensor
+) -> Dict[str, Union[Tensor, None]]:
+    """Get the edge inputs of MACE from an NFF neighbor list. MACE uses
+    `positions[receiver] - positions[sender] + shifts`, and NFF uses
+    `xyz[j] - xyz[i] + offsets`, so the senders are the first column of the
+    neighbor list and the shifts are the offsets.
+
+    Args:
+    nbr_list (Tensor): directed or undirected neighbor list
+    offsets (Tensor, optional): Cartesian periodic offsets of the neighbor list,
+        either dense or sparse
+    cell (Tensor): (3 * num_structures, 3) cells of the structures
+    batch (Tensor): structure index of each atom
+
+    Returns:
+    Dict[str, Tensor]: edge index, shifts and unit shifts of all pairs in the
+        neighbor list, together with the inputs used to build them
+    """
+    dtype = torch.get_default_dtype()
+    nbrs, directed = make_directed(nbr_list)
+    if offsets is None:
+        shifts = torch.zeros(len(nbr_list), 3, dtype=dtype, device=nbr_list.device)
+    else:
+        shifts = (offsets.to_dense() if offsets.is_sparse else offsets).to(dtype).expand(len(nbr_list), 3)
+    if not directed:
+        shifts = torch.cat([shifts, -shifts], dim=0)
+
+    # pinv gives zero unit shifts for structures without a cell
+    inv_cells = torch.linalg.pinv(cell.to(dtype).reshape(-1, 3, 3))
+    unit_shifts = torch.einsum("ej,ejk->ek", shifts, inv_cells[batch[nbrs[:, 0]]]).round()
+
+    return {
+        "nbr_list": copy_key(nbr_list),
+        "offsets": copy_key(offsets),
+        "cell": copy_key(cell),
+        "edge_index": nbrs.T.long().contiguous(),
+        "shifts": shifts.contiguous(),
+        "unit_shifts": unit_shifts,
+    }
+
+
+def batch_to_mace_data(
+    batch: Dict, z_table: AtomicNumberTable, r_max: float, cache: Optional[Dict] = None
+) -> Dict[str, Tensor]:
+    """Build the inputs of MACE directly from the neighbor list of an NFF batch,
+    without copying the structures to numpy and recomputing their neighbors.
+    The neighbor list must have been built with a cutoff of at least `r_max`.
+
+    Node inputs and edges of the full neighbor list are kept in `cache` and
+    reused as long as the atoms, neighbor list and cell don't change, as is the
+    case between neighbor list updates in MD. Only the pairs within `r_max` of
+    each other are recomputed at every call.
+
+    Args:
+    batch (Dict): NFF batch with `nxyz`, `num_atoms`, `nbr_list`, optional
+        `offsets`, and `cell` or `lattice`
+    z_table (AtomicNumberTable): atomic number table of the model
+    r_max (float): cutoff of the model
+    cache (Dict, optional): dictionary in which to keep the static parts of the
+        graph between calls. Defaults to None.
+
+    Raises:
+    ValueError: raised if no cell or lattice is found in the batch
+
+    Returns:
+    Dict[str, Tensor]: inputs of the MACE model
+    """
+    if "cell" in batch:
+        cell = batch["cell"]
+    elif "lattice" in batch:
+        cell = batch["lattice"]
+    else:
+        raise ValueError("No cell or lattice found in batch")
+
+    cache = {} if cache is None else cache
+    nxyz = batch["nxyz"]
+    numbers = nxyz[:, 0].long()
+    num_atoms = torch.atleast_1d(batch["num_atoms"]).long().to(nxyz.device)
+
+    nodes = cache.get("nodes")
+    if nodes is None or not (same_tensor(nodes["numbers"], numbers) and same_tensor(nodes["num_atoms"], num_atoms)):
+        nodes = get_mace_nodes(numbers, num_atoms, z_table)
+        cache["nodes"] = nodes
+
+    nbr_list = batch["nbr_list"]
+    offsets = batch.get("offsets")
+    edges = cache.get("edges")
+    if edges is None or not (
+        same_tensor(edges["nbr_list"], nbr_list)
+        and same_tensor(edges["offsets"], offsets)
+        and same_tensor(edges["cell"], cell)
+    ):
+        edges = get_mace_edges(nbr_list, offsets, cell, nodes["batch"])
+        cache["edges"] = edges
+
+    positions = nxyz[:, 1:].detach().to(dtype=torch.get_default_dtype(), copy=True)
+
+    # drop the pairs in the skin of the neighbor list
+    sender, receiver = edges["edge_index"]
+    dist = (positions[receiver] - positions[sender] + edges["shifts"]).norm(dim=-1)
+    keep = dist < r_max
+
+    return {
+        "positions": positions,
+        "node_attrs": nodes["node_attrs"],
+        "batch": nodes["batch"],
+        "ptr": nodes["ptr"],
+        "cell": cell.detach().to(torch.get_default_dtype()).reshape(-1, 3),
+        "edge_index": edges["edge_index"][:, keep],
+        "shifts": edges["shifts"][keep],
+        "unit_shifts": edges["unit_shifts"][keep],
+    }
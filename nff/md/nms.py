@@ -19,8 +19,7 @@ from tqdm import tqdm
 from nff.data import Dataset, collate_dicts
 from nff.io.ase_ax import AtomsBatch, NeuralFF
 from nff.md import nve
-from nff.nn.models.schnet import SchNet
-from nff.nn.tensorgrad import get_schnet_hessians
+from nff.nn.tensorgrad import BatchHessian
 from nff.nn.tensorgrad import hess_from_atoms as analytical_hess
 from nff.train import load_model
 from nff.utils import constants as const
@@ -555,21 +554,14 @@ def get_modes(model, loader, energy_key, device):
     batch = batch_to(batch, device)
     model = model.to(device)
 
-    if isinstance(model, SchNet):
-        hessian = (
-            get_schnet_hessians(batch=batch, model=model, device=device, energy_key=energy_key)[0]
-            .cpu()
-            .detach()
-            .numpy()
-        )
-    else:
-        raise NotImplementedError
+    (hessian,) = BatchHessian(batch, model=model, en_key=energy_key).blocks()
+    hessian = hessian.cpu().numpy()
 
     # convert to Ha / bohr^2
     hessian *= (const.BOHR_RADIUS) ** 2
     hessian *= const.KCAL_TO_AU["energy"]
 
-    force_consts, vib_freqs, eigvec = vib_analy(
+    force_consts, vib_freqs, eigvec, _, _ = vib_analy(
         r=batch["nxyz"][:, 0].cpu().detach().numpy(), xyz=batch["nxyz"][:, 1:].cpu().detach().numpy(), hessian=hessian
     )
 
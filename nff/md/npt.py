@@ -81,7 +81,7 @@ class NoseHoovernpt(NPT):
         for _ in tqdm(range(epochs)):
             self.max_steps += steps_per_epoch
             Dynamics.run(self)
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
 
 
 class Berendsennpt(Inhomogeneous_NPTBerendsen):
@@ -154,7 +154,7 @@ class Berendsennpt(Inhomogeneous_NPTBerendsen):
         for _ in tqdm(range(epochs)):
             self.max_steps += steps_per_epoch
             Dynamics.run(self)
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
 
 
 class NoseHooverNPT(MolecularDynamics):
@@ -282,7 +282,7 @@ class NoseHooverNPT(MolecularDynamics):
         for _ in range(epochs):
             self.max_steps += steps_per_epoch
             Dynamics.run(self)
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
 
 
 class NoseHooverChainsNPT_Hydrostatic(MolecularDynamics):
@@ -508,7 +508,7 @@ class NoseHooverChainsNPT_Hydrostatic(MolecularDynamics):
         for _ in tqdm(range(epochs)):
             self.max_steps += steps_per_epoch
             Dynamics.run(self)
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
 
 
 class NoseHooverChainsNPT_Flexible(MolecularDynamics):
@@ -831,4 +831,4 @@ class NoseHooverChainsNPT_Flexible(MolecularDynamics):
         for _ in tqdm(range(epochs)):
             self.max_steps += steps_per_epoch
             Dynamics.run(self)
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
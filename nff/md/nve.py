@@ -193,7 +193,9 @@ class Dynamics:
     def run(self) -> None:
         """Run the MD simulation for the specified number of steps. If the stability_check
         parameter is set to True, the simulation will run until the temperature is within
-        reasonable bounds. The neighbor list is updated every nbr_list_update_freq steps.
+        reasonable bounds. Every nbr_list_update_freq steps the displacements are checked
+        against the cutoff skin, and the neighbor list is only rebuilt once some atom has
+        moved by more than half the skin (see `AtomsBatch.update_nbr_list_if_needed`).
         """
         epochs = int(self.steps // self.mdparam["nbr_list_update_freq"])
         # In case it had neighbors that didn't include the cutoff skin,
@@ -217,7 +219,7 @@ class Dynamics:
                 #     self.atomsbatch.set_positions(self.atoms.get_positions(wrap=True))
                 #     self.atomsbatch.set_positions(reconstruct_atoms(atoms, self.atomsbatch.props['mol_idx']))
 
-                self.atomsbatch.update_nbr_list()
+                self.atomsbatch.update_nbr_list_if_needed()
 
         else:
             for _step in range(epochs):
@@ -228,7 +230,7 @@ class Dynamics:
                 #     self.atomsbatch.set_positions(self.atoms.get_positions(wrap=True))
                 #     self.atomsbatch.set_positions(reconstruct_atoms(atoms, self.atomsbatch.props['mol_idx']))
 
-                self.atomsbatch.update_nbr_list()
+                self.atomsbatch.update_nbr_list_if_needed()
 
         self.traj.close()
 
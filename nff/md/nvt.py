@@ -7,7 +7,9 @@ from typing import Optional
 
 import ase
 import numpy as np
+import torch
 from ase import units
+from ase.constraints import FixAtoms
 from ase.md.logger import MDLogger
 from ase.md.md import MolecularDynamics
 from ase.md.velocitydistribution import MaxwellBoltzmannDistribution, Stationary, ZeroRotation
@@ -16,6 +18,8 @@ from packaging.version import Version, parse
 from tqdm import tqdm
 
 from nff.io.ase import AtomsBatch
+from nff.io.ase_calcs import NeuralFF
+from nff.utils.cuda import batch_to
 
 ASE_VERSION = parse(ase.__version__)
 ASE_CUTOFF_VERSION = parse("3.23.0")
@@ -193,7 +197,7 @@ class NoseHoover(MolecularDynamics):
         for _ in tqdm(range(epochs)):
             self.max_steps += steps_per_epoch
             run_with_ase_check(self, steps_per_epoch)
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
 
 
 class NoseHooverChain(NoseHoover):
@@ -425,7 +429,7 @@ class Langevin(MolecularDynamics):
             x = self.atoms.get_positions(wrap=True)
             self.atoms.set_positions(x)
 
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
             Stationary(self.atoms)
             ZeroRotation(self.atoms)
 
@@ -437,7 +441,114 @@ class Langevin(MolecularDynamics):
         #     state = pickle.load(f)
 
 
+def segment_sum(vals: torch.Tensor, mol_idx: torch.Tensor, num_mols: int) -> torch.Tensor:
+    """Sum the per-atom values of each molecule in a batch."""
+    out = vals.new_zeros((num_mols, *vals.shape[1:]))
+    return out.index_add_(0, mol_idx, vals)
+
+
+def preserve_kinetic_energy(
+    momenta: torch.Tensor,
+    new_momenta: torch.Tensor,
+    masses: torch.Tensor,
+    mol_idx: torch.Tensor,
+    num_mols: int,
+) -> torch.Tensor:
+    """Rescale `new_momenta` so that each molecule keeps the kinetic energy it had
+    with `momenta`, like `force_temperature` does after ASE's `Stationary` and
+    `ZeroRotation`.
+    """
+    ke_old = segment_sum((momenta**2 / masses).sum(-1), mol_idx, num_mols)
+    ke_new = segment_sum((new_momenta**2 / masses).sum(-1), mol_idx, num_mols)
+    scale = torch.where(ke_new > 0, ke_old / ke_new.clamp(min=1e-300), torch.zeros_like(ke_new)).sqrt()
+    return new_momenta * scale[mol_idx].unsqueeze(-1)
+
+
+def batch_stationary(
+    momenta: torch.Tensor,
+    masses: torch.Tensor,
+    mol_idx: torch.Tensor,
+    num_mols: int,
+    preserve_temperature: bool = True,
+) -> torch.Tensor:
+    """Batched version of ASE's `Stationary`, which sets the center-of-mass
+    momentum of every molecule to zero.
+
+    Args:
+        momenta (torch.Tensor): momenta of all atoms, (N, 3)
+        masses (torch.Tensor): masses of all atoms, (N, 1)
+        mol_idx (torch.Tensor): index of the molecule of each atom, (N,)
+        num_mols (int): number of molecules
+        preserve_temperature (bool): rescale the momenta of each molecule to
+            keep its kinetic energy
+
+    Returns:
+        torch.Tensor: new momenta
+    """
+    com_vel = segment_sum(momenta, mol_idx, num_mols) / segment_sum(masses, mol_idx, num_mols)
+    new_momenta = momenta - masses * com_vel[mol_idx]
+    if preserve_temperature:
+        new_momenta = preserve_kinetic_energy(momenta, new_momenta, masses, mol_idx, num_mols)
+    return new_momenta
+
+
+def batch_zero_rotation(
+    positions: torch.Tensor,
+    momenta: torch.Tensor,
+    masses: torch.Tensor,
+    mol_idx: torch.Tensor,
+    num_mols: int,
+    preserve_temperature: bool = True,
+) -> torch.Tensor:
+    """Batched version of ASE's `ZeroRotation`, which removes the rigid rotation
+    of every molecule.
+
+    Args:
+        positions (torch.Tensor): positions of all atoms, (N, 3)
+        momenta (torch.Tensor): momenta of all atoms, (N, 3)
+        masses (torch.Tensor): masses of all atoms, (N, 1)
+        mol_idx (torch.Tensor): index of the molecule of each atom, (N,)
+        num_mols (int): number of molecules
+        preserve_temperature (bool): rescale the momenta of each molecule to
+            keep its kinetic energy
+
+    Returns:
+        torch.Tensor: new momenta
+    """
+    com = segment_sum(masses * positions, mol_idx, num_mols) / segment_sum(masses, mol_idx, num_mols)
+    rel_pos = positions - com[mol_idx]
+    ang_mom = segment_sum(torch.cross(rel_pos, momenta, dim=-1), mol_idx, num_mols)
+
+    eye = torch.eye(3, dtype=positions.dtype, device=positions.device)
+    outer = rel_pos.unsqueeze(-1) * rel_pos.unsqueeze(-2)
+    inertia = masses.unsqueeze(-1) * ((rel_pos**2).sum(-1).reshape(-1, 1, 1) * eye - outer)
+    inertia = segment_sum(inertia, mol_idx, num_mols)
+
+    # angular velocity from the principal moments, skipping zero moments
+    # (e.g. the axis of a linear molecule)
+    moments, axes = torch.linalg.eigh(inertia)
+    ang_mom_principal = (axes.transpose(-1, -2) @ ang_mom.unsqueeze(-1)).squeeze(-1)
+    omega_principal = torch.where(
+        moments > 1e-10, ang_mom_principal / moments.clamp(min=1e-10), torch.zeros_like(moments)
+    )
+    omega = (axes @ omega_principal.unsqueeze(-1)).squeeze(-1)
+
+    new_momenta = momenta - masses * torch.cross(omega[mol_idx], rel_pos, dim=-1)
+    if preserve_temperature:
+        new_momenta = preserve_kinetic_energy(momenta, new_momenta, masses, mol_idx, num_mols)
+    return new_momenta
+
+
 class BatchLangevin(MolecularDynamics):
+    """Langevin dynamics of a batch of molecules in an `AtomsBatch`. Positions,
+    momenta, masses and the mask of fixed atoms are kept as tensors on the
+    device of the calculator, and per-molecule operations use segment sums
+    over `num_atoms`. With a `NeuralFF` calculator the model is called
+    directly, and the ASE atoms are only updated when an observer (logger,
+    trajectory) needs them, or when the neighbor list has to be rebuilt.
+    Other calculators are called through ASE at every step.
+    """
+
     def __init__(
         self,
         atoms,
@@ -468,6 +579,7 @@ class BatchLangevin(MolecularDynamics):
                 np.random.set_state(random_seed)
             except BaseException as e:
                 raise ValueError("\tThe provided seed was neither an int nor a state of numpy random") from e
+            random_seed = np.random.randint(2147483647)
 
         MolecularDynamics.__init__(
             self,
@@ -479,25 +591,30 @@ class BatchLangevin(MolecularDynamics):
             append_trajectory=append_trajectory,
         )
 
+        self.device = getattr(atoms.calc, "device", "cpu")
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(random_seed)
+
         # Initialize simulation parameters
         # convert units
         self.dt = timestep * units.fs
         self.T = temperature
-        self.Natom = len(atoms)
-
-        batch = atoms.get_batch()
 
         # Check for number of virtual variables
-        if batch.get("num_atoms", None) is not None:
-            self.Natom = batch.get("num_atoms", None).numpy()
-            self.n_sys = self.Natom.shape[0]
-        else:
-            self.n_sys = 1
+        num_atoms = getattr(atoms, "props", {}).get("num_atoms", None)
+        if num_atoms is None:
+            num_atoms = torch.LongTensor([len(atoms)])
+        self.Natom = torch.as_tensor(num_atoms).reshape(-1).numpy()
+        self.n_sys = self.Natom.shape[0]
+        self.mol_idx = torch.repeat_interleave(
+            torch.arange(self.n_sys, device=self.device), torch.as_tensor(self.Natom, device=self.device)
+        )
+
+        self.masses = torch.tensor(self.atoms.get_masses(), dtype=torch.float64, device=self.device).reshape(-1, 1)
+        self.free_mask = self.get_free_mask()
 
         self.friction = friction_per_ps * 1.0e-3 / units.fs
-        self.rand_push = np.sqrt(self.T * self.friction * self.dt * units.kB / 2.0e0) / np.sqrt(
-            self.atoms.get_masses().reshape(-1, 1)
-        )
+        self.rand_push = torch.sqrt(self.T * self.friction * self.dt * units.kB / 2.0e0 / self.masses)
         self.prefac1 = 2.0 / (2.0 + self.friction * self.dt)
         self.prefac2 = (2.0e0 - self.friction * self.dt) / (2.0e0 + self.friction * self.dt)
 
@@ -507,33 +624,36 @@ class BatchLangevin(MolecularDynamics):
 
         self.nbr_update_period = nbr_update_period
 
+        self.positions = None
+        self.forces = None
+        self.energy = None
+        self.batch = None
+        self.nbr_ref_positions = None
+
         # initial Maxwell-Boltmann temperature for atoms
         if maxwell_temp is None:
             maxwell_temp = self.T
 
         # intialize system momentum
-        momenta = []
-        # split AtomsBatch into separate Atoms objects
-        for atoms in self.atoms.get_list_atoms():
-            # set MaxwellBoltzmannDistribution for each Atoms objects separately
-            MaxwellBoltzmannDistribution(atoms, temperature_K=maxwell_temp)
-            Stationary(atoms)  # zero linear momentum
-            ZeroRotation(atoms)
-            self.remove_constrained_vel(atoms)
-            # set momenta for the individual Atoms objects within the AtomsBatch
-            momenta.append(atoms.get_momenta())
-
-        momenta = np.concatenate(momenta)
-        self.atoms.set_momenta(momenta)
-
-    def remove_constrained_vel(self, atoms):
+        positions = self.get_tensor(self.atoms.get_positions())
+        noise = torch.randn(positions.shape, generator=self.generator, device=self.device, dtype=torch.float64)
+        momenta = noise * torch.sqrt(self.masses * maxwell_temp * units.kB)
+        momenta = batch_stationary(momenta, self.masses, self.mol_idx, self.n_sys)
+        momenta = batch_zero_rotation(positions, momenta, self.masses, self.mol_idx, self.n_sys)
+        self.momenta = momenta * self.free_mask
+        self.atoms.set_momenta(self.momenta.cpu().numpy())
+
+    def get_tensor(self, array):
+        return torch.tensor(np.asarray(array), dtype=torch.float64, device=self.device)
+
+    def get_free_mask(self):
         """
-        Set the initial velocity to zero for any constrained or fixed atoms
+        Mask that is zero for any constrained or fixed atoms, whose velocities
+        are always set to zero
         """
 
-        constraints = atoms.constraints
         fixed_idx = []
-        for constraint in constraints:
+        for constraint in self.atoms.constraints:
             has_keys = False
             keys = ["idx", "indices", "index"]
             for key in keys:
@@ -547,50 +667,100 @@ class BatchLangevin(MolecularDynamics):
                     "%s; do not know how to find its fixed indices." % constraint
                 )
 
-        if not fixed_idx:
-            return
+        mask = torch.ones_like(self.masses)
+        if fixed_idx:
+            mask[torch.LongTensor(list(set(fixed_idx)))] = 0
 
-        fixed_idx = np.array(list(set(fixed_idx)))
-        vel = self.atoms.get_velocities()
-        vel[fixed_idx] = 0
-        self.atoms.set_velocities(vel)
+        return mask
 
-    def step(self):
-        vel = self.atoms.get_velocities()
-        masses = self.atoms.get_masses().reshape(-1, 1)
+    @property
+    def direct_model(self):
+        """Whether the model of the calculator can be called directly. Constraints
+        other than fixed atoms and calculators that change `calculate` (e.g. biased
+        calculators) need the ASE interface.
+        """
+        calc = self.atoms.calc
+        if not isinstance(calc, NeuralFF) or type(calc).calculate is not NeuralFF.calculate:
+            return False
+        return all(isinstance(constraint, FixAtoms) for constraint in self.atoms.constraints)
 
-        self.rand_gauss = np.random.randn(self.atoms.get_positions().shape[0], self.atoms.get_positions().shape[1])
+    def update_batch(self):
+        """Rebuild the neighbor list and the batch from the positions in the ASE atoms."""
+        self.atoms.update_nbr_list()
+        self.batch = batch_to(self.atoms.get_batch(), self.device)
+        self.nbr_ref_positions = self.positions.clone()
+
+    def compute_forces(self):
+        if not self.direct_model:
+            # the constraints may adjust the positions
+            self.atoms.set_positions(self.positions.cpu().numpy())
+            self.positions = self.get_tensor(self.atoms.get_positions())
+            self.forces = self.get_tensor(self.atoms.get_forces())
+            self.energy = None
+            return
 
-        vel += self.rand_push * self.rand_gauss
-        vel += 0.5e0 * self.dt * self.atoms.get_forces() / masses
-        vel *= self.prefac1
-        self.atoms.set_velocities(vel)
+        displacement = (self.positions - self.nbr_ref_positions).norm(dim=-1)
+        if displacement.max() > 0.5 * self.atoms.cutoff_skin:
+            self.atoms.set_positions(self.positions.cpu().numpy())
+            self.update_batch()
+
+        nxyz = self.batch["nxyz"]
+        self.batch["nxyz"] = torch.cat([nxyz[:, :1], self.positions.to(nxyz.dtype)], dim=-1)
+        energy, forces = self.atoms.calc.predict(self.batch)
+        self.energy = energy.to(torch.float64)
+        self.forces = forces.to(torch.float64)
+
+    def observers_due(self, step):
+        """Whether ASE calls any observers after `step`, using the same logic as
+        `Dynamics.call_observers`."""
+        for _, interval, _, _ in self.observers:
+            if interval > 0 and step % interval == 0:
+                return True
+            if interval <= 0 and step == abs(interval):
+                return True
+        return False
+
+    def sync_atoms(self):
+        """Write the tensor state to the ASE atoms. The energy and forces are stored
+        in the calculator too, so that loggers don't compute them again."""
+        self.atoms.set_positions(self.positions.cpu().numpy())
+        self.atoms.set_momenta(self.momenta.cpu().numpy())
+        if self.energy is None:
+            return
 
-        momenta = []
-        for atoms in self.atoms.get_list_atoms():
-            self.remove_constrained_vel(atoms)
-            momenta.append(atoms.get_momenta())
-        momenta = np.concatenate(momenta)
-        self.atoms.set_momenta(momenta)
+        calc = self.atoms.calc
+        calc.results = {"energy": self.energy.cpu().numpy(), "forces": self.forces.cpu().numpy()}
+        calc.atoms = self.atoms.copy()
+        self.atoms.results = calc.results.copy()
 
-        vel = self.atoms.get_velocities()
-        x = self.atoms.get_positions() + self.dt * vel
+    def load_atoms(self):
+        """Read the state of the ASE atoms, which may have been changed between runs."""
+        self.positions = self.get_tensor(self.atoms.get_positions())
+        self.momenta = self.get_tensor(self.atoms.get_momenta()) * self.free_mask
+        if self.direct_model:
+            self.update_batch()
+        self.compute_forces()
 
-        # update positions
-        self.atoms.set_positions(x)
+    def step(self):
+        vel = self.momenta / self.masses
+        rand_gauss = torch.randn(vel.shape, generator=self.generator, device=self.device, dtype=vel.dtype)
 
-        vel *= self.prefac2 / self.prefac1
-        vel += self.rand_push * self.rand_gauss
-        vel += 0.5e0 * self.dt * self.atoms.get_forces() / masses
+        vel = vel + self.rand_push * rand_gauss
+        vel = vel + 0.5e0 * self.dt * self.forces / self.masses
+        vel = vel * self.prefac1 * self.free_mask
 
-        self.atoms.set_velocities(vel)
+        # update positions
+        self.positions = self.positions + self.dt * vel
+        self.compute_forces()
 
-        momenta = []
-        for atoms in self.atoms.get_list_atoms():
-            self.remove_constrained_vel(atoms)
-            momenta.append(atoms.get_momenta())
-        momenta = np.concatenate(momenta)
-        self.atoms.set_momenta(momenta)
+        vel = vel * self.prefac2 / self.prefac1
+        vel = vel + self.rand_push * rand_gauss
+        vel = vel + 0.5e0 * self.dt * self.forces / self.masses
+        self.momenta = vel * self.masses * self.free_mask
+
+        step = self.nsteps + 1
+        if step >= self.max_steps or self.observers_due(step):
+            self.sync_atoms()
 
     def run(self, steps=None):
         if steps is None:
@@ -601,20 +771,17 @@ class BatchLangevin(MolecularDynamics):
         steps_per_epoch = int(steps / epochs)
         # maximum number of steps starts at `steps_per_epoch`
         # and increments after every nbr list update
-        self.atoms.update_nbr_list()
+        self.load_atoms()
+        self.sync_atoms()
 
         for _ in tqdm(range(epochs)):
             self.max_steps += steps_per_epoch
             run_with_ase_check(self, steps_per_epoch)
-            self.atoms.update_nbr_list()
 
-            momenta = []
-            for atoms in self.atoms.get_list_atoms():
-                Stationary(atoms)
-                ZeroRotation(atoms)
-                momenta.append(atoms.get_momenta())
-            momenta = np.concatenate(momenta)
-            self.atoms.set_momenta(momenta)
+            momenta = batch_stationary(self.momenta, self.masses, self.mol_idx, self.n_sys)
+            momenta = batch_zero_rotation(self.positions, momenta, self.masses, self.mol_idx, self.n_sys)
+            self.momenta = momenta * self.free_mask
+            self.atoms.set_momenta(self.momenta.cpu().numpy())
 
 
 class VRescale(MolecularDynamics):
@@ -772,7 +939,7 @@ class VRescale(MolecularDynamics):
         for _ in tqdm(range(epochs)):
             self.max_steps += steps_per_epoch
             run_with_ase_check(self, steps_per_epoch)
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
             Stationary(self.atoms)
             ZeroRotation(self.atoms)
 
@@ -864,7 +1031,7 @@ class NoseHooverMetadynamics(NoseHoover):
             # reset the masses
             self.decrease_h_mass()
 
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
 
             if self.nsteps >= steps_until_add:
                 self.append_atoms()
@@ -1004,7 +1171,7 @@ class BatchNoseHoover(MolecularDynamics):
         for _ in range(epochs):
             self.max_steps += steps_per_epoch
             run_with_ase_check(self, steps_per_epoch)
-            self.atoms.update_nbr_list()
+            self.atoms.update_nbr_list_if_needed()
 
 
 class BatchMDLogger(MDLogger):
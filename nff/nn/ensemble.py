@@ -0,0 +1,196 @@
+"""
+Vectorized evaluation of model ensembles. The parameters of all members are
+stacked with `torch.func.stack_module_state`, and a single `vmap`-ed forward
+pass evaluates every member on the same batch and neighbor list. Forces come
+from one backward pass, because each member gets its own copy of the
+coordinates.
+"""
+
+import copy
+import warnings
+
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+from nff.nn.modules.schnet import get_offsets
+
+
+class EnsembleExecutor:
+    """Evaluates an ensemble of models with the same architecture on a shared batch.
+
+    If the members can't be vectorized (e.g. different architectures, stress
+    or embedding requests, or operations that `vmap` doesn't support), the
+    members are called one after the other instead.
+
+    Attributes:
+        models (list[torch.nn.Module]): ensemble members
+        vectorized (bool): whether to try the vectorized path
+        en_key (str): key of the energy, whose gradient gives the forces
+    """
+
+    def __init__(self, models, vectorized=True, en_key="energy"):
+        self.models = models
+        self.en_key = en_key
+        self.vectorized = vectorized and self.can_stack(models)
+        self.params = None
+        self.buffers = None
+        self.base_model = None
+        if self.vectorized:
+            self.stack()
+
+    @staticmethod
+    def can_stack(models):
+        """Whether the parameters of the models can be stacked.
+
+        Args:
+            models (list[torch.nn.Module]): ensemble members
+
+        Returns:
+            bool: True if all models have the same class and parameter shapes
+        """
+        if len(models) < 2 or len({type(model) for model in models}) > 1:
+            return False
+        shapes = [{key: val.shape for key, val in model.state_dict().items()} for model in models]
+        return all(shape == shapes[0] for shape in shapes)
+
+    def stack(self):
+        """Stack the parameters and buffers of the members. Needs to be called
+        again if the members are moved or their parameters change."""
+        params, buffers = stack_module_state(self.models)
+        self.params = {key: val.detach() for key, val in params.items()}
+        self.buffers = buffers
+
+        # stateless copy of the architecture, whose gradients we compute ourselves
+        self.base_model = copy.deepcopy(self.models[0]).to("meta")
+        if hasattr(self.base_model, "grad_keys"):
+            self.base_model.grad_keys = []
+
+    def to(self, device):
+        for model in self.models:
+            model.to(device)
+        if self.vectorized:
+            self.stack()
+
+    def get_cutoff(self):
+        model = self.models[0]
+        if hasattr(model, "set_cutoff"):
+            model.set_cutoff()
+        return getattr(model, "cutoff", None)
+
+    def use_vectorized(self, kwargs):
+        if not self.vectorized:
+            return False
+        if kwargs.get("requires_stress", False) or kwargs.get("requires_embedding", False):
+            return False
+        return self.get_cutoff() is not None
+
+    def trim_batch(self, batch, xyz):
+        """
+        Restrict the neighbor list to pairs within the cutoff. Models normally
+        do this in `get_rij` with a boolean mask, which `vmap` can't batch.
+        Since all members share the geometry it can be done once beforehand.
+        Args:
+            batch (dict): batch of data
+            xyz (torch.Tensor): coordinates
+        Returns:
+            batch (dict): shallow copy of the batch with the trimmed neighbor list
+        """
+        nbrs = batch["nbr_list"]
+        offsets = get_offsets(batch, "offsets")
+        dist = (xyz[nbrs[:, 1]] - xyz[nbrs[:, 0]] + offsets).detach().norm(dim=-1)
+        keep = dist <= self.get_cutoff()
+
+        batch = batch.copy()
+        batch["nbr_list"] = nbrs[keep]
+        if offsets.dim() == 2 and offsets.shape[0] == keep.shape[0]:
+            batch["offsets"] = offsets[keep]
+        batch["nbrs_in_cutoff"] = True
+
+        return batch
+
+    def run_vectorized(self, batch, **kwargs):
+        xyz = batch["nxyz"][:, 1:].detach()
+        batch = self.trim_batch(batch, xyz)
+
+        def call_member(params, buffers, member_xyz):
+            results = functional_call(self.base_model, (params, buffers), (batch,), {"xyz": member_xyz, **kwargs})
+            return results[self.en_key]
+
+        num_models = len(self.models)
+        member_xyz = xyz.expand(num_models, -1, -1).clone().requires_grad_(True)
+        energy = vmap(call_member, in_dims=(0, 0, 0))(self.params, self.buffers, member_xyz)
+        (energy_grad,) = torch.autograd.grad(energy.sum(), member_xyz)
+
+        return {self.en_key: energy.detach(), f"{self.en_key}_grad": energy_grad}
+
+    def try_vectorized(self, batch, kwargs):
+        """Run the vectorized path if possible, and otherwise return None."""
+        if not self.use_vectorized(kwargs):
+            return None
+        try:
+            return self.run_vectorized(batch, **kwargs)
+        except (RuntimeError, TypeError) as err:
+            # e.g. an operation that `vmap` can't batch, or a model whose
+            # forward doesn't take `xyz`
+            warnings.warn(f"Couldn't vectorize the ensemble ({err}); evaluating the members one by one.", stacklevel=3)
+            self.vectorized = False
+            return None
+
+    def members(self, batch, **kwargs):
+        """
+        Evaluate all members and return their results separately.
+        Args:
+            batch (dict): batch of data
+            **kwargs: keyword arguments for the models
+        Returns:
+            results (list[dict]): results of each member
+        """
+        results = self.try_vectorized(batch, kwargs)
+        if results is not None:
+            return [{key: val[i] for key, val in results.items()} for i in range(len(self.models))]
+
+        return [model(batch, **kwargs) for model in self.models]
+
+    def run(self, batch, **kwargs):
+        """
+        Evaluate all members.
+        Args:
+            batch (dict): batch of data
+            **kwargs: keyword arguments for the models
+        Returns:
+            results (dict): the energy and its gradient of each member, stacked
+                along the first dimension. In the sequential case, any other
+                output with the same shape for every member is stacked too.
+        """
+        results = self.try_vectorized(batch, kwargs)
+        if results is not None:
+            return results
+
+        outputs = [model(batch, **kwargs) for model in self.models]
+        results = {}
+        for key, val in outputs[0].items():
+            vals = [output.get(key) for output in outputs]
+            if all(isinstance(v, torch.Tensor) and v.shape == val.shape for v in vals):
+                results[key] = torch.stack(vals)
+
+        return results
+
+    def __call__(self, batch, **kwargs):
+        """
+        Evaluate all members.
+        Args:
+            batch (dict): batch of data
+            **kwargs: keyword arguments for the models
+        Returns:
+            results (dict): stacked results of the members as in `run`, plus the
+                mean and variance over the members of the energy and its gradient
+                (e.g. `energy_mean` and `energy_grad_var`)
+        """
+        results = self.run(batch, **kwargs)
+        for key in [self.en_key, f"{self.en_key}_grad"]:
+            if key not in results:
+                continue
+            results[f"{key}_mean"] = results[key].mean(0)
+            results[f"{key}_var"] = results[key].var(0, unbiased=False)
+
+        return results
@@ -124,7 +124,8 @@ class Dense(nn.Linear):
         Returns:
             torch.Tensor: Output of the dense layer.
         """
-        self.to(inputs.device)
+        if self.weight.device != inputs.device:
+            self.to(inputs.device)
         y = super().forward(inputs)
 
         # kept for compatibility with earlier versions of nff
@@ -494,7 +495,7 @@ class CosineEnvelope(nn.Module):
     def forward(self, d):
         output = 0.5 * (torch.cos(np.pi * d / self.cutoff) + 1)
         exclude = d >= self.cutoff
-        output[exclude] = 0
+        output = torch.where(exclude, torch.zeros_like(output), output)
 
         return output
 
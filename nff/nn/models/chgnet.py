@@ -17,7 +17,7 @@ except ImportError:
 from chgnet.model import CHGNet
 from torch import Tensor, nn
 
-from nff.io.chgnet import convert_data_batch
+from nff.io.chgnet import batch_to_crystal_graphs, convert_data_batch
 from nff.utils.misc import cat_props
 
 if TYPE_CHECKING:
@@ -58,6 +58,7 @@ class CHGNetNFF(CHGNet):
         self.units = units
         self.device = device
         self.requires_embedding = requires_embedding
+        self.graph_cache = {}
 
         if not key_mappings:
             # map from CHGNet keys to NFF keys
@@ -77,7 +78,9 @@ class CHGNetNFF(CHGNet):
                 param.requires_grad = True
 
     def forward(self, data_batch: Dict[str, List], **kwargs) -> Dict[str, Tensor | List]:
-        """Convert data_batch to CHGNet format and run forward pass.
+        """Convert data_batch to CHGNet format and run forward pass. If the batch has a
+        neighbor list and a lattice, the crystal graphs are built from the neighbor list
+        directly and their static parts are cached between calls.
 
         Args:
             data_batch (Dict[str, List]): A dictionary of properties for each structure in the batch.
@@ -99,11 +102,21 @@ class CHGNetNFF(CHGNet):
                                         np.array([[0, 0, 0], [0.1, 0.2, 0.3]])],
                 }
         """
-        chgnet_data_batch = convert_data_batch(
-            data_batch, cutoff=self.cutoff, shuffle=False
-        )  # shuffle=False to keep the order of the structures
+        if "nbr_list" in data_batch and ("lattice" in data_batch or "cell" in data_batch):
+            if getattr(self, "graph_cache", None) is None:  # models pickled before the cache existed
+                self.graph_cache = {}
+            graphs = batch_to_crystal_graphs(
+                data_batch,
+                atom_graph_cutoff=self.graph_converter.atom_graph_cutoff,
+                bond_graph_cutoff=self.graph_converter.bond_graph_cutoff,
+                cache=self.graph_cache,
+            )
+        else:
+            chgnet_data_batch = convert_data_batch(
+                data_batch, cutoff=self.cutoff, shuffle=False
+            )  # shuffle=False to keep the order of the structures
 
-        graphs, targets = collate_graphs(chgnet_data_batch)
+            graphs, targets = collate_graphs(chgnet_data_batch)
 
         graphs = [graph.to(self.device) for graph in graphs]
 
@@ -4,6 +4,7 @@ import numpy as np
 import torch
 from torch import nn
 
+from nff.data.graphs import get_batch_angle_list
 from nff.nn.layers import DimeNetRadialBasis as RadialBasis
 from nff.nn.layers import DimeNetSphericalBasis as SphericalBasis
 from nff.nn.modules.diabat import DiabaticReadout
@@ -169,19 +170,25 @@ class DimeNet(nn.Module):
         """
 
         nbr_list = batch["nbr_list"]
-        angle_list = batch["angle_list"]
         nxyz = batch["nxyz"]
         num_atoms = batch["num_atoms"].sum()
 
+        # generate the triplets on the fly if they weren't stored in the dataset.
+        # They aren't written into the batch, which may be reused after its
+        # neighbor list has been rebuilt (e.g. `AtomsBatch.props` in MD)
+        if "angle_list" in batch:
+            angle_list = batch["angle_list"]
+            ji_idx = batch["ji_idx"]
+            kj_idx = batch["kj_idx"]
+        else:
+            angle_list, ji_idx, kj_idx = get_batch_angle_list(nbr_list, num_atoms=len(nxyz))
+
         z = nxyz[:, 0].long()
         if xyz is None:
             xyz = nxyz[:, 1:]
             if xyz.is_leaf:
                 xyz.requires_grad = True
 
-        ji_idx = batch["ji_idx"]
-        kj_idx = batch["kj_idx"]
-
         # compute distances
         d = torch.norm(xyz[nbr_list[:, 0]] - xyz[nbr_list[:, 1]], dim=-1).reshape(-1, 1)
 
@@ -3,10 +3,10 @@ Models with added empirical dispersion on top
 """
 
 import numpy as np
-import torch
 from torch import nn
 
 from nff.nn.models.painn import Painn, PainnDiabat, add_stress
+from nff.nn.modules.schnet import get_virials
 from nff.utils import constants as const
 from nff.utils.dispersion import get_dispersion as base_dispersion
 from nff.utils.dispersion import grimme_dispersion
@@ -109,18 +109,9 @@ class PainnDispersion(nn.Module):
             # add gradient for stress
             disp_rij_grad = compute_grad(inputs=r_ij_T, output=e_disp)
 
-            if batch["num_atoms"].shape[0] == 1:
-                disp_stress_volume = torch.matmul(disp_rij_grad.t(), r_ij_T)
-            else:
-                allstress = torch.stack([
-                    torch.matmul(
-                        disp_rij_grad[torch.where(nbrs_T[:, 0] == j)].t(), r_ij_T[torch.where(nbrs_T[:, 0] == j)]
-                    )
-                    for j in range(batch["nxyz"].shape[0])
-                ])
-                N = batch["num_atoms"].detach().cpu().tolist()
-                split_val = torch.split(allstress, N)
-                disp_stress_volume = torch.stack([i.sum(0) for i in split_val])
+            disp_stress_volume = get_virials(
+                grad_rij=disp_rij_grad, r_ij=r_ij_T, nbrs=nbrs_T, num_atoms=batch["num_atoms"]
+            )
             if inference:
                 disp_stress_volume = disp_stress_volume.detach().cpu()
 
@@ -23,6 +23,7 @@ from mace.tools import torch_tools
 # from mace.tools.torch_geometric.batch import Batch
 from nff.io.mace import (
     NffBatch,
+    batch_to_mace_data,
     get_atomic_number_table_from_zs,
     get_init_kwargs_from_model,
     get_mace_mp_model_path,
@@ -59,6 +60,7 @@ class NffScaleMACE(ScaleShiftMACE):
         kwargs.setdefault("radial_MLP", kwargs.pop("radial_MLP", [64, 64, 64]))
 
         super().__init__(**kwargs)
+        self.graph_cache = {}
 
     def forward(
         self,
@@ -101,9 +103,11 @@ class NffScaleMACE(ScaleShiftMACE):
         output.update({"energy_grad": -forces})
         return output
 
-    def convert_batch_to_data(self, batch: dict) -> torch_geometric.data.Data:
-        """Convert Batch object to a torch geometric data object
-        that is used in the MACE model
+    def convert_batch_to_data(self, batch: dict) -> dict | torch_geometric.data.Data:
+        """Convert Batch object to the inputs of the MACE model. If the batch
+        has a neighbor list, the graph is built from it on the device of the
+        batch, and its static parts are cached between calls. Otherwise the
+        neighbors are computed for each structure with `AtomicData.from_config`.
 
         Args:
             batch (dict): a batch object that contains the properties. This
@@ -114,12 +118,31 @@ class NffScaleMACE(ScaleShiftMACE):
             ValueError: raised if no cell or lattice is found in the batch
 
         Returns:
-            torch_geometric.data.Data: torch geometric data object
+            dict | torch_geometric.data.Data: inputs of the MACE model
         """
-        if isinstance(batch, dict):
-            props = batch
-        else:
+        if not isinstance(batch, dict):
             raise ValueError("Batch must be a dictionary")
+        if "nbr_list" not in batch:
+            return self.convert_configs_to_data(batch)
+
+        if getattr(self, "graph_cache", None) is None:  # models pickled before the cache existed
+            self.graph_cache = {}
+        z_table = AtomicNumberTable([int(z) for z in self.atomic_numbers])
+        return batch_to_mace_data(batch, z_table=z_table, r_max=float(self.r_max), cache=self.graph_cache)
+
+    def convert_configs_to_data(self, props: dict) -> torch_geometric.data.Data:
+        """Convert Batch object to a torch geometric data object by computing
+        the neighbors of each structure from scratch
+
+        Args:
+            props (dict): a batch object that contains the properties
+
+        Raises:
+            ValueError: raised if no cell or lattice is found in the batch
+
+        Returns:
+            torch_geometric.data.Data: torch geometric data object
+        """
         num_atoms = props["num_atoms"].unsqueeze(0) if props["num_atoms"].dim() == 0 else props["num_atoms"]
         cum_idx_list = [0, *torch.cumsum(num_atoms, 0).tolist()]
         z_table = AtomicNumberTable([int(z) for z in self.atomic_numbers])
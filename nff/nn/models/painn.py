@@ -7,6 +7,7 @@ from torch import nn
 from nff.nn.layers import Diagonalize, ExpNormalBasis
 from nff.nn.modules.diabat import AdiabaticReadout, DiabaticReadout
 from nff.nn.modules.painn import (
+    EdgeGeometry,
     EmbeddingBlock,
     MessageBlock,
     NbrEmbeddingBlock,
@@ -24,10 +25,11 @@ from nff.nn.modules.schnet import (
     SumPool,
     add_embedding,
     add_stress,
+    get_offsets,
     get_rij,
 )
-from nff.utils.scatter import compute_grad, scatter_add
-from nff.utils.tools import make_directed
+from nff.utils.scatter import compute_grad, inference_mode, is_inference_mode, scatter_add
+from nff.utils.tools import make_directed, same_tensor
 
 POOL_DIC = {
     "sum": SumPool,
@@ -119,6 +121,16 @@ class Painn(nn.Module):
 
         self.compute_delta = modelparams.get("compute_delta", False)
         self.cutoff = cutoff
+        # extra distance beyond the cutoff for which edges are kept, so that the
+        # same edges can be reused until an atom has moved by half of it
+        self.edge_skin = modelparams.get("edge_skin", 0.0)
+        self.edge_cache = {}
+
+    def __getstate__(self):
+        # the cached edges belong to the last batch, so they aren't saved or copied
+        state = self.__dict__.copy()
+        state["edge_cache"] = {}
+        return state
 
     def set_cutoff(self):
         if hasattr(self, "cutoff"):
@@ -127,12 +139,94 @@ class Painn(nn.Module):
         dist_embed = msg.inv_message.dist_embed
         self.cutoff = dist_embed.f_cut.cutoff
 
+    def get_edge_skin(self):
+        """
+        Skin used to reuse the edges between calls. It's only used in inference,
+        and only with the standard message blocks, whose messages vanish at the
+        cutoff, so that the extra edges don't change the results. The excluded
+        volume term has no envelope, so it needs the edges within the cutoff.
+        """
+        if self.training or not all(type(block) is MessageBlock for block in self.message_blocks):
+            return 0.0
+        if getattr(self, "excl_vol", False):
+            return 0.0
+        return getattr(self, "edge_skin", 0.0)
+
+    def get_edges(self, batch, xyz):
+        """
+        Get the directed edges within the cutoff and their vectors r_ij. The
+        directed neighbor list and the offsets are cached until the neighbor
+        list changes, e.g. between MD steps. With an `edge_skin`, the edges
+        within `cutoff + edge_skin` are cached as well, and reused until an atom
+        has moved by more than half the skin.
+        Args:
+            batch (dict): batch of data
+            xyz (torch.Tensor): coordinates
+        Returns:
+            r_ij (torch.Tensor): vectors r_j - r_i of the edges
+            nbrs (torch.Tensor): directed edges
+        """
+        self.set_cutoff()
+
+        # the neighbor list has already been restricted to the cutoff (e.g. by
+        # `nff.nn.ensemble.EnsembleExecutor`), possibly for batched coordinates
+        if batch.get("nbrs_in_cutoff", False):
+            nbrs, _ = make_directed(batch["nbr_list"])
+            return get_rij(xyz=xyz, batch=batch, nbrs=nbrs, cutoff=self.cutoff)
+
+        if getattr(self, "edge_cache", None) is None:
+            self.edge_cache = {}
+        cache = self.edge_cache
+
+        nbr_list = batch["nbr_list"]
+        # offsets may also be given as image shifts and cells
+        keys = {key: batch.get(key) for key in ["nbr_list", "offsets", "image_shifts"]}
+        if "image_shifts" in batch:
+            keys["lattice"] = torch.as_tensor(batch["lattice"] if "lattice" in batch else batch["cell"])
+        if not all(same_tensor(cache.get(key), val) for key, val in keys.items()):
+            cache.clear()
+            # copies, so that buffers refilled in place aren't mistaken for the cached inputs
+            cache.update({key: None if val is None else val.detach().clone() for key, val in keys.items()})
+            cache["all_nbrs"], _ = make_directed(nbr_list)
+            cache["all_offsets"] = get_offsets(batch, "offsets")
+
+        skin = self.get_edge_skin()
+        ref_xyz = cache.get("xyz")
+        if skin > 0 and ref_xyz is not None and ref_xyz.shape == xyz.shape:
+            displacement = (xyz.detach() - ref_xyz).norm(dim=-1)
+            if displacement.max() <= 0.5 * skin:
+                nbrs = cache["nbrs"]
+                r_ij = xyz[nbrs[:, 1]] - xyz[nbrs[:, 0]] + cache["nbr_offsets"]
+                return r_ij, nbrs
+
+        all_nbrs = cache["all_nbrs"]
+        all_offsets = cache["all_offsets"]
+        r_ij = xyz[all_nbrs[:, 1]] - xyz[all_nbrs[:, 0]] + all_offsets
+
+        # remove nbr skin (extra distance added to cutoff
+        # to catch atoms that become neighbors between nbr
+        # list updates)
+        dist = (r_ij.detach() ** 2).sum(-1) ** 0.5
+        cutoff = self.cutoff
+        if isinstance(cutoff, torch.Tensor):
+            cutoff = cutoff.to(dist.device)
+        keep = torch.nonzero(dist <= cutoff + skin).reshape(-1)
+        r_ij = r_ij[keep]
+        nbrs = all_nbrs[keep]
+
+        if skin > 0:
+            per_edge = all_offsets.dim() == 2 and all_offsets.shape[0] == all_nbrs.shape[0]
+            cache["nbrs"] = nbrs
+            cache["nbr_offsets"] = all_offsets[keep] if per_edge else all_offsets
+            cache["xyz"] = xyz.detach().clone()
+
+        return r_ij, nbrs
+
     def atomwise(self, batch, xyz=None):
         # for backwards compatability
         if isinstance(self.skip, bool):
             self.skip = {key: self.skip for key in self.output_keys}
 
-        nbrs, _ = make_directed(batch["nbr_list"])
         nxyz = batch["nxyz"]
 
         if xyz is None:
@@ -143,15 +237,15 @@ class Painn(nn.Module):
 
         # get r_ij including offsets and excluding
         # anything in the neighbor skin
-        self.set_cutoff()
-        r_ij, nbrs = get_rij(xyz=xyz, batch=batch, nbrs=nbrs, cutoff=self.cutoff)
+        r_ij, nbrs = self.get_edges(batch=batch, xyz=xyz)
+        geom = EdgeGeometry(r_ij)
 
         s_i, v_i = self.embed_block(z_numbers, nbrs=nbrs, r_ij=r_ij)
         results = {}
 
         for i, message_block in enumerate(self.message_blocks):
             update_block = self.update_blocks[i]
-            ds_message, dv_message = message_block(s_j=s_i, v_j=v_i, r_ij=r_ij, nbrs=nbrs)
+            ds_message, dv_message = message_block(s_j=s_i, v_j=v_i, r_ij=r_ij, nbrs=nbrs, geom=geom)
 
             s_i = s_i + ds_message
             v_i = v_i + dv_message
@@ -297,17 +391,20 @@ class Painn(nn.Module):
         Call the model
         Args:
             batch (dict): batch dictionary
+            inference (bool): detach the results, and compute gradients
+                without a second-order graph (see `nff.utils.scatter.inference_mode`)
         Returns:
             results (dict): dictionary of predictions
         """
 
-        results, _ = self.run(
-            batch=batch,
-            xyz=xyz,
-            requires_embedding=requires_embedding,
-            requires_stress=requires_stress,
-            inference=inference,
-        )
+        with inference_mode(inference or is_inference_mode()):
+            results, _ = self.run(
+                batch=batch,
+                xyz=xyz,
+                requires_embedding=requires_embedding,
+                requires_stress=requires_stress,
+                inference=inference,
+            )
 
         return results
 
@@ -554,7 +651,6 @@ class Painn_VecOut(Painn):
         if isinstance(self.skip, bool):
             self.skip = {key: self.skip for key in self.output_keys}
 
-        nbrs, _ = make_directed(batch["nbr_list"])
         nxyz = batch["nxyz"]
 
         if xyz is None:
@@ -565,15 +661,15 @@ class Painn_VecOut(Painn):
 
         # get r_ij including offsets and excluding
         # anything in the neighbor skin
-        self.set_cutoff()
-        r_ij, nbrs = get_rij(xyz=xyz, batch=batch, nbrs=nbrs, cutoff=self.cutoff)
+        r_ij, nbrs = self.get_edges(batch=batch, xyz=xyz)
+        geom = EdgeGeometry(r_ij)
 
         s_i, v_i = self.embed_block(z_numbers, nbrs=nbrs, r_ij=r_ij)
         results = {}
 
         for i, message_block in enumerate(self.message_blocks):
             update_block = self.update_blocks[i]
-            ds_message, dv_message = message_block(s_j=s_i, v_j=v_i, r_ij=r_ij, nbrs=nbrs)
+            ds_message, dv_message = message_block(s_j=s_i, v_j=v_i, r_ij=r_ij, nbrs=nbrs, geom=geom)
 
             s_i = s_i + ds_message
             v_i = v_i + dv_message
@@ -767,7 +863,6 @@ class Painn_Complex(Painn):
         if isinstance(self.skip, bool):
             self.skip = {key: self.skip for key in self.output_keys}
 
-        nbrs, _ = make_directed(batch["nbr_list"])
         nxyz = batch["nxyz"]
 
         if xyz is None:
@@ -778,15 +873,15 @@ class Painn_Complex(Painn):
 
         # get r_ij including offsets and excluding
         # anything in the neighbor skin
-        self.set_cutoff()
-        r_ij, nbrs = get_rij(xyz=xyz, batch=batch, nbrs=nbrs, cutoff=self.cutoff)
+        r_ij, nbrs = self.get_edges(batch=batch, xyz=xyz)
+        geom = EdgeGeometry(r_ij)
 
         s_i, v_i = self.embed_block(z_numbers, nbrs=nbrs, r_ij=r_ij)
         results = {}
 
         for i, message_block in enumerate(self.message_blocks):
             update_block = self.update_blocks[i]
-            ds_message, dv_message = message_block(s_j=s_i, v_j=v_i, r_ij=r_ij, nbrs=nbrs)
+            ds_message, dv_message = message_block(s_j=s_i, v_j=v_i, r_ij=r_ij, nbrs=nbrs, geom=geom)
 
             s_i = s_i + ds_message
             v_i = v_i + dv_message
@@ -879,7 +974,6 @@ class Painn_Tuple(Painn):
         if isinstance(self.skip, bool):
             self.skip = {key: self.skip for key in self.output_keys}
 
-        nbrs, _ = make_directed(batch["nbr_list"])
         nxyz = batch["nxyz"]
 
         if xyz is None:
@@ -890,15 +984,15 @@ class Painn_Tuple(Painn):
 
         # get r_ij including offsets and excluding
         # anything in the neighbor skin
-        self.set_cutoff()
-        r_ij, nbrs = get_rij(xyz=xyz, batch=batch, nbrs=nbrs, cutoff=self.cutoff)
+        r_ij, nbrs = self.get_edges(batch=batch, xyz=xyz)
+        geom = EdgeGeometry(r_ij)
 
         s_i, v_i = self.embed_block(z_numbers, nbrs=nbrs, r_ij=r_ij)
         results = {}
 
         for i, message_block in enumerate(self.message_blocks):
             update_block = self.update_blocks[i]
-            ds_message, dv_message = message_block(s_j=s_i, v_j=v_i, r_ij=r_ij, nbrs=nbrs)
+            ds_message, dv_message = message_block(s_j=s_i, v_j=v_i, r_ij=r_ij, nbrs=nbrs, geom=geom)
 
             s_i = s_i + ds_message
             v_i = v_i + dv_message
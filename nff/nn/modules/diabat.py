@@ -163,7 +163,12 @@ class DiabaticReadout(nn.Module):
                 if grad_key in results:
                     grad = results[grad_key]
                 else:
-                    grad = compute_grad(inputs=xyz, output=results[diabat_key], allow_unused=True)
+                    grad = compute_grad(
+                        inputs=xyz,
+                        output=results[diabat_key],
+                        allow_unused=True,
+                        create_graph=False if inference else None,
+                    )
 
                 if inference:
                     grad = grad.detach()
@@ -249,7 +254,7 @@ class DiabaticReadout(nn.Module):
 
         for key in en_keys_for_grad:
             val = results[key]
-            grad = compute_grad(inputs=xyz, output=val, allow_unused=True)
+            grad = compute_grad(inputs=xyz, output=val, allow_unused=True, create_graph=False if inference else None)
             if inference:
                 grad = grad.detach()
             results[key + "_grad"] = grad
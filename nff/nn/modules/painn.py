@@ -27,6 +27,32 @@ def preprocess_r(r_ij):
     return dist, unit
 
 
+class EdgeGeometry:
+    """
+    Distances and unit vectors of the edges in one forward pass, together
+    with radial features of the distances (basis functions, cutoff envelopes).
+    They're computed once and shared by all message blocks.
+    """
+
+    def __init__(self, r_ij):
+        self.r_ij = r_ij
+        self.dist, self.unit = preprocess_r(r_ij)
+        self.features = {}
+
+    def get(self, key, layer):
+        """
+        Output of `layer` for the distances, computed the first time `key` is requested.
+        Args:
+            key (hashable): key that identifies the output of the layer
+            layer (callable): function of the distances
+        Returns:
+            torch.Tensor: features of the distances
+        """
+        if key not in self.features:
+            self.features[key] = layer(self.dist)
+        return self.features[key]
+
+
 def to_module(activation):
     return layer_types[activation]()
 
@@ -53,10 +79,21 @@ class DistanceEmbed(nn.Module):
         self.block = nn.Sequential(rbf, dense)
         self.f_cut = CosineEnvelope(cutoff=cutoff)
 
-    def forward(self, dist):
-        rbf_feats = self.block(dist)
-        envelope = self.f_cut(dist).reshape(-1, 1)
-        output = rbf_feats * envelope
+    def forward(self, dist, geom=None):
+        if geom is None:
+            rbf_feats = self.block(dist)
+            envelope = self.f_cut(dist).reshape(-1, 1)
+            return rbf_feats * envelope
+
+        # the basis and envelope are the same in every block, unless
+        # the frequencies of the basis are learned
+        rbf, dense = self.block
+        if isinstance(rbf.n, nn.Parameter):
+            rbf_out = rbf(geom.dist)
+        else:
+            rbf_out = geom.get(("rbf", rbf.n.shape[0], rbf.cutoff), rbf)
+        envelope = geom.get(("envelope", self.f_cut.cutoff), self.f_cut).reshape(-1, 1)
+        output = dense(rbf_out) * envelope
 
         return output
 
@@ -70,9 +107,9 @@ class InvariantMessage(nn.Module):
             n_rbf=n_rbf, cutoff=cutoff, feat_dim=feat_dim, learnable_k=learnable_k, dropout=dropout
         )
 
-    def forward(self, s_j, dist, nbrs):
+    def forward(self, s_j, dist, nbrs, geom=None):
         phi = self.inv_dense(s_j)[nbrs[:, 1]]
-        w_s = self.dist_embed(dist)
+        w_s = self.dist_embed(dist, geom=geom)
         output = phi * w_s
 
         # split into three components, so the tensor now has
@@ -85,9 +122,11 @@ class InvariantMessage(nn.Module):
 
 
 class MessageBase(nn.Module):
-    def forward(self, s_j, v_j, r_ij, nbrs):
-        dist, unit = preprocess_r(r_ij)
-        inv_out = self.inv_message(s_j=s_j, dist=dist, nbrs=nbrs)
+    def forward(self, s_j, v_j, r_ij, nbrs, geom=None, **kwargs):
+        if geom is None:
+            geom = EdgeGeometry(r_ij)
+        unit = geom.unit
+        inv_out = self.inv_message(s_j=s_j, dist=geom.dist, nbrs=nbrs, geom=geom)
 
         split_0 = inv_out[:, 0, :].unsqueeze(-1)
         split_1 = inv_out[:, 1, :]
@@ -119,27 +158,6 @@ class MessageBlock(MessageBase):
             dropout=dropout,
         )
 
-    def forward(self, s_j, v_j, r_ij, nbrs, **kwargs):
-        dist, unit = preprocess_r(r_ij)
-        inv_out = self.inv_message(s_j=s_j, dist=dist, nbrs=nbrs)
-
-        split_0 = inv_out[:, 0, :].unsqueeze(-1)
-        split_1 = inv_out[:, 1, :]
-        split_2 = inv_out[:, 2, :].unsqueeze(-1)
-
-        unit_add = split_2 * unit.unsqueeze(1)
-        delta_v_ij = unit_add + split_0 * v_j[nbrs[:, 1]]
-        delta_s_ij = split_1
-
-        # add results from neighbors of each node
-
-        graph_size = s_j.shape[0]
-        delta_v_i = scatter_add(src=delta_v_ij, index=nbrs[:, 0], dim=0, dim_size=graph_size)
-
-        delta_s_i = scatter_add(src=delta_s_ij, index=nbrs[:, 0], dim=0, dim_size=graph_size)
-
-        return delta_s_i, delta_v_i
-
 
 class InvariantTransformerMessage(nn.Module):
     def __init__(self, rbf, num_heads, feat_dim, activation, layer_norm):
@@ -149,7 +167,7 @@ class InvariantTransformerMessage(nn.Module):
         self.dense = Dense(in_features=(num_heads * feat_dim), out_features=(3 * feat_dim), bias=True, activation=None)
         self.layer_norm = nn.LayerNorm(feat_dim) if (layer_norm) else None
 
-    def forward(self, s_j, dist, nbrs):
+    def forward(self, s_j, dist, nbrs, **kwargs):
         inp = self.layer_norm(s_j) if self.layer_norm else s_j
         output = self.dense(self.msg_layer(dist=dist, nbrs=nbrs, x_i=inp))
         out_reshape = output.reshape(output.shape[0], 3, -1)
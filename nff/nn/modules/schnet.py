@@ -6,6 +6,7 @@ import torch.nn as nn
 from torch.nn import LeakyReLU, Linear, ModuleDict, ReLU, Sequential, Softmax
 from torch.nn.functional import softmax
 
+from nff.data.sparse import shifts_to_offsets
 from nff.nn.activations import shifted_softplus
 from nff.nn.graphconv import (
     EdgeUpdateModule,
@@ -31,6 +32,15 @@ DEFAULT_BONDPRIOR_PARAM = {"k": 20.0}
 def get_offsets(batch, key):
     nxyz = batch["nxyz"]
     zero = torch.Tensor([0]).to(nxyz.device)
+
+    # offsets stored as integer image shifts are rebuilt from the cell
+    if key == "offsets" and key not in batch and "image_shifts" in batch:
+        cell = batch["lattice"] if "lattice" in batch else batch["cell"]
+        cell = torch.as_tensor(cell).to(device=nxyz.device, dtype=nxyz.dtype)
+        return shifts_to_offsets(
+            batch["image_shifts"].to(nxyz.device), cell, nbr_list=batch["nbr_list"], num_atoms=batch["num_atoms"]
+        )
+
     offsets = batch.get(key, zero)
     if isinstance(offsets, torch.Tensor) and offsets.is_sparse:
         offsets = offsets.to_dense()
@@ -43,6 +53,11 @@ def get_rij(xyz, batch, nbrs, cutoff):
     # whereas for schnet we've coded it as r_i - r_j
     r_ij = xyz[nbrs[:, 1]] - xyz[nbrs[:, 0]] + offsets
 
+    # the neighbor list has already been restricted to the cutoff
+    # (e.g. by `nff.nn.ensemble.EnsembleExecutor`)
+    if batch.get("nbrs_in_cutoff", False):
+        return r_ij, nbrs
+
     # remove nbr skin (extra distance added to cutoff
     # to catch atoms that become neighbors between nbr
     # list updates)
@@ -62,25 +77,43 @@ def add_embedding(atomwise_out, all_results):
     return all_results
 
 
+def get_virials(grad_rij, r_ij, nbrs, num_atoms):
+    """
+    Virial of each structure, i.e. the sum of (dE/dr_ij)^T r_ij over its edges.
+    The edges are assigned to structures through their first atom and summed
+    with a scatter, so periodic and non-periodic structures can be mixed in a
+    batch (r_ij already contains the offsets of periodic images).
+    Args:
+        grad_rij (torch.Tensor): gradient of the energy with respect to r_ij
+        r_ij (torch.Tensor): vectors of the edges
+        nbrs (torch.Tensor): edges
+        num_atoms (torch.Tensor): number of atoms in each structure
+    Returns:
+        torch.Tensor: virials, of shape (3, 3) for a single structure and
+            (num_structures, 3, 3) otherwise
+    """
+    if num_atoms.shape[0] == 1:
+        return torch.matmul(grad_rij.t(), r_ij)
+
+    num_structures = num_atoms.shape[0]
+    mol_idx = torch.repeat_interleave(
+        torch.arange(num_structures, device=r_ij.device), num_atoms.to(r_ij.device)
+    )
+    edge_virials = (grad_rij.unsqueeze(-1) * r_ij.unsqueeze(-2)).reshape(-1, 9)
+    virials = scatter_add(src=edge_virials, index=mol_idx[nbrs[:, 0]], dim=0, dim_size=num_structures)
+
+    return virials.reshape(-1, 3, 3)
+
+
 def add_stress(batch, all_results, nbrs, r_ij):
     """
     Add stress as output. Needs to be divided by lattice volume to get actual stress.
-    For batching for loop seemed unavoidable. will change later.
     stress considers both for crystal and molecules.
     For crystals need to divide by lattice volume.
     r_ij considers offsets which is different for molecules and crystals.
     """
     Z = compute_grad(output=all_results["energy"], inputs=r_ij)
-    if batch["num_atoms"].shape[0] == 1:
-        all_results["stress_volume"] = torch.matmul(Z.t(), r_ij)
-    else:
-        allstress = torch.stack([
-            torch.matmul(Z[torch.where(nbrs[:, 0] == j)].t(), r_ij[torch.where(nbrs[:, 0] == j)])
-            for j in range(batch["nxyz"].shape[0])
-        ])
-        N = batch["num_atoms"].detach().cpu().tolist()
-        split_val = torch.split(allstress, N)
-        all_results["stress_volume"] = torch.stack([i.sum(0) for i in split_val])
+    all_results["stress_volume"] = get_virials(grad_rij=Z, r_ij=r_ij, nbrs=nbrs, num_atoms=batch["num_atoms"])
     return all_results
 
 
@@ -1030,17 +1063,12 @@ def sum_and_grad(batch, xyz, r_ij, nbrs, atomwise_output, grad_keys, out_keys=No
         if key == "stress":
             output = results["energy"]
             grad_ = compute_grad(output=output, inputs=r_ij)
-            allstress = torch.stack([
-                torch.matmul(grad_[torch.where(nbrs[:, 0] == i)].t(), r_ij[torch.where(nbrs[:, 0] == i)])
-                for i in range(batch["nxyz"].shape[0])
-            ])
-            split_val = torch.split(allstress, N)
-            grad_ = torch.stack([i.sum(0) for i in split_val])
+            grad_ = get_virials(grad_rij=grad_, r_ij=r_ij, nbrs=nbrs, num_atoms=batch["num_atoms"]).reshape(-1, 3, 3)
             if "cell" in batch:
                 cell = torch.stack(torch.split(batch["cell"], 3, dim=0))
             elif "lattice" in batch:
                 cell = torch.stack(torch.split(batch["lattice"], 3, dim=0))
-            volume = torch.Tensor(np.abs(np.linalg.det(cell.cpu().numpy()))).to(grad_.get_device())
+            volume = torch.Tensor(np.abs(np.linalg.det(cell.cpu().numpy()))).to(grad_.device)
             grad = grad_ * (1 / volume[:, None, None])
             grad = torch.flatten(grad, start_dim=0, end_dim=1)
 
@@ -10,38 +10,63 @@ from torch.autograd import grad
 from torch.utils.data import DataLoader
 
 
-def compute_jacobian(inputs, output, device):
+def batched_vjp(inputs, output, grad_outputs, chunk_size=None):
+    """
+    Vector-Jacobian products of `output` with respect to `inputs` for a batch
+    of vectors. The backward pass is vectorized over the vectors with `vmap`
+    (`is_grads_batched`), in chunks of `chunk_size` vectors to cap the memory.
+    If the backward pass can't be vectorized, the vectors are done one by one.
+
+    Args:
+        inputs (torch.Tensor): tensor that `output` was computed from
+        output (torch.Tensor): differentiable output
+        grad_outputs (torch.Tensor): size (N_vec, *output.shape)
+        chunk_size (int, optional): number of vectors per backward pass.
+            Defaults to all of them at once.
+
+    Returns:
+        torch.Tensor: size (N_vec, *inputs.shape)
+    """
+
+    num_vecs = grad_outputs.shape[0]
+    chunk_size = chunk_size or num_vecs
+    vjps = []
+
+    for start in range(0, num_vecs, chunk_size):
+        chunk = grad_outputs[start : start + chunk_size]
+        try:
+            (vjp,) = grad(output, inputs, grad_outputs=chunk, retain_graph=True, is_grads_batched=True)
+        except RuntimeError:
+            vjp = torch.stack([grad(output, inputs, grad_outputs=vec, retain_graph=True)[0] for vec in chunk])
+        vjps.append(vjp)
+
+    return torch.cat(vjps)
+
+
+def compute_jacobian(inputs, output, device=None, chunk_size=None):
     """
     Compute Jacobians
 
     Args:
         inputs (torch.Tensor): size (N_in, )
         output (torch.Tensor): size (N_in, N_out, )
-        device (torch.Tensor): integer
+        device (torch.Tensor): integer. Unused, since the Jacobian is created
+            on the device of `inputs`.
+        chunk_size (int, optional): number of output components whose
+            gradients are computed in one vectorized backward pass
 
     Returns:
         torch.Tensor: size (N_in, N_in, N_out)
     """
 
-    # from torch.autograd.gradcheck import zero_gradients
-
     assert inputs.requires_grad
 
     num_classes = output.size()[1]
-    jacobian = torch.zeros(num_classes, *inputs.size())
-    grad_output = torch.zeros(*output.size())
-    if inputs.is_cuda:
-        grad_output = grad_output.to(device)
-        jacobian = jacobian.to(device)
-
-    for i in range(num_classes):
-        # zero_gradients(inputs)
-        inputs.grad = None
+    grad_outputs = torch.zeros(num_classes, *output.size(), dtype=output.dtype, device=output.device)
+    classes = torch.arange(num_classes, device=output.device)
+    grad_outputs[classes, :, classes] = 1
 
-        grad_output.zero_()
-        grad_output[:, i] = 1
-        output.backward(grad_output, retain_graph=True)
-        jacobian[i] = inputs.grad.data
+    jacobian = batched_vjp(inputs, output, grad_outputs, chunk_size=chunk_size)
 
     return torch.transpose(jacobian, dim0=0, dim1=1)
 
@@ -69,7 +94,7 @@ def compute_grad(inputs, output, allow_unused=False):
     return gradspred
 
 
-def compute_hess(inputs, output, device):
+def compute_hess(inputs, output, device, chunk_size=None):
     """
     Compute Hessians for arbitary model
 
@@ -77,12 +102,13 @@ def compute_hess(inputs, output, device):
         inputs (torch.Tensor): size (N_in, )
         output (torch.Tensor): size (N_out, )
         device (torch.Tensor): int
+        chunk_size (int, optional): number of Hessian columns per backward pass
 
     Returns:
         torch.Tensor: N_in, N_in, N_out
     """
     gradient = compute_grad(inputs, output)
-    hess = compute_jacobian(inputs, gradient, device=device)
+    hess = compute_jacobian(inputs, gradient, device=device, chunk_size=chunk_size)
 
     return hess
 
@@ -313,6 +339,140 @@ def general_batched_hessian(batch, keys, device, model=None, forward=None, **kwa
     return results
 
 
+class BatchHessian:
+    """
+    Hessians of the energies of a batch of geometries with respect to their
+    coordinates. The model is called once, and the Hessian is then probed with
+    Hessian-vector products (HVPs), i.e. backward passes through the gradient.
+
+    Since the geometries of a batch don't interact, the Hessian of the batch is
+    block-diagonal. Column k of every block is therefore computed with one HVP,
+    using a vector that has coordinate k of every geometry set to one. This takes
+    3 * max(num_atoms) HVPs instead of 3 * sum(num_atoms), and the HVPs are
+    vectorized with `vmap`.
+
+    For large systems, `lowest_modes` gets a few eigenpairs with Lanczos
+    iterations on HVPs without forming the Hessian.
+
+    Attributes:
+        xyz (torch.Tensor): coordinates that the energy was computed from
+        energy (torch.Tensor): energy of each geometry
+        gradient (torch.Tensor): gradient of the energy, with its graph
+        num_atoms (list[int]): number of atoms in each geometry
+    """
+
+    def __init__(self, batch, model=None, forward=None, en_key="energy", **kwargs):
+        """
+        Args:
+            batch (dict): batch of data
+            model (torch.nn.Module, optional): model that takes `xyz` as a
+                keyword argument
+            forward (callable, optional): forward function to use instead of
+                `model.forward`
+            en_key (str): key of the energy
+            **kwargs: keyword arguments for the model
+        """
+        assert any(i is not None for i in [model, forward])
+        if model is not None:
+            forward = model.forward
+
+        self.xyz = batch["nxyz"][:, 1:].detach().clone().requires_grad_(True)
+        results = forward(batch, xyz=self.xyz, **kwargs)
+        self.energy = results[en_key]
+
+        # reuse the gradient that the model already computed if it can be differentiated
+        gradient = results.get(en_key + "_grad")
+        if gradient is None or not gradient.requires_grad:
+            gradient = compute_grad(self.xyz, self.energy)
+        self.gradient = gradient
+
+        num_atoms = batch.get("num_atoms", torch.LongTensor([len(self.xyz)]))
+        self.num_atoms = torch.atleast_1d(num_atoms).tolist()
+
+    def hvp(self, vectors, chunk_size=None):
+        """
+        Hessian-vector products.
+
+        Args:
+            vectors (torch.Tensor): size (N_atoms, 3) or (N_vec, N_atoms, 3)
+            chunk_size (int, optional): number of vectors per backward pass
+
+        Returns:
+            torch.Tensor: products with the same size as `vectors`
+        """
+        if vectors.dim() == 2:
+            return grad(self.gradient, self.xyz, grad_outputs=vectors, retain_graph=True)[0]
+        return batched_vjp(self.xyz, self.gradient, vectors, chunk_size=chunk_size)
+
+    def blocks(self, chunk_size=None):
+        """
+        Hessian of each geometry.
+
+        Args:
+            chunk_size (int, optional): number of columns computed per
+                backward pass, to cap the memory
+
+        Returns:
+            list[torch.Tensor]: Hessians of size (3 * n_atoms, 3 * n_atoms)
+        """
+        device = self.xyz.device
+        dims = torch.LongTensor(self.num_atoms).to(device) * 3
+        starts = torch.cumsum(dims // 3, 0) - dims // 3
+        max_dim = int(dims.max())
+        chunk_size = chunk_size or max_dim
+
+        hessians = [self.xyz.new_zeros(dim, dim) for dim in dims.tolist()]
+        for first in range(0, max_dim, chunk_size):
+            cols = torch.arange(first, min(first + chunk_size, max_dim), device=device)
+
+            # one vector per column, with that column of every geometry set to one
+            vec_idx, geom_idx = torch.nonzero(cols.reshape(-1, 1) < dims.reshape(1, -1), as_tuple=True)
+            vectors = self.xyz.new_zeros(len(cols), *self.xyz.shape)
+            atoms = starts[geom_idx] + cols[vec_idx] // 3
+            vectors[vec_idx, atoms, cols[vec_idx] % 3] = 1
+
+            products = self.hvp(vectors)
+            for hessian, start, dim in zip(hessians, starts.tolist(), dims.tolist()):
+                valid = cols < dim
+                block = products[valid, start : start + dim // 3].reshape(-1, dim)
+                hessian[:, cols[valid]] = block.T
+
+        return [hessian.detach() for hessian in hessians]
+
+    def lowest_modes(self, k=1, geom_idx=0, tol=0):
+        """
+        Lowest eigenvalues and eigenvectors of the Hessian of one geometry,
+        from Lanczos iterations on Hessian-vector products.
+
+        Args:
+            k (int): number of eigenpairs
+            geom_idx (int): index of the geometry in the batch
+            tol (float): relative tolerance of the eigenvalues. 0 means
+                machine precision.
+
+        Returns:
+            eigvals (np.ndarray): size (k,), in ascending order
+            eigvecs (np.ndarray): size (3 * n_atoms, k)
+        """
+        from scipy.sparse.linalg import LinearOperator, eigsh
+
+        start = sum(self.num_atoms[:geom_idx])
+        num_atoms = self.num_atoms[geom_idx]
+        dim = 3 * num_atoms
+
+        def matvec(vec):
+            vectors = self.xyz.new_zeros(self.xyz.shape)
+            vectors[start : start + num_atoms] = torch.as_tensor(vec.reshape(-1, 3), dtype=self.xyz.dtype)
+            product = self.hvp(vectors)[start : start + num_atoms]
+            return product.detach().cpu().double().numpy().reshape(-1)
+
+        operator = LinearOperator((dim, dim), matvec=matvec, dtype=np.float64)
+        eigvals, eigvecs = eigsh(operator, k=k, which="SA", tol=tol)
+        order = np.argsort(eigvals)
+
+        return eigvals[order], eigvecs[:, order]
+
+
 def hess_from_atoms(atoms):
     """
     Use an ASE AtomsBatch to get the Hessian in Ha / Bohr^2.
@@ -345,14 +505,10 @@ def hess_from_atoms(atoms):
     model = atoms.calc.model.to(device)
     batch = batch_to(batch, device)
 
-    # get the results
+    # get the Hessian
     key = getattr(atoms.calc, "en_key", "energy")
-    results = general_batched_hessian(batch=batch, keys=[key], device=device, model=model)
-
-    hess_key = key + "_hess"
-    hessian = torch.stack(results[hess_key])
-    hessian = hessian.reshape(*hessian.shape[1:])
+    (hessian,) = BatchHessian(batch, model=model, en_key=key).blocks()
 
-    hessian = hessian.detach().cpu().numpy() * const.KCAL_TO_AU["energy"] * const.BOHR_RADIUS**2
+    hessian = hessian.cpu().numpy() * const.KCAL_TO_AU["energy"] * const.BOHR_RADIUS**2
 
     return hessian
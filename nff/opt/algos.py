@@ -70,7 +70,7 @@ class NeuralAseBFGS(BFGS):
     def step(self, f=None):
         atoms = self.atoms
 
-        atoms.update_nbr_list()
+        atoms.update_nbr_list_if_needed()
 
         if f is None:
             f = atoms.get_forces()
@@ -1,26 +1,31 @@
 import torch
-from neuralnet.vib import hessian_and_modes
 
 from nff.io.ase_calcs import NeuralFF
+from nff.nn.tensorgrad import BatchHessian
 from nff.reactive_tools.utils import (
     neural_energy_ase,
     neural_force_ase,
 )
-from nff.utils.constants import BOHR_RADIUS, EV_TO_AU
+from nff.utils import constants as const
+from nff.utils.cuda import batch_to
 
 CONVG_LINE = "Optimization converged!"
 
 
 def get_hessian(atoms, device):
-    mode_results = hessian_and_modes(atoms)
+    """Analytical Hessian of the NFF calculator of `atoms`, in the units of its
+    predictions per A^2 (eV / A^2 by default)."""
+
+    calc = atoms.calc
+    batch = batch_to(atoms.get_batch(), device)
+    key = getattr(calc, "en_key", "energy")
 
     # use the full Hessian, not the one with
     # translation and rotation projected out
+    (hessian,) = BatchHessian(batch, model=calc.model, en_key=key).blocks()
 
-    # hessian = mode_results["hess_proj"]
-    hessian = mode_results["hessianmatrix"]
-    hessian = torch.Tensor(hessian).to(device)
-    hessian /= EV_TO_AU * BOHR_RADIUS**2
+    conversion = const.conversion_factors.get((calc.model_units, calc.prediction_units), const.DEFAULT)
+    hessian = hessian.to(device) * conversion["energy"]
 
     return hessian
 
@@ -5,6 +5,20 @@ import torch
 
 torch.set_num_threads(int(os.getenv("OMP_NUM_THREADS", "1")))
 
+# small PaiNN shared by the tests of the models, calculators and dynamics
+PAINN_PARAMS = {
+    "feat_dim": 16,
+    "activation": "swish",
+    "n_rbf": 8,
+    "cutoff": 3.0,
+    "num_conv": 2,
+    "output_keys": ["energy"],
+    "grad_keys": ["energy_grad"],
+    "learnable_k": False,
+    "conv_dropout": 0,
+    "readout_dropout": 0,
+}
+
 
 def pytest_addoption(parser):
     parser.addoption("--device", action="store", default="cpu", help="Whether to use the CPU or GPU for the tests")
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest as ut
+
+import numpy as np
+
+from nff.io.array_log import ArrayLog, close_array_logs, load_array_log, open_array_log
+
+
+class TestArrayLog(ut.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "log.npy")
+        self.rows = np.random.RandomState(0).rand(50, 4, 3).astype(np.float32)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_append(self):
+        for asynchronous in [True, False]:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            log = ArrayLog(self.path, chunk_size=8, asynchronous=asynchronous)
+            for row in self.rows:
+                log.append(row[None])
+            assert len(log) == len(self.rows)
+
+            # only complete chunks are on disk before the log is flushed
+            log.flush(wait=True)
+            assert np.array_equal(load_array_log(self.path), self.rows)
+            assert np.array_equal(np.load(self.path), self.rows)
+            log.close()
+
+        with self.assertRaises(ValueError):
+            log.append(np.zeros((1, 5, 3)))
+
+    def test_existing_file(self):
+        np.save(self.path, self.rows[:10])
+        log = ArrayLog(self.path, chunk_size=4)
+        log.append(self.rows[10:])
+        log.close()
+        assert np.array_equal(load_array_log(self.path), self.rows)
+
+        # a new log continues the same file
+        log = ArrayLog(self.path)
+        log.append(self.rows[:1])
+        log.close()
+        assert np.array_equal(load_array_log(self.path), np.concatenate([self.rows, self.rows[:1]]))
+
+    def test_open_array_log(self):
+        log = open_array_log(self.path)
+        assert open_array_log(os.path.join(self.tmpdir.name, ".", "log.npy")) is log
+        log.append(self.rows[:3])
+        close_array_logs()
+        assert np.array_equal(load_array_log(self.path), self.rows[:3])
+
+
+if __name__ == "__main__":
+    ut.main()
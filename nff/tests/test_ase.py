@@ -4,6 +4,7 @@ from collections.abc import Iterable
 import networkx as nx
 import numpy as np
 import pytest
+import torch
 from ase import Atoms
 
 from nff.io.ase import AtomsBatch
@@ -192,6 +193,28 @@ class TestAtomsBatch(ut.TestCase):
         # compare the props
         compare_dicts(ab_dict_props, ab_dict_again_props)
 
+    def test_lazy_nbr_update(self):
+        atoms_batch = AtomsBatch(self.ethanol, cutoff=2.5, cutoff_skin=1.0, device=self.device)
+        atoms_batch.update_nbr_list()
+        nbr_list = atoms_batch.nbr_list
+        assert not atoms_batch.requires_nbr_update()
+
+        # moving less than half the skin keeps the neighbor list
+        atoms_batch.positions[0] += [0.4, 0.0, 0.0]
+        atoms_batch.get_batch()
+        assert atoms_batch.nbr_list is nbr_list
+
+        # moving more than half the skin triggers a rebuild
+        atoms_batch.positions[0] += [0.2, 0.0, 0.0]
+        assert atoms_batch.requires_nbr_update()
+        atoms_batch.get_batch()
+        assert atoms_batch.nbr_list is not nbr_list
+        assert not atoms_batch.requires_nbr_update()
+
+        # so does a change of the cell
+        atoms_batch.set_cell([10.0, 10.0, 10.0])
+        assert atoms_batch.requires_nbr_update()
+
 
 @pytest.mark.usefixtures("device")  # Ensure the fixture is loaded
 class TestPeriodic(ut.TestCase):
@@ -488,6 +511,33 @@ class TestPeriodic(ut.TestCase):
         )
         assert np.allclose(nbrlist, expected_nbrlist)
 
+    def test_cell_change(self):
+        self.quartz.cutoff_skin = 1.0
+        batch = self.quartz.get_batch()
+        nbr_list = self.quartz.nbr_list
+        assert self.quartz.image_shifts.dtype == torch.int8
+
+        xyz = batch["nxyz"][:, 1:]
+        offsets = batch["offsets"].to_dense() if batch["offsets"].is_sparse else batch["offsets"]
+        dist = (xyz[nbr_list[:, 1]] - xyz[nbr_list[:, 0]] + offsets).norm(dim=-1)
+
+        # a small strain moves the periodic images with the cell, so the
+        # neighbor list is kept and only the offsets are recomputed
+        self.quartz.set_cell(self.quartz.get_cell() * 1.01, scale_atoms=True)
+        assert not self.quartz.requires_nbr_update()
+        batch = self.quartz.get_batch()
+        assert self.quartz.nbr_list is nbr_list
+
+        xyz = batch["nxyz"][:, 1:]
+        offsets = batch["offsets"]
+        assert torch.allclose(offsets, self.quartz.image_shifts.float() @ torch.Tensor(np.array(self.quartz.cell)))
+        new_dist = (xyz[nbr_list[:, 1]] - xyz[nbr_list[:, 0]] + offsets).norm(dim=-1)
+        assert torch.allclose(new_dist, 1.01 * dist, atol=1e-4)
+
+        # a large one doesn't
+        self.quartz.set_cell(self.quartz.get_cell() * 1.2, scale_atoms=True)
+        assert self.quartz.requires_nbr_update()
+
 
 if __name__ == "__main__":
     ut.main()
@@ -0,0 +1,68 @@
+import unittest as ut
+
+import numpy as np
+
+from nff.io.bias_calculators import WTMeABF, welford_var
+from nff.nn.models.painn import Painn
+from nff.tests.conftest import PAINN_PARAMS
+
+
+def get_cv_def(lo, hi, cv_type="not_angle"):
+    return {
+        "definition": {"name": "distance", "index_list": [0, 1]},
+        "range": [lo, hi],
+        "bin_width": 0.1,
+        "ext_sigma": 0.1,
+        "ext_pos": (lo + hi) / 2,
+        "ext_mass": 10.0,
+        "hill_std": 0.15,
+        "type": cv_type,
+    }
+
+
+class TestWTMeABF(ut.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        cv_defs = [get_cv_def(1.0, 3.0), get_cv_def(-np.pi, np.pi, "angle")]
+        self.calc = WTMeABF(
+            Painn(PAINN_PARAMS), cv_defs, dt=0.5, friction_per_ps=1.0, hill_height=0.05, hill_drop_freq=3
+        )
+
+        rng = np.random.RandomState(1)
+        for _ in range(300):
+            xi = self.calc.ext_coords + 0.05 * rng.randn(2, 1)
+            self.calc._propagate_ext()
+            self.calc.ext_forces[:] = 0.0
+            self.calc._update_bias(xi)
+            self.calc._up_extvel()
+
+    def test_grid_matches_hills(self):
+        calc = self.calc
+        assert calc.num_hills > 0
+        assert len(calc.center) == calc.num_hills
+
+        for center in calc.center:
+            bink = calc.get_index(center)
+            xi = np.array([[calc.grid[0][bink[0]]], [calc.grid[1][bink[1]]]])
+            force, pot = calc._analytic_wtm_force(xi)
+            assert np.allclose(pot, calc.metapot[bink])
+            assert np.allclose(force.reshape(-1), calc.metaforce[(slice(None), *bink)], atol=1e-6)
+
+    def test_hill_buffer(self):
+        calc = self.calc
+        centers = np.copy(calc.center)
+        for _ in range(len(calc.hill_heights) + 1):
+            calc.add_hill(np.array([2.0, 0.0]), 0.0)
+        assert np.allclose(calc.center[: len(centers)], centers)
+
+    def test_welford_var(self):
+        samples = np.random.RandomState(0).rand(10, 3)
+        mean, m2, var = np.zeros(3), np.zeros(3), np.zeros(3)
+        for count, sample in enumerate(samples, 1):
+            mean, m2, var = welford_var(count, mean, m2, sample)
+        assert np.allclose(mean, samples.mean(0))
+        assert np.allclose(var, samples.var(0))
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from ase import Atoms
+from ase.build import bulk
+from ase.neighborlist import neighbor_list
+
+from nff.utils.cell_list import cell_list_nbr_list
+
+
+def sorted_pairs(i, j, offsets):
+    return sorted(zip(np.asarray(i).tolist(), np.asarray(j).tolist(), map(tuple, np.asarray(offsets).tolist())))
+
+
+def get_systems():
+    rng = np.random.default_rng(0)
+
+    cubic = bulk("Cu", "fcc", a=3.6, cubic=True).repeat((3, 3, 3))
+    cubic.rattle(0.1, seed=1)
+    # unwrapped positions should give offsets with respect to the unwrapped atoms
+    cubic.positions += 4 * rng.normal(size=cubic.positions.shape)
+
+    # small triclinic cell where the cutoff spans several images
+    triclinic = bulk("Si", "diamond", a=5.43)
+    triclinic.rattle(0.1, seed=2)
+
+    slab = bulk("Cu", "fcc", a=3.6).repeat((3, 3, 2))
+    slab.center(vacuum=5.0, axis=2)
+    slab.pbc = [True, True, False]
+
+    gas = Atoms("H150", positions=rng.uniform(0, 15, (150, 3)))
+
+    return [(cubic, 5.0), (triclinic, 7.0), (slab, 4.0), (gas, 3.0)]
+
+
+@pytest.mark.parametrize("atoms,cutoff", get_systems())
+def test_matches_ase(atoms, cutoff):
+    i, j, offsets = neighbor_list("ijS", atoms, cutoff)
+    nbr_list, cl_offsets = cell_list_nbr_list(atoms.get_positions(), cutoff, cell=atoms.cell.array, pbc=atoms.pbc)
+
+    assert sorted_pairs(i, j, offsets) == sorted_pairs(nbr_list[:, 0], nbr_list[:, 1], cl_offsets)
+
+
+def test_undirected():
+    atoms, cutoff = get_systems()[0]
+    directed, _ = cell_list_nbr_list(atoms.get_positions(), cutoff, cell=atoms.cell.array, pbc=True)
+    undirected, _ = cell_list_nbr_list(atoms.get_positions(), cutoff, cell=atoms.cell.array, pbc=True, directed=False)
+
+    assert (undirected[:, 1] > undirected[:, 0]).all()
+    assert len(undirected) == (directed[:, 1] > directed[:, 0]).sum()
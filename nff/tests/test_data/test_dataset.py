@@ -1,4 +1,5 @@
 import os
+import tempfile
 import unittest
 from collections import Counter
 from pathlib import Path
@@ -10,9 +11,15 @@ import torch
 from nff.data.dataset import (
     Dataset,
     concatenate_dict,
+    split_train_test,
     split_train_validation_test,
     stratified_split,
 )
+from nff.data.loader import collate_dicts
+from nff.data.memmap import convert_to_memmap
+from nff.data.packed import PackedTensorList
+from nff.data.sparse import to_image_shifts
+from nff.nn.modules.schnet import get_offsets
 
 current_path = Path(__file__).parent
 DATASET_PATH = os.path.join(current_path, "..", "..", "..", "tutorials", "data", "dataset.pth.tar")
@@ -260,6 +267,112 @@ class TestPeriodicDataset(unittest.TestCase):
     def test_neighbor_list(self):
         self.qtz_dataset.generate_neighbor_list(cutoff=5)
 
+    def test_image_shifts(self):
+        strained = {"nxyz": self.quartz["nxyz"] * [1, 1.05, 1.05, 1.05], "lattice": self.quartz["lattice"] * 1.05}
+        props = concatenate_dict(self.quartz, strained, self.quartz)
+        dataset = Dataset(props, device=self._test_fixture_device)
+        dataset.generate_neighbor_list(cutoff=5, undirected=False)
+        shifts_dataset = Dataset(props.copy(), device=self._test_fixture_device)
+        nbr_list, image_shifts = shifts_dataset.generate_neighbor_list(cutoff=5, undirected=False, image_shifts=True)
+
+        assert "offsets" not in shifts_dataset.props
+        assert all(shifts.dtype == torch.int8 for shifts in image_shifts)
+        assert all(torch.equal(nbrs, other) for nbrs, other in zip(nbr_list, dataset.props["nbr_list"]))
+
+        # the offsets rebuilt from each cell match the Cartesian ones
+        batch = collate_dicts([dataset[i] for i in range(len(dataset))])
+        shifts_batch = collate_dicts([shifts_dataset[i] for i in range(len(shifts_dataset))])
+        assert shifts_batch["image_shifts"].dtype == torch.int8
+        offsets = get_offsets(shifts_batch, "offsets")
+        assert torch.allclose(offsets, get_offsets(batch, "offsets"), atol=1e-5)
+
+        # shifts that don't fit in int8 aren't wrapped around
+        assert torch.equal(
+            to_image_shifts(np.array([[0.0, -1.0, 127.0]])), torch.tensor([[0, -1, 127]], dtype=torch.int8)
+        )
+        with pytest.raises(ValueError):
+            to_image_shifts(np.array([[0.0, 0.0, 200.0]]))
+
+
+class TestPackedDataset(unittest.TestCase):
+    def setUp(self):
+        self.dataset = Dataset.from_file(PEROVSKITE_DATA_PATH)
+        self.packed = self.dataset.copy()
+        self.packed.pack()
+
+    def test_getitem(self):
+        assert self.packed.is_packed
+        assert isinstance(self.packed.props["nxyz"], PackedTensorList)
+        # per-atom properties share the same offsets
+        assert self.packed.props["nxyz"].offsets is self.packed.props["energy_grad"].offsets
+
+        for i in [0, 7, len(self.dataset) - 1]:
+            item, packed_item = self.dataset[i], self.packed[i]
+            for key, val in item.items():
+                if isinstance(val, torch.Tensor):
+                    assert torch.equal(val, packed_item[key])
+                else:
+                    assert val == packed_item[key]
+
+    def test_to_units(self):
+        self.dataset.to_units("eV")
+        self.packed.to_units("eV")
+        for val, packed_val in zip(self.dataset.props["energy_grad"], self.packed.props["energy_grad"]):
+            assert torch.allclose(val, packed_val)
+
+    def test_split_and_save(self):
+        train, test = split_train_test(self.packed, test_size=0.2, seed=SEED)
+        assert train.is_packed
+        assert len(train) + len(test) == len(self.packed)
+
+        path = os.path.join(current_path, "packed_dataset.pth.tar")
+        try:
+            train.save(path)
+            loaded = Dataset.from_file(path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        assert isinstance(loaded.props["nxyz"], PackedTensorList)
+        assert all(torch.equal(a, b) for a, b in zip(train.props["nxyz"], loaded.props["nxyz"]))
+
+    def test_unpack(self):
+        self.packed.unpack()
+        assert not self.packed.is_packed
+        assert all(torch.equal(a, b) for a, b in zip(self.dataset.props["nxyz"], self.packed.props["nxyz"]))
+
+
+class TestMemmapDataset(unittest.TestCase):
+    def setUp(self):
+        self.dataset = Dataset.from_file(PEROVSKITE_DATA_PATH)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.memmap = convert_to_memmap(PEROVSKITE_DATA_PATH, self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_getitem(self):
+        assert len(self.memmap) == len(self.dataset)
+        for i in [0, 11, len(self.dataset) - 1]:
+            item, mm_item = self.dataset[i], self.memmap[i]
+            assert item.keys() == mm_item.keys()
+            for key, val in item.items():
+                if isinstance(val, torch.Tensor):
+                    assert torch.equal(val.to_dense() if val.is_sparse else val, mm_item[key])
+                else:
+                    assert val == mm_item[key]
+
+    def test_collate(self):
+        batch = collate_dicts([self.memmap[i] for i in range(4)])
+        expected = collate_dicts([self.dataset[i] for i in range(4)])
+        assert torch.equal(batch["nbr_list"], expected["nbr_list"])
+        assert torch.equal(batch["nxyz"], expected["nxyz"])
+
+    def test_to_dataset(self):
+        dataset = self.memmap.to_dataset()
+        assert dataset.is_packed
+        assert all(torch.equal(a, b) for a, b in zip(self.dataset.props["nxyz"], dataset.props["nxyz"]))
+
 
 if __name__ == "__main__":
     unittest.main()
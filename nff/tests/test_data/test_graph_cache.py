@@ -0,0 +1,136 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from nff.data import Dataset
+from nff.data.dataset import concatenate_dict
+from nff.data.graph_cache import GraphCache, hash_geom, set_graph_cache
+from nff.tests.test_data.test_parallel import get_dataset
+
+QUARTZ = {
+    "nxyz": np.array(
+        [
+            [14.0, -1.19984241582007, 2.07818802527655, 4.59909615202747],
+            [14.0, 1.31404847917993, 2.27599872954824, 2.7594569553608],
+            [14.0, 2.39968483164015, 0.0, 0.919817758694137],
+            [8.0, -1.06646793438585, 3.24694318819338, 0.20609293956337],
+            [8.0, 0.235189576572621, 1.80712683722845, 3.8853713328967],
+            [8.0, 0.831278357813231, 3.65430348422777, 2.04573213623004],
+            [8.0, 3.34516925281323, 0.699883270597028, 5.31282465043663],
+            [8.0, 1.44742296061415, 1.10724356663142, 1.6335462571033],
+            [8.0, 2.74908047157262, 2.54705991759635, 3.47318545376996],
+        ]
+    ),
+    "lattice": np.array(
+        [
+            [5.02778179, 0.0, 3.07862843796742e-16],
+            [-2.513890895, 4.3541867548248, 3.07862843796742e-16],
+            [0.0, 0.0, 5.51891759],
+        ]
+    ),
+}
+
+
+def put_items(path, seed, num_items=200):
+    cache = GraphCache(path)
+    for i in range(num_items):
+        nbr_list = torch.full((i % 7 + 1, 2), seed * num_items + i)
+        cache.put(hash_geom(nbr_list, cutoff=5.0, directed=True), {"nbr_list": nbr_list})
+
+
+def assert_lists_equal(first, second):
+    assert len(first) == len(second)
+    for val_1, val_2 in zip(first, second):
+        val_1 = val_1.to_dense() if val_1.is_sparse else val_1
+        val_2 = val_2.to_dense() if val_2.is_sparse else val_2
+        assert torch.equal(val_1, val_2)
+
+
+class TestGraphCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache")
+
+    def tearDown(self):
+        set_graph_cache(None)
+        self.tmpdir.cleanup()
+
+    def test_store(self):
+        cache = GraphCache(self.path)
+        values = {"nbr_list": torch.LongTensor([[0, 1], [1, 0]]), "offsets": torch.zeros(0, 3)}
+        key = hash_geom(torch.rand(2, 4), cutoff=5.0, directed=True)
+        cache.put(key, values)
+
+        # another instance sees the entry
+        cached = GraphCache(self.path).get(key)
+        for name, val in values.items():
+            assert torch.equal(cached[name], val)
+
+        assert hash_geom(torch.ones(2, 4), 5.0, True) != hash_geom(torch.ones(2, 4), 5.0, False)
+        assert hash_geom(torch.ones(2, 4), 5.0, True) != hash_geom(torch.ones(2, 4), 4.0, True)
+
+    def test_concurrent_writers(self):
+        context = multiprocessing.get_context("fork")
+        procs = [context.Process(target=put_items, args=(self.path, seed)) for seed in range(8)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            assert proc.exitcode == 0
+
+        # every entry points to its own data
+        cache = GraphCache(self.path)
+        assert len(cache) == 8 * 200
+        for seed in range(8):
+            for i in range(200):
+                nbr_list = torch.full((i % 7 + 1, 2), seed * 200 + i)
+                cached = cache.get(hash_geom(nbr_list, cutoff=5.0, directed=True))
+                assert torch.equal(cached["nbr_list"], nbr_list)
+
+    def test_dataset(self):
+        expected = get_dataset()
+        expected.generate_neighbor_list(cutoff=2.5, undirected=False, cache=False)
+        expected.generate_angle_list(cache=False)
+        expected_kj_ji = get_dataset()
+        expected_kj_ji.generate_neighbor_list(cutoff=2.5, undirected=False, cache=False)
+        expected_kj_ji.generate_kj_ji(cache=False)
+
+        set_graph_cache(self.path)
+        for _ in range(2):
+            dataset = get_dataset()
+            dataset.generate_neighbor_list(cutoff=2.5, undirected=False)
+            dataset.generate_angle_list()
+            for key in ["nbr_list", "angle_list", "ji_idx", "kj_idx"]:
+                assert_lists_equal(dataset.props[key], expected.props[key])
+
+            dataset.generate_kj_ji(cache=self.path)
+            assert_lists_equal(dataset.props["ji_idx"], expected_kj_ji.props["ji_idx"])
+            assert_lists_equal(dataset.props["kj_idx"], expected_kj_ji.props["kj_idx"])
+
+            # the second pass only reads from the cache
+            assert len(GraphCache(self.path)) == 3 * len(dataset)
+
+        # a different cutoff isn't a cache hit
+        dataset.generate_neighbor_list(cutoff=2.0, undirected=False)
+        assert sum(len(nbrs) for nbrs in dataset.props["nbr_list"]) < sum(
+            len(nbrs) for nbrs in expected.props["nbr_list"]
+        )
+
+    def test_periodic(self):
+        expected = Dataset(concatenate_dict(*[QUARTZ] * 2), device="cpu")
+        expected.generate_neighbor_list(cutoff=5, undirected=False, cache=False)
+
+        for _ in range(2):
+            dataset = Dataset(concatenate_dict(*[QUARTZ] * 2), device="cpu")
+            dataset.generate_neighbor_list(cutoff=5, undirected=False, cache=self.path)
+            assert_lists_equal(dataset.props["nbr_list"], expected.props["nbr_list"])
+            assert_lists_equal(dataset.props["offsets"], expected.props["offsets"])
+            assert not any(offsets.is_sparse for offsets in dataset.props["offsets"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import torch
+
+from nff.data.graphs import add_ji_kj, batch_angle_idx, get_angle_list, get_batch_angle_list, get_neighbor_list
+
+
+def get_nbr_lists():
+    torch.manual_seed(0)
+    return [get_neighbor_list(torch.rand(n, 3) * 4, cutoff=2.5) for n in [5, 9, 12]]
+
+
+def test_angle_list():
+    nbr_list = torch.LongTensor([[0, 1], [1, 2]])
+    angles, nbrs = get_angle_list([nbr_list])
+
+    assert torch.equal(nbrs[0], torch.LongTensor([[0, 1], [1, 2], [1, 0], [2, 1]]))
+    assert torch.equal(angles[0], torch.LongTensor([[0, 1, 2], [2, 1, 0]]))
+
+
+def test_ji_kj():
+    angles, nbrs = get_angle_list(get_nbr_lists())
+    ji_idx, kj_idx = add_ji_kj(angles, nbrs)
+
+    for angle, nbr, ji, kj in zip(angles, nbrs, ji_idx, kj_idx):
+        assert torch.equal(nbr[ji], angle[:, [1, 0]])
+        assert torch.equal(nbr[kj], angle[:, [2, 1]])
+
+
+def test_batched_angle_list():
+    angles, nbrs = get_angle_list(get_nbr_lists())
+    ji_idx, kj_idx = add_ji_kj(angles, nbrs)
+
+    # collate the geometries and generate the triplets for the whole batch
+    num_atoms = [int(nbr.max()) + 1 for nbr in nbrs]
+    atom_shift = [sum(num_atoms[:i]) for i in range(len(nbrs))]
+    edge_shift = [sum(len(nbr) for nbr in nbrs[:i]) for i in range(len(nbrs))]
+    batch_nbrs = torch.cat([nbr + shift for nbr, shift in zip(nbrs, atom_shift)])
+
+    batch_angles, batch_ji, batch_kj = get_batch_angle_list(batch_nbrs)
+
+    assert torch.equal(batch_angles, torch.cat([a + shift for a, shift in zip(angles, atom_shift)]))
+    assert torch.equal(batch_ji, torch.cat([idx + shift for idx, shift in zip(ji_idx, edge_shift)]))
+    assert torch.equal(batch_kj, torch.cat([idx + shift for idx, shift in zip(kj_idx, edge_shift)]))
+
+
+def test_batch_angle_idx():
+    nbrs = torch.LongTensor([[1, 2], [2, 1], [2, 3], [3, 2], [2, 4], [4, 2]])
+    ji_idx, kj_idx = batch_angle_idx(nbrs)
+
+    assert (nbrs[kj_idx][:, 0] == nbrs[ji_idx][:, 1]).all()
+    assert (nbrs[kj_idx][:, 1] != nbrs[ji_idx][:, 0]).all()
+    assert torch.equal(kj_idx, torch.LongTensor([1, 1, 2, 2, 4, 4]))
+    assert torch.equal(ji_idx, torch.LongTensor([3, 5, 0, 5, 0, 3]))
+
+
+def test_dimenet_triplets_on_the_fly():
+    from nff.nn.models.dimenet import DimeNet
+
+    modelparams = {
+        "n_rbf": 6,
+        "cutoff": 2.5,
+        "envelope_p": 6,
+        "n_spher": 3,
+        "l_spher": 3,
+        "embed_dim": 8,
+        "n_bilinear": 2,
+        "activation": "swish",
+        "n_convolutions": 1,
+        "output_keys": ["energy"],
+        "grad_keys": [],
+    }
+    model = DimeNet(modelparams)
+
+    torch.manual_seed(0)
+    xyz = torch.rand(6, 3) * 3
+    batch = {
+        "nxyz": torch.cat([torch.ones(6, 1), xyz], dim=1),
+        "nbr_list": get_neighbor_list(xyz, cutoff=2.5, undirected=False),
+        "num_atoms": torch.LongTensor([6]),
+    }
+
+    # the triplets of the old neighbor list aren't left in a reused batch
+    model(batch)
+    assert "angle_list" not in batch
+    batch["nbr_list"] = get_neighbor_list(xyz, cutoff=2.0, undirected=False)
+    energy = model(batch)["energy"]
+
+    angle_list, ji_idx, kj_idx = get_batch_angle_list(batch["nbr_list"])
+    expected = model({**batch, "angle_list": angle_list, "ji_idx": ji_idx, "kj_idx": kj_idx})["energy"]
+    assert torch.allclose(energy, expected)
@@ -0,0 +1,134 @@
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, SequentialSampler
+
+from nff.data import Dataset
+from nff.data.loader import CollateBuffers, ImbalancedDatasetSampler, SizeBatchSampler, collate_dicts
+
+
+def get_dicts():
+    dicts = []
+    for n, num_nbrs in [(3, 4), (5, 6), (2, 2)]:
+        nbr_list = torch.stack([torch.arange(num_nbrs) % n, (torch.arange(num_nbrs) + 1) % n], dim=1)
+        dicts.append(
+            {
+                "nxyz": torch.rand(n, 4),
+                "num_atoms": torch.tensor(n),
+                "energy": torch.rand(1),
+                "nbr_list": nbr_list,
+                "bond_idx": torch.arange(num_nbrs),
+                "atomwise_mol_list": torch.zeros(n, dtype=torch.long),
+                "smiles": "C",
+            }
+        )
+    return dicts
+
+
+class TestCollate(unittest.TestCase):
+    def setUp(self):
+        self.dicts = get_dicts()
+
+    def test_reindex(self):
+        batch = collate_dicts(self.dicts)
+
+        assert torch.equal(batch["nbr_list"][:4], self.dicts[0]["nbr_list"])
+        assert torch.equal(batch["nbr_list"][4:10], self.dicts[1]["nbr_list"] + 3)
+        assert torch.equal(batch["nbr_list"][10:], self.dicts[2]["nbr_list"] + 8)
+        assert torch.equal(batch["bond_idx"], torch.arange(12))
+        assert torch.equal(batch["atomwise_mol_list"], torch.LongTensor([0] * 3 + [1] * 5 + [2] * 2))
+        assert torch.equal(batch["num_atoms"], torch.LongTensor([3, 5, 2]))
+        assert batch["smiles"] == ["C"] * 3
+
+    def test_inputs_unchanged(self):
+        copies = [{key: val.clone() if torch.is_tensor(val) else val for key, val in d.items()} for d in self.dicts]
+        first = collate_dicts(self.dicts)
+        second = collate_dicts(self.dicts)
+
+        for d, copy in zip(self.dicts, copies):
+            for key, val in copy.items():
+                if torch.is_tensor(val):
+                    assert torch.equal(d[key], val)
+        for key in ["nbr_list", "bond_idx", "atomwise_mol_list", "nxyz"]:
+            assert torch.equal(first[key], second[key])
+
+    def test_buffers(self):
+        buffers = CollateBuffers(num_sets=2)
+        expected = collate_dicts(self.dicts)
+        first = collate_dicts(self.dicts, buffers=buffers)
+        second = collate_dicts(self.dicts[:2], buffers=buffers)
+
+        for key in ["nbr_list", "bond_idx", "atomwise_mol_list", "nxyz"]:
+            assert torch.equal(first[key], expected[key])
+        assert torch.equal(second["nbr_list"], expected["nbr_list"][:10])
+        # the third batch reuses the memory of the first one
+        third = collate_dicts(self.dicts, buffers=buffers)
+        assert third["nxyz"].data_ptr() == first["nxyz"].data_ptr()
+
+
+class TestSizeBatchSampler(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.num_atoms = torch.randint(1, 30, (200,))
+        self.num_edges = self.num_atoms * torch.randint(2, 8, (200,))
+
+    def check_budget(self, batches, max_atoms, max_edges):
+        for batch in batches:
+            if len(batch) > 1:
+                assert self.num_atoms[batch].sum() <= max_atoms
+                assert self.num_edges[batch].sum() <= max_edges
+
+    def test_batches(self):
+        sampler = SizeBatchSampler(
+            SequentialSampler(range(200)),
+            self.num_atoms,
+            num_edges=self.num_edges,
+            max_atoms=100,
+            max_edges=300,
+            bucket_size=50,
+        )
+        assert len(sampler) == len(sampler)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        self.check_budget(batches, 100, 300)
+
+        # every index is used once
+        assert sorted(sum(batches, [])) == list(range(200))
+
+        # an item larger than the budget is batched on its own
+        num_atoms = self.num_atoms.clone()
+        num_atoms[7] = 500
+        batches = list(SizeBatchSampler(range(200), num_atoms, max_atoms=100))
+        assert [7] in batches
+
+        dropped = list(SizeBatchSampler(range(200), self.num_atoms, max_size=16, shuffle=False, drop_last=True))
+        assert all(len(batch) == 16 for batch in dropped)
+        assert len(dropped) == 200 // 16
+
+    def test_weighted_sampler(self):
+        labels = torch.zeros(200)
+        labels[:20] = 1
+        base_sampler = ImbalancedDatasetSampler("label", {"label": labels})
+        sampler = SizeBatchSampler(base_sampler, self.num_atoms, num_edges=self.num_edges, max_edges=300)
+
+        indices = sum(list(sampler), [])
+        assert len(indices) == len(base_sampler)
+        # both classes are sampled equally often
+        assert 0.4 < (torch.LongTensor(indices) < 20).float().mean() < 0.6
+
+    def test_dataset(self):
+        dicts = get_dicts() * 10
+        dataset = Dataset({key: [d[key] for d in dicts] for key in ["nxyz", "energy", "nbr_list"]}, units="eV")
+        sampler = SizeBatchSampler.from_dataset(dataset, max_atoms=8, max_edges=12)
+        loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_dicts)
+
+        num_geoms = 0
+        for batch in loader:
+            assert len(batch["nxyz"]) <= 8
+            assert len(batch["nbr_list"]) <= 12
+            num_geoms += len(batch["num_atoms"])
+        assert num_geoms == len(dataset)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from nff.data import Dataset
+from nff.data.graphs import full_angle_idx, get_bond_idx, get_neighbor_list
+from nff.data.parallel import add_bond_idx_parallel, add_kj_ji_parallel, hash_run, map_geoms
+
+
+def get_dataset():
+    torch.manual_seed(0)
+    nxyz = []
+    for n in [5, 9, 12, 7, 3, 10, 6]:
+        xyz = torch.rand(n, 3) * 4
+        nxyz.append(torch.cat([torch.ones(n, 1), xyz], dim=1))
+
+    dataset = Dataset({"nxyz": nxyz, "energy": [torch.zeros(1)] * len(nxyz)}, units="eV")
+    dataset.props["nbr_list"] = [get_neighbor_list(val[:, 1:], cutoff=2.5, undirected=False) for val in nxyz]
+    dataset.props["bonded_nbr_list"] = [nbrs[::2] for nbrs in dataset.props["nbr_list"]]
+
+    return dataset
+
+
+def sum_geom(inputs):
+    return {"total": inputs["nxyz"].sum(0, keepdim=True)}
+
+
+def max_geom(inputs):
+    return {"total": inputs["nxyz"].max(0, keepdim=True).values}
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.dataset = get_dataset()
+
+    def test_kj_ji(self):
+        add_kj_ji_parallel(self.dataset, num_procs=2, chunk_size=2)
+
+        for i in range(len(self.dataset)):
+            ji_idx, kj_idx = full_angle_idx({key: self.dataset.props[key][i] for key in ["nbr_list", "num_atoms"]})
+            assert torch.equal(self.dataset.props["ji_idx"][i], ji_idx)
+            assert torch.equal(self.dataset.props["kj_idx"][i], kj_idx)
+
+    def test_bond_idx(self):
+        self.dataset.pack()
+        add_bond_idx_parallel(self.dataset, num_procs=2, chunk_size=3)
+
+        for i, bond_idx in enumerate(self.dataset.props["bond_idx"]):
+            nbr_list = self.dataset.props["nbr_list"][i]
+            assert torch.equal(bond_idx, get_bond_idx(self.dataset.props["bonded_nbr_list"][i], nbr_list))
+            assert torch.equal(nbr_list[bond_idx], self.dataset.props["bonded_nbr_list"][i])
+
+    def test_resume(self):
+        inputs = {"nxyz": self.dataset.props["nxyz"]}
+        expected = torch.stack([nxyz.sum(0) for nxyz in inputs["nxyz"]])
+        lengths = [len(nxyz) for nxyz in inputs["nxyz"]]
+
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            outputs = map_geoms(sum_geom, inputs, num_procs=2, chunk_size=3, checkpoint_dir=checkpoint_dir)
+            assert torch.allclose(outputs["total"].data, expected)
+            assert len(os.listdir(checkpoint_dir)) == 3
+
+            # finished chunks are loaded instead of computed
+            path = os.path.join(checkpoint_dir, f"chunk_{hash_run(sum_geom, inputs)}_0_3.pt")
+            torch.save({"total": (torch.zeros(3, 4), torch.ones(3, dtype=torch.long))}, path)
+            outputs = map_geoms(sum_geom, inputs, num_procs=1, chunk_size=3, checkpoint_dir=checkpoint_dir)
+            assert torch.equal(outputs["total"].data[:3], torch.zeros(3, 4))
+            assert torch.allclose(outputs["total"].data[3:], expected[3:])
+
+            # chunks of another function or other inputs aren't reused
+            outputs = map_geoms(max_geom, inputs, num_procs=1, chunk_size=3, checkpoint_dir=checkpoint_dir)
+            assert torch.equal(outputs["total"].data, torch.stack([nxyz.max(0).values for nxyz in inputs["nxyz"]]))
+
+            inputs = {"nxyz": [nxyz + 1 for nxyz in inputs["nxyz"]]}
+            outputs = map_geoms(sum_geom, inputs, num_procs=1, chunk_size=3, checkpoint_dir=checkpoint_dir)
+            assert torch.allclose(outputs["total"].data, expected + torch.Tensor([[n, n, n, n] for n in lengths]))
+            assert len(os.listdir(checkpoint_dir)) == 9
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,13 +3,25 @@ from pathlib import Path
 
 import numpy as np
 import torch
+from sklearn import linear_model
 
 from nff.data.dataset import Dataset
-from nff.data.stats import all_atoms, get_atom_count, remove_dataset_outliers
+from nff.data.stats import (
+    DatasetStats,
+    QuantileSketch,
+    RunningMoments,
+    all_atoms,
+    get_atom_count,
+    get_stoich_dict,
+    reg_atom_count,
+    remove_dataset_outliers,
+)
+from nff.data.views import DatasetView
 
 current_path = Path(__file__).parent
 
 DATASET_PATH = current_path / "../../../tutorials/data/dataset.pth.tar"
+PEROVSKITE_DATA_PATH = current_path / "data/SrIrO3_bulk_55_nff_all_dataset.pth.tar"
 
 
 class TestAtoms(unittest.TestCase):
@@ -78,5 +90,80 @@ class TestStats(unittest.TestCase):
 #        print(np.mean(new_array), np.std(new_array))
 #        print(np.max(new_array), np.min(new_array))
 
+
+class TestStreamingStats(unittest.TestCase):
+    def setUp(self):
+        self.dataset = Dataset.from_file(DATASET_PATH)
+        self.perovskite = Dataset.from_file(PEROVSKITE_DATA_PATH)
+
+    def test_moments(self):
+        values = np.random.default_rng(0).normal(1e6, 2.0, size=1000)
+        moments = RunningMoments()
+        for chunk in np.array_split(values, 7):
+            moments.update(torch.from_numpy(chunk))
+
+        assert moments.count == len(values)
+        assert np.isclose(moments.mean, values.mean())
+        assert np.isclose(moments.std, values.std())
+        assert moments.max == values.max()
+
+    def test_sketch(self):
+        values = torch.randn(5000, generator=torch.Generator().manual_seed(0))
+        sketch = QuantileSketch(size=10000)
+        sketch.update(values)
+        assert np.isclose(sketch.quantile(0.9), np.quantile(values.numpy(), 0.9))
+
+        sketch = QuantileSketch(size=1000)
+        for chunk in values.split(300):
+            sketch.update(chunk)
+        assert len(sketch.values) == 1000
+        assert abs(sketch.quantile(0.5) - np.quantile(values.numpy(), 0.5)) < 0.15
+
+    def test_dataset_stats(self):
+        stats = DatasetStats.from_dataset(self.dataset, chunk_size=37)
+        energies = self.dataset.props["energy"].numpy()
+        grads = torch.cat(self.dataset.props["energy_grad"]).numpy()
+
+        assert stats.num_geoms == len(self.dataset)
+        assert np.isclose(stats.mean("energy"), energies.mean(), atol=1e-6)
+        assert np.isclose(stats.std("energy"), energies.std())
+        assert np.isclose(stats.rms("energy_grad"), np.sqrt(np.square(grads).mean()))
+        assert np.isclose(stats.quantile("energy", 1.0), energies[np.abs(energies).argmax()])
+
+    def test_composition(self):
+        # the same statistics from a view of the packed dataset
+        self.perovskite.pack()
+        view = DatasetView([self.perovskite]).subset(np.arange(len(self.perovskite))[::-1])
+        stats = DatasetStats.from_dataset(view, chunk_size=16)
+        elements = stats.elements
+        assert elements == [8, 38, 77]
+
+        energies = np.array([float(energy) for energy in self.perovskite.props["energy"]])
+        counts = np.stack(
+            [np.bincount(nxyz[:, 0].long(), minlength=78)[elements] for nxyz in self.perovskite.props["nxyz"]]
+        )
+        expected = np.linalg.lstsq(counts, energies, rcond=None)[0]
+        coefs, _ = stats.fit_composition(intercept=False)
+        assert np.allclose([coefs[z] for z in elements], expected)
+
+        expected_mean = ((energies - counts @ expected) / counts.sum(1)).mean()
+        assert np.isclose(stats.mean_atomic_energy(coefs), expected_mean)
+
+    def test_stoich_dict(self):
+        stoich_dict = get_stoich_dict(self.perovskite)
+        formulas = sorted(set(self.perovskite.props["formula"]))
+        atoms = ["Ir", "O", "Sr"]
+        x_in = np.stack([reg_atom_count(formula, atoms) for formula in formulas])
+        min_energy = {}
+        for i, formula in enumerate(self.perovskite.props["formula"]):
+            energy = float(self.perovskite.props["energy"][i])
+            min_energy[formula] = min(energy, min_energy.get(formula, np.inf))
+        y_out = np.array([min_energy[formula] for formula in formulas])
+
+        clf = linear_model.LinearRegression().fit(x_in, y_out)
+        assert np.allclose([stoich_dict[atom] for atom in atoms], clf.coef_, atol=1e-6)
+        assert np.isclose(stoich_dict["offset"], clf.intercept_)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from nff.data import Dataset, DatasetView, collate_dicts, split_train_validation_test
+from nff.data.loader import get_item_sizes
+from nff.tests.test_data.test_parallel import get_dataset
+
+
+def assert_items_equal(item, other):
+    assert item.keys() == other.keys()
+    for key, val in item.items():
+        assert torch.equal(torch.as_tensor(val), torch.as_tensor(other[key]))
+
+
+class TestViews(unittest.TestCase):
+    def setUp(self):
+        self.dataset = get_dataset()
+        self.packed = get_dataset()
+        self.packed.pack()
+
+    def test_concat(self):
+        view = DatasetView([self.dataset, self.packed])
+        assert len(view) == 2 * len(self.dataset)
+        for i in range(len(self.dataset)):
+            assert_items_equal(view[i], self.dataset[i])
+            assert_items_equal(view[i + len(self.dataset)], self.packed[i])
+
+        # the view reads the properties of the datasets
+        assert view[0]["nxyz"].data_ptr() == self.dataset.props["nxyz"][0].data_ptr()
+
+    def test_subset(self):
+        view = DatasetView([self.dataset, self.packed])
+        idx = [12, 3, 5, 9]
+        subset = view.subset(idx).subset([3, 1, 0])
+
+        # views of views are flattened
+        assert subset.datasets == [self.dataset, self.packed]
+        for i, j in enumerate([9, 3, 12]):
+            assert_items_equal(subset[i], view[j])
+
+        num_atoms, num_edges = get_item_sizes(subset)
+        assert num_atoms.tolist() == [len(subset[i]["nxyz"]) for i in range(len(subset))]
+        assert num_edges.tolist() == [len(subset[i]["nbr_list"]) for i in range(len(subset))]
+
+        batch = collate_dicts([subset[i] for i in range(len(subset))])
+        assert len(batch["nxyz"]) == num_atoms.sum()
+
+    def test_materialize(self):
+        view = (DatasetView([self.packed]) + self.dataset).subset([10, 0, 4, 7])
+        dataset = view.to_dataset()
+        assert isinstance(dataset, Dataset)
+        assert len(dataset) == len(view)
+        for i in range(len(view)):
+            assert_items_equal(dataset[i], view[i])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dataset.pth.tar")
+            view.save(path)
+            loaded = Dataset.from_file(path, units=view.units)
+            for i in range(len(view)):
+                assert_items_equal(loaded[i], view[i])
+
+    def test_units(self):
+        other = get_dataset()
+        other.to_units("kcal/mol")
+        with self.assertRaises(NotImplementedError):
+            DatasetView([self.dataset, other])
+
+    def test_split(self):
+        train, val, test = split_train_validation_test(self.dataset, val_size=0.3, test_size=0.3, seed=0, view=True)
+        assert all(isinstance(split, DatasetView) for split in [train, val, test])
+        assert train.datasets == [self.dataset]
+
+        idx = np.concatenate([train.index, val.index, test.index])
+        assert sorted(idx.tolist()) == list(range(len(self.dataset)))
+
+    def test_add(self):
+        nxyz = list(self.dataset.props["nxyz"])
+        dataset = self.dataset + self.packed
+        assert len(dataset) == 2 * len(self.dataset)
+        assert self.dataset.props["nxyz"] == nxyz
+
+        view = DatasetView([self.dataset, self.packed])
+        for i in range(len(dataset)):
+            assert_items_equal(dataset[i], view[i])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest as ut
+
+import torch
+from ase.build import molecule
+from torch import nn
+
+from nff.io.ase import AtomsBatch
+from nff.nn.ensemble import EnsembleExecutor
+from nff.nn.models.painn import Painn
+from nff.tests.conftest import PAINN_PARAMS
+
+
+class NoXyzModel(nn.Module):
+    """Model whose forward only takes the batch."""
+
+    def __init__(self):
+        super().__init__()
+        self.cutoff = 3.0
+        self.linear = nn.Linear(3, 1)
+
+    def forward(self, batch):
+        return {"energy": self.linear(batch["nxyz"][:, 1:]).sum().reshape(1)}
+
+
+class TestEnsembleExecutor(ut.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.models = [Painn(PAINN_PARAMS).eval() for _ in range(3)]
+        # the skin adds pairs beyond the cutoff, which the executor has to remove
+        atoms = AtomsBatch(molecule("CH3CH2OH"), cutoff=3.0, cutoff_skin=1.0, directed=True, device="cpu")
+        self.batch = atoms.get_batch()
+
+    def test_matches_sequential(self):
+        executor = EnsembleExecutor(self.models)
+        results = executor(self.batch)
+        assert executor.vectorized
+
+        expected = [model(self.batch) for model in self.models]
+        energy = torch.stack([result["energy"] for result in expected]).detach()
+        energy_grad = torch.stack([result["energy_grad"] for result in expected]).detach()
+
+        assert torch.allclose(results["energy"], energy, atol=1e-5)
+        assert torch.allclose(results["energy_grad"], energy_grad, atol=1e-5)
+        assert torch.allclose(results["energy_grad_var"], energy_grad.var(0, unbiased=False), atol=1e-5)
+
+    def test_sequential_fallback(self):
+        executor = EnsembleExecutor(self.models, vectorized=False)
+        members = executor.members(self.batch)
+        assert len(members) == len(self.models)
+        assert "energy_grad" in members[0]
+
+    def test_vectorize_failure(self):
+        executor = EnsembleExecutor([NoXyzModel() for _ in range(2)])
+        with self.assertWarns(UserWarning):
+            members = executor.members(self.batch)
+        assert not executor.vectorized
+        assert len(members) == 2
+
+
+if __name__ == "__main__":
+    ut.main()
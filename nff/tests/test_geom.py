@@ -0,0 +1,127 @@
+import unittest as ut
+
+import torch
+
+from nff.utils.geom import (
+    RMSDReferences,
+    batch_compute_distance,
+    batched_kabsch,
+    compute_distance,
+    kabsch_rmsd,
+    quaternion_to_matrix,
+    rmsd_matrix,
+)
+
+
+def random_rotation():
+    q = torch.randn(1, 4, dtype=torch.float64)
+    return quaternion_to_matrix(q / q.norm())[0]
+
+
+class TestRMSDReferences(ut.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.mol_idx = torch.LongTensor([0] * 5 + [1] * 7)
+        self.xyz = torch.randn(12, 3, dtype=torch.float64)
+
+        # rotated, translated and distorted copies of the current geometry
+        self.refs = []
+        for _ in range(5):
+            ref = self.xyz + 0.3 * torch.randn(12, 3, dtype=torch.float64)
+            self.refs.append(ref @ random_rotation().T + torch.randn(3, dtype=torch.float64))
+
+        self.references = RMSDReferences(self.mol_idx, max_refs=3)
+        for ref in self.refs:
+            self.references.append(ref)
+
+    def test_rmsd(self):
+        # only the newest references are kept
+        assert len(self.references) == 3
+
+        def with_z(xyz):
+            return torch.cat([torch.ones(len(xyz), 1, dtype=xyz.dtype), xyz], dim=1)
+
+        expected, _ = batch_compute_distance(
+            ref_nxyz=with_z(self.xyz),
+            query_nxyz=torch.stack([with_z(ref) for ref in self.refs[-3:]]),
+            mol_idx=self.mol_idx,
+            num_atoms_tensor=torch.LongTensor([5, 7]),
+            store_grad=True,
+        )
+        assert torch.allclose(self.references.rmsd(self.xyz), expected.detach())
+
+        # a mirror image can't be superimposed
+        references = RMSDReferences(torch.zeros(12, dtype=torch.long))
+        references.append(self.xyz * torch.tensor([1.0, 1.0, -1.0], dtype=torch.float64))
+        assert references.rmsd(self.xyz).item() > 0.1
+
+    def test_gaussian_bias(self):
+        heights = torch.rand(3, 2, dtype=torch.float64)
+        alpha = 2.0
+        energy, forces = self.references.gaussian_bias(self.xyz, heights, alpha)
+
+        xyz = self.xyz.clone().requires_grad_(True)
+        refs = self.references.refs[self.references.get_slots()]
+        rmsd_sq, _ = batched_kabsch(self.references.center(xyz), refs, self.mol_idx, 2)
+        expected = (heights * torch.exp(-alpha * rmsd_sq)).sum(0)
+        (grad,) = torch.autograd.grad(expected.sum(), xyz)
+
+        assert torch.allclose(energy, expected)
+        assert torch.allclose(forces, -grad)
+
+
+class TestRMSDMatrix(ut.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        base = torch.randn(8, 3, dtype=torch.float64)
+        self.xyz = torch.stack(
+            [
+                (base + 0.3 * torch.randn(8, 3, dtype=torch.float64)) @ random_rotation().T
+                + torch.randn(3, dtype=torch.float64)
+                for _ in range(11)
+            ]
+        )
+        # a mirror image, which can't be superimposed with a rotation
+        self.xyz[-1] = self.xyz[0] * torch.tensor([1.0, 1.0, -1.0], dtype=torch.float64)
+
+    def test_kabsch_rmsd(self):
+        def with_z(xyz):
+            return torch.cat([torch.ones(*xyz.shape[:-1], 1, dtype=xyz.dtype), xyz], dim=-1)
+
+        expected, _ = compute_distance(with_z(self.xyz[:4]).float(), with_z(self.xyz).float())
+        rmsd, rot = kabsch_rmsd(self.xyz[:4], self.xyz, return_rot=True)
+        fast_rmsd, _ = kabsch_rmsd(self.xyz[:4], self.xyz)
+
+        assert torch.allclose(rmsd.float(), expected.transpose(0, 1), atol=1e-5)
+        assert torch.allclose(fast_rmsd, rmsd, atol=1e-6)
+        assert rmsd[0, -1] > 0.1
+
+        # the rotations superimpose the centered geometries
+        p0 = self.xyz[:4] - self.xyz[:4].mean(1, keepdim=True)
+        p1 = self.xyz - self.xyz.mean(1, keepdim=True)
+        aligned = torch.einsum("abij,bnj->abni", rot, p1)
+        assert torch.allclose(((aligned - p0.unsqueeze(1)) ** 2).sum((-1, -2)) / 8, rmsd**2)
+        assert torch.allclose(torch.linalg.det(rot), torch.ones_like(rmsd))
+
+        # gradients
+        xyz = self.xyz.clone().requires_grad_(True)
+        grad_rmsd, _ = kabsch_rmsd(self.xyz[:4], xyz, store_grad=True)
+        assert torch.allclose(grad_rmsd, rmsd, atol=1e-6)
+        assert torch.autograd.gradcheck(lambda x: kabsch_rmsd(self.xyz[:4], x, store_grad=True)[0], (xyz[4:6],))
+
+    def test_symmetric_blocks(self):
+        expected, expected_rot = kabsch_rmsd(self.xyz, self.xyz, return_rot=True)
+        for num_workers in [1, 2]:
+            rmsd, rot = rmsd_matrix(self.xyz, block_size=3, num_workers=num_workers, return_rot=True)
+            assert torch.allclose(rmsd, expected, atol=1e-7)
+            assert torch.allclose(rot, expected_rot, atol=1e-7)
+            assert torch.equal(rmsd, rmsd.transpose(0, 1))
+            assert torch.all(rmsd.diagonal() == 0)
+
+        rmsd, rot = rmsd_matrix(self.xyz[:5], self.xyz, block_size=2)
+        assert torch.allclose(rmsd, expected[:5], atol=1e-7)
+        assert rot is None
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,99 @@
+import unittest as ut
+
+import torch
+from ase.build import bulk
+from ase.neighborlist import neighbor_list
+from chgnet.model import CHGNet
+from mace.data.atomic_data import AtomicNumberTable
+from pymatgen.io.ase import AseAtomsAdaptor
+
+from nff.io.ase import AtomsBatch
+from nff.io.chgnet import batch_to_crystal_graphs
+from nff.io.mace import batch_to_mace_data
+from nff.nn.models.chgnet import CHGNetNFF
+
+
+def get_atoms():
+    atoms = bulk("Cu", "fcc", a=3.6) * (2, 2, 2)
+    atoms.rattle(0.1, seed=1)
+    atoms[0].symbol = "O"
+    return atoms
+
+
+class TestMaceAdapter(ut.TestCase):
+    def test_edges(self):
+        atoms = get_atoms()
+        r_max = 4.0
+        z_table = AtomicNumberTable([8, 29])
+        for directed in [True, False]:
+            batch = AtomsBatch(atoms, cutoff=r_max, cutoff_skin=1.0, directed=directed, device="cpu").get_batch()
+            cache = {}
+            data = batch_to_mace_data(batch, z_table=z_table, r_max=r_max, cache=cache)
+
+            i, j, S = neighbor_list("ijS", atoms, r_max)
+            expected = {(a, b, *s) for a, b, s in zip(i.tolist(), j.tolist(), S.tolist())}
+            edges = torch.cat([data["edge_index"].T, data["unit_shifts"].long()], dim=1)
+            assert {tuple(edge) for edge in edges.tolist()} == expected
+            assert len(edges) == len(expected)
+            assert torch.equal(data["node_attrs"].argmax(1), (batch["nxyz"][:, 0] == 29).long())
+
+            # the static parts are reused for the next step
+            nodes = cache["nodes"]
+            batch_to_mace_data(batch, z_table=z_table, r_max=r_max, cache=cache)
+            assert cache["nodes"] is nodes
+
+    def test_cache_in_place_update(self):
+        atoms = get_atoms()
+        z_table = AtomicNumberTable([8, 29])
+        batch = AtomsBatch(atoms, cutoff=4.0, cutoff_skin=1.0, directed=True, device="cpu").get_batch()
+        batch["offsets"] = batch["offsets"].to_dense()
+        cache = {}
+        batch_to_mace_data(batch, z_table=z_table, r_max=4.0, cache=cache)
+
+        # a neighbor list refilled in place with the same shape doesn't hit the cache
+        nbr_list, offsets = batch["nbr_list"], batch["offsets"]
+        half = len(nbr_list) // 2
+        nbr_list.copy_(torch.cat([nbr_list[half:], nbr_list[: len(nbr_list) - half]]))
+        offsets.copy_(torch.cat([offsets[half:], offsets[: len(offsets) - half]]))
+        data = batch_to_mace_data(batch, z_table=z_table, r_max=4.0, cache=cache)
+        expected = batch_to_mace_data(batch, z_table=z_table, r_max=4.0)
+        assert torch.equal(data["edge_index"], expected["edge_index"])
+        assert torch.equal(data["shifts"], expected["shifts"])
+
+
+class TestCHGNetAdapter(ut.TestCase):
+    def setUp(self):
+        self.model = CHGNetNFF.load(device="cpu")
+        self.atoms = get_atoms()
+
+    def test_matches_converter(self):
+        graph = self.model.graph_converter(AseAtomsAdaptor.get_structure(self.atoms))
+        expected = CHGNet.forward(self.model, [graph], task="ef")
+
+        batch = AtomsBatch(self.atoms, cutoff=6.5, directed=True, device="cpu").get_batch()
+        (new_graph,) = batch_to_crystal_graphs(batch, atom_graph_cutoff=6, bond_graph_cutoff=3)
+        assert new_graph.atom_graph.shape == graph.atom_graph.shape
+        assert new_graph.bond_graph.shape == graph.bond_graph.shape
+
+        results = self.model(batch)
+        assert torch.allclose(results["energy"], expected["e"], atol=1e-5)
+        assert torch.allclose(-results["energy_grad"], expected["f"][0], atol=1e-4)
+
+    def test_cache_in_place_update(self):
+        batch = AtomsBatch(self.atoms, cutoff=6.5, directed=True, device="cpu").get_batch()
+        batch["offsets"] = batch["offsets"].to_dense()
+        cache = {}
+        batch_to_crystal_graphs(batch, atom_graph_cutoff=6, bond_graph_cutoff=3, cache=cache)
+
+        # a strained cell whose offsets are refilled in place doesn't hit the cache
+        batch["cell"] = batch["cell"] * 1.02
+        batch["nxyz"][:, 1:] *= 1.02
+        batch["offsets"].mul_(1.02)
+        batch_to_crystal_graphs(batch, atom_graph_cutoff=6, bond_graph_cutoff=3, cache=cache)
+        expected = {}
+        batch_to_crystal_graphs(batch, atom_graph_cutoff=6, bond_graph_cutoff=3, cache=expected)
+        assert torch.allclose(cache["edges"]["offsets"], expected["edges"]["offsets"])
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,41 @@
+import unittest as ut
+
+import numpy as np
+import torch
+from ase.build import molecule
+
+from nff.data.loader import collate_dicts
+from nff.io.ase import AtomsBatch
+from nff.nn.models.painn import Painn
+from nff.nn.tensorgrad import BatchHessian, get_painn_hessians
+from nff.tests.conftest import PAINN_PARAMS
+
+
+class TestBatchHessian(ut.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = Painn(PAINN_PARAMS).eval()
+        self.batches = []
+        for name in ["CH3CH2OH", "H2O", "CH4"]:
+            batch = AtomsBatch(molecule(name), cutoff=3.0, directed=True, device="cpu").get_batch()
+            self.batches.append({key: batch[key] for key in ["nxyz", "num_atoms", "nbr_list"]})
+
+    def test_blocks(self):
+        blocks = BatchHessian(collate_dicts(self.batches), model=self.model).blocks(chunk_size=5)
+
+        for batch, block in zip(self.batches, blocks):
+            expected = get_painn_hessians(batch, self.model, device="cpu").squeeze(0)
+            assert block.shape == expected.shape
+            assert (block - expected).abs().max() < 1e-5 * expected.abs().max()
+
+    def test_lowest_modes(self):
+        engine = BatchHessian(collate_dicts(self.batches), model=self.model)
+        hessian = engine.blocks()[0].double().numpy()
+        eigvals, eigvecs = engine.lowest_modes(k=2, geom_idx=0)
+
+        assert np.allclose(eigvals, np.linalg.eigvalsh(hessian)[:2], atol=1e-3)
+        assert eigvecs.shape == (hessian.shape[0], 2)
+
+
+if __name__ == "__main__":
+    ut.main()
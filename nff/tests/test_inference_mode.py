@@ -0,0 +1,41 @@
+import unittest as ut
+
+import torch
+from ase.build import molecule
+
+from nff.io.ase import AtomsBatch
+from nff.nn.models.painn import Painn
+from nff.nn.tensorgrad import BatchHessian
+from nff.tests.conftest import PAINN_PARAMS
+from nff.utils.scatter import inference_mode, is_inference_mode
+
+
+class TestInferenceMode(ut.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = Painn(PAINN_PARAMS).eval()
+        atoms = AtomsBatch(molecule("CH3CH2OH"), cutoff=3.0, cutoff_skin=1.0, directed=True, device="cpu")
+        self.batch = atoms.get_batch()
+
+    def test_first_order_grads(self):
+        expected = self.model(self.batch)
+        assert expected["energy_grad"].requires_grad
+
+        with inference_mode():
+            assert is_inference_mode()
+            results = self.model(self.batch)
+        assert not is_inference_mode()
+
+        assert not results["energy_grad"].requires_grad
+        assert torch.allclose(results["energy_grad"], expected["energy_grad"], atol=1e-6)
+
+    def test_hessian_in_inference_mode(self):
+        expected = BatchHessian(self.batch, model=self.model).blocks()[0]
+        with inference_mode():
+            hessian = BatchHessian(self.batch, model=self.model).blocks()[0]
+
+        assert torch.allclose(hessian, expected, rtol=1e-5, atol=1e-5 * expected.abs().max().item())
+
+
+if __name__ == "__main__":
+    ut.main()
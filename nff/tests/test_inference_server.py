@@ -0,0 +1,102 @@
+import os
+import stat
+import tempfile
+import threading
+import unittest as ut
+from multiprocessing import AuthenticationError
+
+import numpy as np
+import torch
+from ase.build import molecule
+
+from nff.io.ase import AtomsBatch
+from nff.io.ase_calcs import NeuralFF
+from nff.io.inference_server import InferenceServer, RemoteNeuralFF
+from nff.nn.models.painn import Painn
+from nff.tests.conftest import PAINN_PARAMS
+
+MOLECULES = ["CH3CH2OH", "H2O", "CH4", "CO2", "C6H6", "NH3"]
+
+
+def get_atoms(name):
+    # symmetric geometries make the float32 forces sensitive to round-off
+    mol = molecule(name)
+    mol.rattle(0.05, seed=0)
+    return AtomsBatch(mol, cutoff=3.0, cutoff_skin=1.0, directed=True, device="cpu")
+
+
+class TestInferenceServer(ut.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = Painn(PAINN_PARAMS).eval()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.tmpdir.name, "nff.sock")
+        self.server = InferenceServer(self.model, self.address, max_wait=0.5)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def test_concurrent_clients(self):
+        expected = []
+        for name in MOLECULES:
+            atoms = get_atoms(name)
+            atoms.calc = NeuralFF(self.model, device="cpu")
+            expected.append((atoms.get_potential_energy(), atoms.get_forces()))
+
+        all_atoms = [get_atoms(name) for name in MOLECULES]
+        results = [None] * len(all_atoms)
+        barrier = threading.Barrier(len(all_atoms))
+
+        def run(i):
+            atoms = all_atoms[i]
+            atoms.calc = RemoteNeuralFF(self.address)
+            barrier.wait()
+            results[i] = (atoms.get_potential_energy(), atoms.get_forces())
+            atoms.calc.close()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(all_atoms))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for (energy, forces), (expected_energy, expected_forces) in zip(results, expected):
+            assert np.allclose(energy, expected_energy, atol=1e-5)
+            assert np.allclose(forces, expected_forces, atol=1e-5)
+
+        assert self.server.num_requests == len(MOLECULES)
+        assert self.server.num_batches < len(MOLECULES)
+
+    def test_error(self):
+        atoms = AtomsBatch(molecule("H2O"), cutoff=3.0, directed=False, device="cpu")
+        atoms.calc = RemoteNeuralFF(self.address)
+        with self.assertRaises(AssertionError):
+            atoms.get_forces()
+        atoms.calc.close()
+
+    def test_authentication(self):
+        # only the user running the server can connect to the socket
+        assert stat.S_IMODE(os.stat(self.address).st_mode) == 0o600
+
+        server = InferenceServer(self.model, ("127.0.0.1", 0))
+        server.start()
+        try:
+            assert len(server.authkey) == 32
+            address = server.listener.address
+
+            atoms = get_atoms("H2O")
+            atoms.calc = RemoteNeuralFF(address, authkey=b"wrong key")
+            with self.assertRaises(AuthenticationError):
+                atoms.get_forces()
+
+            atoms.calc = RemoteNeuralFF(address, authkey=server.authkey)
+            assert atoms.get_forces().shape == (3, 3)
+            atoms.calc.close()
+        finally:
+            server.close()
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,74 @@
+import unittest as ut
+
+import numpy as np
+import torch
+from ase import Atoms
+from ase.build import molecule
+from ase.constraints import FixAtoms
+from ase.md.velocitydistribution import MaxwellBoltzmannDistribution, Stationary, ZeroRotation
+
+from nff.io.ase import AtomsBatch
+from nff.io.ase_calcs import NeuralFF
+from nff.md.nvt import BatchLangevin, batch_stationary, batch_zero_rotation
+from nff.nn.models.painn import Painn
+from nff.tests.conftest import PAINN_PARAMS
+
+MOLECULES = ["CH3CH2OH", "H2O", "CH4", "CO2"]
+
+
+def get_batch_atoms():
+    mols = [molecule(name) for name in MOLECULES]
+    atoms = Atoms(
+        numbers=np.concatenate([mol.numbers for mol in mols]),
+        positions=np.concatenate([mol.positions for mol in mols]),
+    )
+    props = {"num_atoms": torch.LongTensor([len(mol) for mol in mols])}
+    return mols, AtomsBatch(atoms, props=props, cutoff=3.0, cutoff_skin=1.0, directed=True, device="cpu")
+
+
+class TestBatchLangevin(ut.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.mols, self.atoms = get_batch_atoms()
+        self.atoms.calc = NeuralFF(Painn(PAINN_PARAMS).eval(), device="cpu")
+        self.mol_idx = torch.repeat_interleave(torch.arange(len(self.mols)), self.atoms.props["num_atoms"])
+
+    def test_helpers_match_ase(self):
+        momenta = []
+        for mol in self.mols:
+            MaxwellBoltzmannDistribution(mol, temperature_K=300)
+            momenta.append(mol.get_momenta())
+        momenta = torch.tensor(np.concatenate(momenta))
+        positions = torch.tensor(self.atoms.get_positions())
+        masses = torch.tensor(self.atoms.get_masses()).reshape(-1, 1)
+
+        momenta = batch_stationary(momenta, masses, self.mol_idx, len(self.mols))
+        momenta = batch_zero_rotation(positions, momenta, masses, self.mol_idx, len(self.mols))
+
+        expected = []
+        for mol in self.mols:
+            Stationary(mol)
+            ZeroRotation(mol)
+            expected.append(mol.get_momenta())
+
+        assert np.allclose(momenta.numpy(), np.concatenate(expected), atol=1e-8)
+
+    def test_run(self):
+        self.atoms.set_constraint(FixAtoms(indices=[0, 1]))
+        dyn = BatchLangevin(self.atoms, timestep=0.5, temperature=300, random_seed=1, nbr_update_period=10)
+        start = self.atoms.get_positions()
+        dyn.run(20)
+
+        end = self.atoms.get_positions()
+        assert np.allclose(end[:2], start[:2])
+        assert not np.allclose(end[2:], start[2:])
+        assert np.allclose(self.atoms.calc.results["forces"], dyn.forces.numpy())
+
+        # the center-of-mass momentum is removed from the molecules without fixed atoms
+        momenta = torch.tensor(self.atoms.get_momenta())
+        total = torch.zeros(len(self.mols), 3, dtype=momenta.dtype).index_add_(0, self.mol_idx, momenta)
+        assert torch.allclose(total[1:], torch.zeros_like(total[1:]), atol=1e-10)
+
+
+if __name__ == "__main__":
+    ut.main()
@@ -0,0 +1,135 @@
+import copy
+import unittest as ut
+
+import torch
+from ase.build import bulk, molecule
+
+from nff.data import collate_dicts
+from nff.io.ase import AtomsBatch
+from nff.nn.models.painn import Painn
+from nff.nn.modules.schnet import get_rij, sum_and_grad
+from nff.tests.conftest import PAINN_PARAMS
+
+
+class TestEdgeCache(ut.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = Painn(PAINN_PARAMS).eval()
+        # the skin adds pairs beyond the cutoff, which the model has to remove
+        atoms = AtomsBatch(molecule("CH3CH2OH"), cutoff=3.0, cutoff_skin=1.0, directed=True, device="cpu")
+        self.batch = atoms.get_batch()
+
+    def displaced(self, step):
+        batch = self.batch.copy()
+        batch["nxyz"] = self.batch["nxyz"].clone()
+        batch["nxyz"][:, 1:] += 0.02 * step * torch.randn(batch["nxyz"].shape[0], 3)
+        return batch
+
+    def test_edge_skin(self):
+        skin_model = copy.deepcopy(self.model)
+        skin_model.edge_skin = 0.5
+
+        for step in range(5):
+            batch = self.displaced(step)
+            expected = self.model(batch)
+            results = skin_model(batch)
+            for key in ["energy", "energy_grad"]:
+                assert torch.allclose(results[key], expected[key], atol=1e-5)
+            if step == 0:
+                all_nbrs = skin_model.edge_cache["all_nbrs"]
+
+        # the directed neighbor list is built once for the whole trajectory
+        assert skin_model.edge_cache["all_nbrs"] is all_nbrs
+
+    def test_in_place_refill(self):
+        # the directed edges are derived from an undirected neighbor list
+        atoms = AtomsBatch(molecule("CH3CH2OH"), cutoff=3.0, cutoff_skin=1.0, directed=False, device="cpu")
+        batch = {key: val for key, val in atoms.get_batch().items() if key != "offsets"}
+        self.model(batch)
+
+        # a neighbor list refilled in place with the same shape doesn't hit the cache
+        nbr_list = batch["nbr_list"]
+        half = len(nbr_list) // 2
+        nbr_list.copy_(torch.cat([nbr_list[:half], nbr_list[: len(nbr_list) - half]]))
+        results = self.model(batch)
+
+        fresh_model = copy.deepcopy(self.model)
+        expected = fresh_model(batch)
+        assert torch.equal(self.model.edge_cache["all_nbrs"], fresh_model.edge_cache["all_nbrs"])
+        for key in ["energy", "energy_grad"]:
+            assert torch.allclose(results[key], expected[key], atol=1e-5)
+
+    def test_excluded_volume(self):
+        torch.manual_seed(0)
+        model = Painn({**PAINN_PARAMS, "excl_vol": True, "V_ex_power": 9, "V_ex_sigma": 1.0}).eval()
+        skin_model = copy.deepcopy(model)
+        skin_model.edge_skin = 2.0
+
+        # the excluded volume term has no envelope, so the skin isn't used
+        for step in range(3):
+            batch = self.displaced(step)
+            assert torch.allclose(skin_model(batch)["energy"], model(batch)["energy"])
+
+    def test_cache_not_copied(self):
+        self.model(self.batch)
+        assert self.model.edge_cache
+        assert not copy.deepcopy(self.model).edge_cache
+
+
+class TestStress(ut.TestCase):
+    def test_mixed_batch(self):
+        torch.manual_seed(0)
+        model = Painn({**PAINN_PARAMS, "grad_keys": ["energy_grad"]}).eval()
+        structures = [
+            bulk("Si", "diamond", 5.43),
+            molecule("CH3CH2OH"),
+            bulk("Si", "diamond", 5.43).repeat((2, 1, 1)),
+        ]
+
+        batches = []
+        for atoms in structures:
+            # away from equilibrium, so the stress isn't dominated by round-off
+            atoms.rattle(0.1, seed=0)
+            atoms = AtomsBatch(atoms, cutoff=3.0, cutoff_skin=1.0, directed=True, device="cpu")
+            batch = atoms.get_batch()
+            batch = {key: batch[key] for key in ["nxyz", "nbr_list", "offsets", "num_atoms"]}
+            batch["offsets"] = batch["offsets"].to_dense()
+            batches.append(batch)
+
+        expected = torch.stack([model(batch, requires_stress=True)["stress_volume"] for batch in batches])
+        results = model(collate_dicts(batches), requires_stress=True)
+
+        assert results["stress_volume"].shape == (3, 3, 3)
+        assert torch.allclose(results["stress_volume"], expected, atol=1e-5)
+
+    def test_sum_and_grad(self):
+        structures = [bulk("Si", "diamond", 5.43), bulk("Si", "diamond", 5.43).repeat((2, 1, 1))]
+        batches = []
+        for atoms in structures:
+            atoms.rattle(0.1, seed=0)
+            batch = AtomsBatch(atoms, cutoff=3.0, directed=True, device="cpu").get_batch()
+            batch = {key: batch[key] for key in ["nxyz", "nbr_list", "offsets", "num_atoms"]}
+            batch["offsets"] = batch["offsets"].to_dense()
+            batches.append(batch)
+        batch = collate_dicts(batches)
+        batch["lattice"] = torch.cat([torch.Tensor(atoms.get_cell().array) for atoms in structures])
+
+        xyz = batch["nxyz"][:, 1:].requires_grad_()
+        r_ij, nbrs = get_rij(xyz, batch, batch["nbr_list"], cutoff=3.0)
+        # E = sum of |r_ij|^2 / 2, so that dE/dr_ij = r_ij
+        energy = torch.zeros(len(xyz)).index_add(0, nbrs[:, 0], (r_ij**2).sum(-1) / 2)
+        results = sum_and_grad(batch, xyz, r_ij, nbrs, {"energy": energy}, grad_keys=["stress"])
+
+        expected = []
+        start = 0
+        for atoms in structures:
+            in_structure = (nbrs[:, 0] >= start) & (nbrs[:, 0] < start + len(atoms))
+            expected.append(r_ij[in_structure].t() @ r_ij[in_structure] / atoms.get_volume())
+            start += len(atoms)
+
+        assert results["stress"].shape == (6, 3)
+        assert torch.allclose(results["stress"], torch.cat(expected), atol=1e-5)
+
+
+if __name__ == "__main__":
+    ut.main()
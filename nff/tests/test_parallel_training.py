@@ -0,0 +1,24 @@
+import os
+from types import SimpleNamespace
+
+import torch.distributed as dist
+
+from nff.train import Trainer
+from nff.train.parallel import all_gather, all_reduce_sum, init_process_group
+
+
+def test_reduce_val_loss(tmpdir):
+    init_process_group(global_rank=0, world_size=1, init_method=f"file://{os.path.join(tmpdir, 'pg')}")
+    try:
+        assert dist.get_backend() == "gloo"
+        assert all_reduce_sum([1.5, 2.0]) == [1.5, 2.0]
+        assert all_gather({"loss": 1.0}) == [{"loss": 1.0}]
+
+        # normalized losses are averaged over the processes, others are added
+        trainer = SimpleNamespace(loss_is_normalized=True, mol_loss_norm=False)
+        assert Trainer.reduce_val_loss(trainer, 2.5, 10) == 2.5
+
+        trainer = SimpleNamespace(loss_is_normalized=False, mol_loss_norm=False)
+        assert Trainer.reduce_val_loss(trainer, 3.0, 10, device="cpu") == 3.0
+    finally:
+        dist.destroy_process_group()
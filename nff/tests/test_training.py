@@ -3,9 +3,10 @@ import pathlib
 
 import torch
 from torch.optim import Adam
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, WeightedRandomSampler
 
 from nff.data import Dataset, collate_dicts, split_train_validation_test
+from nff.data.loader import SizeBatchSampler
 from nff.train import Trainer, evaluate, get_model, hooks, loss, metrics
 
 
@@ -69,3 +70,64 @@ def test_training(device, tmpdir):
         targ = torch.stack(targets[key], dim=0).view(-1).detach().cpu().numpy()
         mae = abs(pred - targ).mean()
         assert mae < 10.0
+
+
+class BatchCountHook(hooks.Hook):
+    def __init__(self):
+        self.batches = []
+        self.expected = []
+
+    def on_epoch_begin(self, trainer):
+        self.batches.append(0)
+
+    def on_batch_begin(self, trainer, train_batch):
+        self.batches[-1] += 1
+
+    def on_epoch_end(self, trainer):
+        self.expected.append(trainer.max_batch_iters)
+
+
+def test_variable_epoch_length(device, tmpdir):
+    dataset = Dataset.from_file(os.path.join(pathlib.Path(__file__).parent.absolute(), "data", "dataset.pth.tar"))
+
+    # fragments of different sizes, so that the number of batches packed
+    # from weighted samples changes every epoch
+    torch.manual_seed(0)
+    sizes = torch.randint(2, 10, (200,)).tolist()
+    props = {
+        "nxyz": [nxyz[:n] for nxyz, n in zip(dataset.props["nxyz"], sizes)],
+        "energy": dataset.props["energy"][:200],
+    }
+    dataset = Dataset(props, units=dataset.units)
+    dataset.generate_neighbor_list(cutoff=5.0)
+
+    sampler = WeightedRandomSampler(torch.rand(len(dataset)), num_samples=len(dataset))
+    batch_sampler = SizeBatchSampler.from_dataset(dataset, sampler=sampler, max_atoms=40, bucket_size=50)
+    train_loader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_dicts)
+    val_loader = DataLoader(dataset, batch_size=100, collate_fn=collate_dicts)
+
+    params = {
+        "n_atom_basis": 16,
+        "n_filters": 16,
+        "n_gaussians": 8,
+        "n_convolutions": 1,
+        "cutoff": 5.0,
+    }
+    model = get_model(params)
+    count_hook = BatchCountHook()
+
+    T = Trainer(
+        model_path=tmpdir,
+        model=model,
+        loss_fn=loss.build_mse_loss(loss_coef={"energy": 1}),
+        optimizer=Adam(model.parameters(), lr=1e-4),
+        train_loader=train_loader,
+        validation_loader=val_loader,
+        checkpoint_interval=1,
+        hooks=[count_hook],
+    )
+    T.train(device=device, n_epochs=4)
+
+    # every epoch goes through all of its batches, and no further
+    assert count_hook.batches == count_hook.expected
+    assert len(set(count_hook.batches)) > 1
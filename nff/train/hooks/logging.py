@@ -13,6 +13,7 @@ import torch
 
 from nff.train.hooks import Hook
 from nff.train.metrics import PrAuc, RocAuc, RootMeanSquaredError
+from nff.train.parallel import all_gather, dist_is_initialized
 
 
 class LoggingHook(Hook):
@@ -154,6 +155,25 @@ class LoggingHook(Hook):
             dic = {}
 
         # update with metrics
+        dic.update(self.get_metric_data())
+
+        # save
+        with open(json_file, "w") as f:
+            json.dump(dic, f, indent=4, sort_keys=True)
+
+    def get_metric_data(self):
+        """
+        Get the data of each metric that is shared with the other parallel
+        processes.
+        Args:
+            None
+        Returns:
+            dic (dict): dictionary of each metric name with its value,
+                or with its labels and predictions for metrics that can't
+                be averaged.
+        """
+
+        dic = {}
         for metric in self.metrics:
             if type(metric) in [RocAuc, PrAuc]:
                 m = {"y_true": metric.actual, "y_pred": metric.pred}
@@ -161,33 +181,25 @@ class LoggingHook(Hook):
                 m = metric.aggregate()
             dic[metric.name] = m
 
-        # save
-        with open(json_file, "w") as f:
-            json.dump(dic, f, indent=4, sort_keys=True)
+        return dic
 
-    def avg_parallel_metrics(self, epoch, test):
+    def load_parallel_metrics(self, epoch, test):
         """
-        Average metrics over parallel processes.
+        Save the metrics from this process and load those of all the
+        parallel processes from disk.
         Args:
             epoch (int): current epoch
         Returns:
-            metric_dic (dict): dictionary of each metric name with its
-                corresponding averaged value.
+            par_dics (list[dict]): metric data from each process
         """
 
-        # save metrics from this process
-
         self.save_metrics(epoch, test)
-        metric_dic = {}
+        par_dics = {folder: {} for folder in self.par_folders}
 
         for metric in self.metrics:
-            # initialize par_dic as a dictionary with None for each parallel
-            # folder
-            par_dic = {folder: None for folder in self.par_folders}
-
             # continue looping through other folders until you've succesfully
             # loaded their metric values
-            while None in par_dic.values():
+            while any(metric.name not in dic for dic in par_dics.values()):
                 for folder in self.par_folders:
                     if test:
                         path = os.path.join(folder, f"epoch_{epoch}_test.json")
@@ -196,18 +208,46 @@ class LoggingHook(Hook):
                     try:
                         with open(path, "r") as f:
                             path_dic = json.load(f)
-                        par_dic[folder] = path_dic[metric.name]
+                        par_dics[folder][metric.name] = path_dic[metric.name]
                     except (json.JSONDecodeError, FileNotFoundError, KeyError):
                         continue
 
+        return list(par_dics.values())
+
+    def avg_parallel_metrics(self, epoch, test, use_collectives=True):
+        """
+        Average metrics over parallel processes. If a `torch.distributed`
+        process group has been initialized, the metrics are gathered with
+        a collective; otherwise they are exchanged through files.
+        Args:
+            epoch (int): current epoch
+            use_collectives (bool): whether the metrics may be gathered with
+                a collective. DistributedDataParallel training exchanges them
+                through files, because its backend (e.g. NCCL) may not support
+                CPU collectives.
+        Returns:
+            metric_dic (dict): dictionary of each metric name with its
+                corresponding averaged value.
+        """
+
+        if use_collectives and dist_is_initialized():
+            par_dics = all_gather(self.get_metric_data())
+        else:
+            par_dics = self.load_parallel_metrics(epoch, test)
+
+        metric_dic = {}
+
+        for metric in self.metrics:
+            par_vals = [dic[metric.name] for dic in par_dics]
+
             # average appropriately
 
             if isinstance(metric, RootMeanSquaredError):
-                metric_val = np.mean(np.array(list(par_dic.values)) ** 2) ** 0.5
+                metric_val = np.mean(np.array(par_vals) ** 2) ** 0.5
             elif type(metric) in [RocAuc, PrAuc]:
                 y_true = []
                 y_pred = []
-                for sub_dic in par_dic.values():
+                for sub_dic in par_vals:
                     y_true += sub_dic["y_true"]
                     y_pred += sub_dic["y_pred"]
                 metric.actual = y_true
@@ -215,7 +255,7 @@ class LoggingHook(Hook):
                 metric_val = metric.aggregate()
 
             else:
-                metric_val = np.mean(list(par_dic.values()))
+                metric_val = np.mean(par_vals)
             metric_dic[metric.name] = metric_val
 
         return metric_dic
@@ -232,7 +272,9 @@ class LoggingHook(Hook):
 
         # if parallel, average over parallel metrics
         if self.parallel:
-            metric_dic = self.avg_parallel_metrics(epoch=trainer.epoch, test=test)
+            metric_dic = self.avg_parallel_metrics(
+                epoch=trainer.epoch, test=test, use_collectives=not getattr(trainer, "torch_parallel", False)
+            )
 
         # otherwise aggregate as usual
         else:
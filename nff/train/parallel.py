@@ -1,11 +1,16 @@
 """
-Tools to implement parallelization by writing quantities to disk and loading them
-between processes.
+Tools to implement parallelization between processes. If a `torch.distributed`
+process group has been initialized, gradients and metrics are combined with
+collective operations. Otherwise quantities are written to disk and loaded
+by the other processes.
 """
 
 import os
 import pickle
 
+import torch
+import torch.distributed as dist
+
 
 def get_grad(optimizer):
     grad_list = []
@@ -112,3 +117,100 @@ def update_optim(
     )
 
     return optimizer
+
+
+def dist_is_initialized():
+    """Whether a `torch.distributed` process group is available for syncing."""
+    return dist.is_available() and dist.is_initialized()
+
+
+def init_process_group(global_rank, world_size, init_method=None, backend="gloo"):
+    """
+    Initialize the default `torch.distributed` process group. The gloo backend
+    works on CPU, so it doesn't need GPUs or NCCL.
+    Args:
+        global_rank (int): overall rank of this process
+        world_size (int): total number of processes
+        init_method (str, optional): URL specifying how to find the other
+            processes (e.g. "tcp://host:port" or "file:///path/to/file").
+            If not given, the `MASTER_ADDR` and `MASTER_PORT` environment
+            variables are used.
+        backend (str): distributed backend
+    Returns:
+        None
+    """
+    if dist_is_initialized():
+        return
+    dist.init_process_group(backend=backend, init_method=init_method, rank=global_rank, world_size=world_size)
+
+
+def comm_device(device):
+    """Device on which tensors have to be for collectives with the current backend."""
+    return "cpu" if dist.get_backend() == "gloo" else device
+
+
+def all_reduce_grads(optimizer, loss_size, device):
+    """
+    Sum the gradients and loss sizes of all processes with one all-reduce, and
+    divide the gradients by the total size. Every process ends up with the same
+    gradients, as in `add_grads`.
+    Args:
+        optimizer (torch.optim.Optimizer): optimizer whose gradients are synced
+        loss_size (int): number of atoms or molecules whose losses were added
+            into the gradients of this process
+        device (str): device of the model parameters
+    Returns:
+        optimizer (torch.optim.Optimizer): optimizer with synced gradients
+    """
+
+    params = [param for group in optimizer.param_groups for param in group["params"]]
+    # parameters without gradients contribute zeros, so the buffers have the
+    # same size on all processes
+    grads = [
+        torch.zeros(param.numel(), dtype=param.dtype, device=device)
+        if param.grad is None
+        else param.grad.detach().reshape(-1)
+        for param in params
+    ]
+    size = torch.tensor([float(loss_size)], device=device)
+
+    flat = torch.cat(grads + [size]).to(comm_device(device))
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat = flat.to(device)
+
+    total_size = flat[-1]
+    start = 0
+    for param in params:
+        stop = start + param.numel()
+        if param.grad is not None:
+            param.grad.copy_((flat[start:stop] / total_size).reshape(param.shape))
+        start = stop
+
+    return optimizer
+
+
+def all_reduce_sum(values, device="cpu"):
+    """
+    Sum a list of numbers over all processes.
+    Args:
+        values (list[float]): numbers from this process
+        device (str): device to do the reduction on for non-gloo backends
+    Returns:
+        totals (list[float]): numbers summed over all processes
+    """
+    tensor = torch.tensor(values, dtype=torch.double, device=comm_device(device))
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def all_gather(obj):
+    """
+    Gather a picklable object from all processes.
+    Args:
+        obj: object from this process
+    Returns:
+        objs (list): objects from all processes, ordered by rank
+    """
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
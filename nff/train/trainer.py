@@ -13,7 +13,7 @@ from tqdm import tqdm
 
 from nff.train.evaluate import evaluate
 from nff.train.hooks.scheduling import ReduceLROnPlateauHook
-from nff.train.parallel import update_optim
+from nff.train.parallel import all_reduce_grads, all_reduce_sum, dist_is_initialized, update_optim
 from nff.utils.cuda import batch_detach, batch_to
 
 MAX_EPOCHS = 100
@@ -55,6 +55,9 @@ class Trainer:
             in a batch
        del_grad_interval (int, optional): if training in parallel and writing gradients to disk,
             this is the number of batches that must pass before deleting old gradients.
+            Gradients are only written to disk if no `torch.distributed` process group
+            has been initialized (see `nff.train.parallel.init_process_group`); otherwise
+            they are synced with an all-reduce.
        metric_as_loss (str, optional): if specified, use this metric to determine which validation
             epoch was the best, rather than the validation loss.
        metric_objective (str, optional): if metric_as_loss is specified, metric_objective indicates
@@ -117,7 +120,10 @@ class Trainer:
         self.base = global_rank == 0
         # how many times you've called loss.backward()
         self.back_count = 0
-        # maximum number of batches to iterate through
+        # maximum number of batches to iterate through. If it isn't given it's
+        # the length of the loader, which is updated every epoch because it can
+        # change (e.g. a `SizeBatchSampler` packing weighted samples)
+        self.update_batch_iters = max_batch_iters is None
         self.max_batch_iters = max_batch_iters if (max_batch_iters is not None) else len(self.train_loader)
         self.model_kwargs = model_kwargs if (model_kwargs is not None) else {}
         self.batch_stop = False
@@ -281,18 +287,21 @@ class Trainer:
 
     def optim_step(self, batch_num, device):
         if self.parallel and not self.torch_parallel:
-            self.optimizer = update_optim(
-                optimizer=self.optimizer,
-                loss_size=self.nloss,
-                rank=self.global_rank,
-                world_size=self.world_size,
-                weight_path=self.model_path,
-                batch_num=batch_num,
-                epoch=self.epoch,
-                del_interval=self.del_grad_interval,
-                device=device,
-                max_batch_iters=self.max_batch_iters,
-            )
+            if dist_is_initialized():
+                self.optimizer = all_reduce_grads(optimizer=self.optimizer, loss_size=self.nloss, device=device)
+            else:
+                self.optimizer = update_optim(
+                    optimizer=self.optimizer,
+                    loss_size=self.nloss,
+                    rank=self.global_rank,
+                    world_size=self.world_size,
+                    weight_path=self.model_path,
+                    batch_num=batch_num,
+                    epoch=self.epoch,
+                    del_interval=self.del_grad_interval,
+                    device=device,
+                    max_batch_iters=self.max_batch_iters,
+                )
             if not self.grad_is_nan():
                 self.optimizer.step()
             self.nloss = 0
@@ -372,6 +381,10 @@ class Trainer:
                 if self._stop:
                     break
 
+                self.back_count = 0
+                if self.update_batch_iters:
+                    self.max_batch_iters = len(self.train_loader)
+
                 for j, batch in self.tqdm_enum(self.train_loader):
                     for hook in self.hooks:
                         hook.on_batch_begin(self, batch)
@@ -535,6 +548,30 @@ class Trainer:
 
         return avg_loss
 
+    def reduce_val_loss(self, val_loss, n_val, device="cpu"):
+        """
+        Combine the validation losses of all parallel processes with a
+        `torch.distributed` all-reduce.
+        Args:
+            val_loss (float): validation loss from this trainer
+            n_val (int): number of atoms or molecules in the validation set
+                of this trainer
+            device (str): device of the model, used for the reduction with
+                backends that don't support CPU tensors (e.g. NCCL)
+        Returns:
+            avg_loss (float): validation loss averaged among all
+                processes if self.loss_is_normalized = True,
+                and added otherwise.
+        """
+
+        val_loss = float(val_loss)
+        if self.loss_is_normalized or self.mol_loss_norm:
+            total_loss, total_n = all_reduce_sum([val_loss * n_val, n_val], device=device)
+            return total_loss / total_n
+
+        (total_loss,) = all_reduce_sum([val_loss], device=device)
+        return total_loss
+
     def save(self, model):
         """
         Save the model
@@ -620,7 +657,10 @@ class Trainer:
         # if running in parallel, save the validation loss
         # and pick up the losses from the other processes too
 
-        if self.parallel:
+        # DistributedDataParallel keeps exchanging the losses through files
+        if self.parallel and not self.torch_parallel and dist_is_initialized():
+            val_loss = self.reduce_val_loss(val_loss, n_val, device=device)
+        elif self.parallel:
             self.save_val_loss(val_loss, n_val)
             val_loss = self.load_val_loss()
 
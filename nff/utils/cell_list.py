@@ -0,0 +1,176 @@
+"""
+Linked-cell (binning) neighbor lists. Atoms are sorted into bins that are
+at least one cutoff wide, and only atoms in adjacent bins are compared, so the
+cost scales linearly with the number of atoms instead of quadratically.
+"""
+
+import numpy as np
+import torch
+from ase.geometry import complete_cell
+
+# below this many atoms the dense N x N distance matrix is cheaper
+CELL_LIST_MIN_ATOMS = 1000
+# number of atoms whose candidate pairs are evaluated at once
+CELL_LIST_CHUNK_SIZE = 8192
+
+
+def get_bin_shape(extent, cutoff, num_atoms):
+    """
+    Get the number of bins along each cell vector.
+    Args:
+        extent (np.array): perpendicular width of the binned region
+            along each of the three cell vectors
+        cutoff (float): neighbor list cutoff
+        num_atoms (int): number of atoms, used to cap the total number
+            of bins for very sparse systems
+    Returns:
+        num_bins (np.array): number of bins along each cell vector
+    """
+
+    num_bins = np.maximum(np.floor(extent / cutoff), 1).astype(int)
+    max_bins = 4 * num_atoms + 27
+    while num_bins.prod() > max_bins:
+        k = num_bins.argmax()
+        num_bins[k] = max(num_bins[k] // 2, 1)
+
+    return num_bins
+
+
+def cell_list_nbr_list(
+    xyz,
+    cutoff,
+    cell=None,
+    pbc=False,
+    directed=True,
+    inclusive=False,
+    device="cpu",
+    chunk_size=CELL_LIST_CHUNK_SIZE,
+):
+    """
+    Neighbor list from a linked-cell search. Handles orthorhombic, triclinic
+    and non-periodic systems (or any mix of periodic and non-periodic axes),
+    and returns periodic images at any distance, so small cells with large
+    cutoffs are also supported.
+    Args:
+        xyz (torch.Tensor or np.array): (N, 3) positions. They don't need to
+            be wrapped into the cell.
+        cutoff (float): neighbor cutoff
+        cell (torch.Tensor or np.array, optional): (3, 3) lattice vectors as rows.
+            Only needed if any axis is periodic.
+        pbc (bool or list[bool]): periodicity along each cell vector
+        directed (bool): if False, only pairs with j > i are returned
+        inclusive (bool): whether pairs exactly at the cutoff are neighbors
+        device (str): device on which to do the search
+        chunk_size (int): number of atoms whose candidate pairs are
+            evaluated at once, to cap memory
+    Returns:
+        nbr_list (torch.LongTensor): (E, 2) pairs of atoms, sorted by i and then j
+        offsets (torch.LongTensor): (E, 3) integer multiples of the lattice vectors,
+            such that r_ij = xyz[j] - xyz[i] + offsets @ cell, as in
+            `torch_nbr_list`.
+    """
+
+    xyz = torch.as_tensor(np.asarray(xyz) if not torch.is_tensor(xyz) else xyz)
+    xyz = xyz.detach().to(device=device, dtype=torch.float64)
+    num_atoms = xyz.shape[0]
+    pbc = np.broadcast_to(np.asarray(pbc, dtype=bool), (3,))
+
+    empty = torch.zeros((0, 2), dtype=torch.long, device=device)
+    if num_atoms == 0:
+        return empty, torch.zeros((0, 3), dtype=torch.long, device=device)
+
+    cell = np.zeros((3, 3)) if cell is None else np.asarray(cell, dtype=float).reshape(3, 3)
+    if np.any(np.linalg.norm(cell, axis=1)[pbc] == 0):
+        raise ValueError("Periodic axes need non-zero cell vectors.")
+
+    # fill in missing non-periodic vectors so we can always bin in fractional space
+    cell = complete_cell(cell)
+    inv_cell = np.linalg.inv(cell)
+    cell_t = torch.from_numpy(cell).to(xyz)
+    frac = xyz @ torch.from_numpy(inv_cell).to(xyz)
+
+    # wrap periodic axes into [0, 1) and remember the integer shift
+    pbc_t = torch.from_numpy(pbc.copy()).to(device)
+    shift = torch.where(pbc_t, torch.floor(frac), torch.zeros_like(frac))
+    frac = frac - shift
+    wrapped_xyz = xyz - shift @ cell_t
+    shift = shift.long()
+
+    # non-periodic axes are binned over the range spanned by the atoms
+    lo = torch.where(pbc_t, torch.zeros(3).to(frac), frac.min(0).values)
+    span = torch.where(pbc_t, torch.ones(3).to(frac), frac.max(0).values - lo)
+    heights = 1 / np.linalg.norm(inv_cell, axis=0)
+    extent = span.cpu().numpy() * heights
+
+    num_bins = get_bin_shape(extent, cutoff, num_atoms)
+    # how many bins away a neighbor can be
+    num_search = np.ceil(cutoff * num_bins / np.maximum(extent, 1e-12)).astype(int)
+    num_search[~pbc] = np.minimum(num_search[~pbc], num_bins[~pbc] - 1)
+
+    num_bins_t = torch.from_numpy(num_bins).to(device)
+    scaled = (frac - lo) / span.clamp(min=1e-12) * num_bins_t
+    atom_bin = torch.minimum(torch.floor(scaled).long().clamp(min=0), num_bins_t - 1)
+
+    strides = torch.LongTensor([num_bins[1] * num_bins[2], num_bins[2], 1]).to(device)
+    bin_id = (atom_bin * strides).sum(-1)
+
+    # CSR layout of the atoms in each bin
+    order = torch.argsort(bin_id, stable=True)
+    bin_counts = torch.bincount(bin_id, minlength=int(num_bins.prod()))
+    bin_starts = torch.cumsum(bin_counts, 0) - bin_counts
+
+    ranges = [torch.arange(-n, n + 1, device=device) for n in num_search]
+    disp = torch.stack(torch.meshgrid(*ranges, indexing="ij"), dim=-1).reshape(-1, 3)
+
+    all_nbrs = []
+    all_offsets = []
+    for start in range(0, num_atoms, chunk_size):
+        idx_i = torch.arange(start, min(start + chunk_size, num_atoms), device=device)
+
+        # neighboring bins of every atom, and the periodic image they belong to
+        nbr_bin = atom_bin[idx_i][:, None, :] + disp[None, :, :]
+        image = torch.where(pbc_t, torch.div(nbr_bin, num_bins_t, rounding_mode="floor"), 0)
+        nbr_bin = nbr_bin - image * num_bins_t
+        valid = ((nbr_bin >= 0) & (nbr_bin < num_bins_t)).all(-1)
+
+        pair_i = idx_i[:, None].expand(-1, disp.shape[0])[valid]
+        image = image[valid]
+        nbr_bin_id = (nbr_bin[valid] * strides).sum(-1)
+
+        # expand every (atom, bin) pair into the atoms in that bin
+        counts = bin_counts[nbr_bin_id]
+        total = int(counts.sum())
+        if total == 0:
+            continue
+
+        pair_i = torch.repeat_interleave(pair_i, counts)
+        image = torch.repeat_interleave(image, counts, dim=0)
+        first = torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+        within = torch.arange(total, device=device) - first
+        pair_j = order[torch.repeat_interleave(bin_starts[nbr_bin_id], counts) + within]
+
+        r_ij = wrapped_xyz[pair_j] - wrapped_xyz[pair_i] + image.to(cell_t) @ cell_t
+        dist_sq = r_ij.pow(2).sum(-1)
+        in_range = dist_sq <= cutoff**2 if inclusive else dist_sq < cutoff**2
+        is_self = (pair_i == pair_j) & (image == 0).all(-1)
+        mask = in_range & ~is_self
+        if not directed:
+            mask = mask & (pair_j > pair_i)
+
+        pair_i = pair_i[mask]
+        pair_j = pair_j[mask]
+        # convert to offsets of the unwrapped positions
+        offsets = image[mask] - shift[pair_j] + shift[pair_i]
+
+        all_nbrs.append(torch.stack([pair_i, pair_j], dim=1))
+        all_offsets.append(offsets)
+
+    if not all_nbrs:
+        return empty, torch.zeros((0, 3), dtype=torch.long, device=device)
+
+    nbr_list = torch.cat(all_nbrs)
+    offsets = torch.cat(all_offsets)
+
+    sort_idx = torch.argsort(nbr_list[:, 0] * num_atoms + nbr_list[:, 1], stable=True)
+
+    return nbr_list[sort_idx], offsets[sort_idx]
@@ -222,11 +222,17 @@ def convert_units(props, conversion_dict):
     Returns:
         props (dict): dictionary with properties converted.
     """
+    from nff.data.packed import PackedTensorList
+
     props = props.copy()
     for prop_key in props:
         for conv_key, conv_const in conversion_dict.items():
             if conv_key in prop_key:
-                props[prop_key] = [x * conv_const for x in props[prop_key]]
+                if isinstance(props[prop_key], PackedTensorList):
+                    # a single operation on the packed data
+                    props[prop_key] = props[prop_key] * conv_const
+                else:
+                    props[prop_key] = [x * conv_const for x in props[prop_key]]
 
     return props
 
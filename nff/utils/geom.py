@@ -2,13 +2,14 @@
 Tools for analyzing and comparing geometries
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
 
 from nff.utils.scatter import scatter_add
 
-BATCH_SIZE = 3000
+BLOCK_SIZE = 512
 
 
 def quaternion_to_matrix(q):
@@ -198,65 +199,195 @@ def compute_distance(targ_nxyz, atom_nxyz, store_grad=False):
     return distances.detach(), R
 
 
-def compute_distances(dataset, device, batch_size=BATCH_SIZE, dataset_1=None, store_grad=False, collate_dicts=None):
+def kabsch_from_cov(cov, return_rot=False):
     """
-    Compute distances between different configurations for one molecule.
+    Optimal rotations (Kabsch algorithm) from covariance matrices.
+
+    Args:
+        cov (torch.Tensor): ... x 3 x 3 covariances sum_i y_i x_i^T between
+            centered coordinates y and x
+        return_rot (bool): whether to return the rotations. Without them, only
+            the singular values are needed, which is about twice as fast.
+    Returns:
+        trace (torch.Tensor): max_R tr(R cov) over proper rotations R
+        rot (torch.Tensor or None): ... x 3 x 3 rotations with R y ~ x
     """
 
-    if collate_dicts is None:
-        from nff.data import collate_dicts
+    if not return_rot:
+        s = torch.linalg.svdvals(cov)
+        # the smallest singular value changes sign if the optimal
+        # orthogonal matrix is a reflection
+        det = torch.linalg.det(cov)
+        sign = torch.where(det < 0, -torch.ones_like(det), torch.ones_like(det))
+        return s[..., 0] + s[..., 1] + sign * s[..., 2], None
+
+    u, s, vh = torch.linalg.svd(cov)
 
-    if dataset_1 is None:
-        dataset_1 = dataset
+    # rotation R = V D U^T, where D removes reflections
+    v = vh.transpose(-1, -2)
+    det = torch.linalg.det(v @ u.transpose(-1, -2))
+    sign = torch.where(det < 0, -torch.ones_like(det), torch.ones_like(det))
+    v = torch.cat([v[..., :2], v[..., 2:] * sign[..., None, None]], dim=-1)
+    rot = v @ u.transpose(-1, -2)
+    trace = s[..., 0] + s[..., 1] + sign * s[..., 2]
 
-    distance_mat = torch.zeros((len(dataset), len(dataset_1)))
-    shape = list(distance_mat.shape)
-    shape += [3, 3]
-    R_mat = torch.zeros(tuple(shape))
+    return trace, rot
 
-    loader_0 = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_dicts)
 
-    loader_1 = DataLoader(dataset_1, batch_size=batch_size, collate_fn=collate_dicts)
+def kabsch_rmsd(xyz_0, xyz_1, return_rot=False, store_grad=False):
+    """
+    RMSDs between all pairs of geometries in two stacks, after optimal
+    translation and rotation.
 
-    i_start = 0
-    xyz_list = []
+    Args:
+        xyz_0 (torch.Tensor): A x N x 3 coordinates
+        xyz_1 (torch.Tensor): B x N x 3 coordinates
+        return_rot (bool): whether to return the rotations
+        store_grad (bool): whether the RMSDs should be differentiable with respect
+            to the coordinates
+    Returns:
+        rmsd (torch.Tensor): A x B RMSDs
+        rot (torch.Tensor or None): A x B x 3 x 3 rotations of the centered
+            geometries in `xyz_1` onto those in `xyz_0`
+    """
 
-    for batch_0 in loader_0:
-        j_start = 0
-        for batch_1 in loader_1:
-            num_mols_0 = len(batch_0["num_atoms"])
-            num_mols_1 = len(batch_1["num_atoms"])
+    p0 = xyz_0 - xyz_0.mean(1, keepdim=True)
+    p1 = xyz_1 - xyz_1.mean(1, keepdim=True)
+    num_atoms = xyz_0.shape[1]
 
-            targ_nxyz = batch_0["nxyz"].reshape(num_mols_0, -1, 4).to(device)
-            atom_nxyz = batch_1["nxyz"].reshape(num_mols_1, -1, 4).to(device)
+    if store_grad:
+        # the derivative of the RMSD with respect to the rotation vanishes at the
+        # optimum, so the rotation doesn't need a gradient
+        with torch.no_grad():
+            cov = torch.einsum("bni,anj->abij", p1.double(), p0.double())
+            _, rot = kabsch_from_cov(cov, return_rot=True)
+        rot = rot.to(p0.dtype)
+        aligned = torch.einsum("abij,bnj->abni", rot, p1)
+        rmsd = (((p0.unsqueeze(1) - aligned) ** 2).sum((-1, -2)) / num_atoms) ** 0.5
 
-            out = compute_distance(targ_nxyz=targ_nxyz, atom_nxyz=atom_nxyz, store_grad=store_grad)
-            if store_grad:
-                distances, R, xyz_0 = out
-                batch_1["num_atoms"].tolist()
-                xyz_list.append(xyz_0)
+        return rmsd, (rot if return_rot else None)
 
-            else:
-                distances, R = out
+    # the traces are computed in double precision, because RMSD^2 is a small
+    # difference of large numbers
+    p0 = p0.double()
+    p1 = p1.double()
+    cov = torch.einsum("bni,anj->abij", p1, p0)
+    trace, rot = kabsch_from_cov(cov, return_rot=return_rot)
 
-            distances = distances.transpose(0, 1)
+    sq_0 = (p0**2).sum((1, 2))
+    sq_1 = (p1**2).sum((1, 2))
+    rmsd_sq = (sq_0.reshape(-1, 1) + sq_1.reshape(1, -1) - 2 * trace) / num_atoms
+    rmsd = rmsd_sq.clamp(min=0) ** 0.5
 
-            all_indices = torch.ones_like(distances).nonzero(as_tuple=False).cpu()
+    if rot is not None:
+        rot = rot.to(xyz_0.dtype)
 
-            all_indices[:, 0] += i_start
-            all_indices[:, 1] += j_start
+    return rmsd.to(xyz_0.dtype), rot
 
-            distance_mat[all_indices[:, 0], all_indices[:, 1]] = distances.reshape(-1)
 
-            R_mat[all_indices[:, 0], all_indices[:, 1]] = R.detach()
+def rmsd_matrix(xyz_0, xyz_1=None, block_size=BLOCK_SIZE, num_workers=1, return_rot=False):
+    """
+    Matrix of RMSDs between all pairs of geometries, computed in blocks to limit
+    the memory. Without `xyz_1` the matrix is symmetric, so only the blocks
+    on and above the diagonal are computed.
+
+    Args:
+        xyz_0 (torch.Tensor): A x N x 3 coordinates
+        xyz_1 (torch.Tensor, optional): B x N x 3 coordinates
+        block_size (int): number of geometries along each side of a block
+        num_workers (int): number of threads that compute blocks in parallel
+        return_rot (bool): whether to return the rotations
+    Returns:
+        rmsd (torch.Tensor): A x B RMSDs
+        rot (torch.Tensor or None): A x B x 3 x 3 rotations of the centered
+            geometries in `xyz_1` onto those in `xyz_0`
+    """
+
+    symmetric = xyz_1 is None
+    if symmetric:
+        xyz_1 = xyz_0
+
+    num_0 = xyz_0.shape[0]
+    num_1 = xyz_1.shape[0]
+    rmsd = torch.zeros(num_0, num_1, dtype=xyz_0.dtype, device=xyz_0.device)
+    rot = torch.zeros(num_0, num_1, 3, 3, dtype=xyz_0.dtype, device=xyz_0.device) if return_rot else None
+
+    blocks = [(i, j) for i in range(0, num_0, block_size) for j in range(i if symmetric else 0, num_1, block_size)]
+
+    def compute(block):
+        i, j = block
+        return kabsch_rmsd(xyz_0[i : i + block_size], xyz_1[j : j + block_size], return_rot=return_rot)
+
+    if num_workers > 1:
+        # the heavy lifting happens in torch, which releases the GIL
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(compute, blocks))
+    else:
+        results = map(compute, blocks)
+
+    for (i, j), (block_rmsd, block_rot) in zip(blocks, results):
+        if symmetric and i == j:
+            # make the diagonal blocks exactly symmetric
+            block_rmsd = torch.triu(block_rmsd, 1)
+            block_rmsd = block_rmsd + block_rmsd.transpose(0, 1)
+            if return_rot:
+                lower = torch.tril_indices(*block_rmsd.shape, offset=-1)
+                block_rot[lower[0], lower[1]] = block_rot[lower[1], lower[0]].transpose(-1, -2)
+                diag = torch.arange(len(block_rot))
+                block_rot[diag, diag] = torch.eye(3, dtype=block_rot.dtype, device=block_rot.device)
+
+        rmsd[i : i + block_size, j : j + block_size] = block_rmsd
+        if return_rot:
+            rot[i : i + block_size, j : j + block_size] = block_rot
+        if symmetric and i != j:
+            rmsd[j : j + block_size, i : i + block_size] = block_rmsd.transpose(0, 1)
+            if return_rot:
+                rot[j : j + block_size, i : i + block_size] = block_rot.transpose(0, 1).transpose(-1, -2)
+
+    return rmsd, rot
+
+
+def compute_distances(
+    dataset, device, batch_size=BLOCK_SIZE, dataset_1=None, store_grad=False, collate_dicts=None, num_workers=1
+):
+    """
+    Compute distances between different configurations for one molecule.
+
+    Args:
+        dataset (nff.data.Dataset): dataset of geometries with the same atoms
+        device (str): device on which to compute the distances
+        batch_size (int): number of geometries along each side of the blocks
+            in which the distances are computed
+        dataset_1 (nff.data.Dataset, optional): second dataset. The distances
+            within `dataset` are computed if it isn't given.
+        store_grad (bool): whether to make the distances differentiable with
+            respect to the coordinates of `dataset_1`
+        collate_dicts (callable, optional): unused, kept for backwards compatibility
+        num_workers (int): number of threads that compute blocks in parallel
+    Returns:
+        distance_mat (torch.Tensor): RMSDs between geometries of `dataset` and
+            geometries of `dataset_1`
+        R_mat (torch.Tensor): rotations of the centered geometries of `dataset_1`
+            onto those of `dataset`
+        xyz_list (list[torch.Tensor]): coordinates of `dataset_1` with respect to
+            which the distances can be differentiated, if `store_grad`
+    """
 
-            j_start += num_mols_1
+    def get_xyz(dset):
+        return torch.stack([dset[i]["nxyz"][:, 1:] for i in range(len(dset))]).to(device)
 
-        i_start += num_mols_0
+    xyz_0 = get_xyz(dataset)
 
     if store_grad:
-        return distance_mat, R_mat, xyz_list
-    return distance_mat, R_mat
+        xyz_1 = get_xyz(dataset if dataset_1 is None else dataset_1)
+        xyz_1.requires_grad = True
+        distance_mat, R_mat = kabsch_rmsd(xyz_0, xyz_1, return_rot=True, store_grad=True)
+        return distance_mat.cpu(), R_mat.cpu(), [xyz_1]
+
+    xyz_1 = None if dataset_1 is None else get_xyz(dataset_1)
+    distance_mat, R_mat = rmsd_matrix(xyz_0, xyz_1, block_size=batch_size, num_workers=num_workers, return_rot=True)
+
+    return distance_mat.cpu(), R_mat.cpu()
 
 
 """
@@ -396,3 +527,132 @@ def batch_compute_distance(ref_nxyz, query_nxyz, mol_idx, num_atoms_tensor, stor
     rmsd = delta_sq_mean**0.5
 
     return rmsd, ref_xyz
+
+
+def batched_kabsch(xyz, refs, mol_idx, num_mols):
+    """
+    Optimal (Kabsch) superposition of a stack of reference geometries onto the
+    current coordinates of several molecules, computed in closed form from the
+    3x3 covariance matrices.
+
+    Args:
+        xyz (torch.Tensor): n_atoms x 3 current coordinates, centered on the
+            center of each molecule
+        refs (torch.Tensor): n_refs x n_atoms x 3 reference coordinates, centered
+            in the same way
+        mol_idx (torch.LongTensor): molecule index of each atom
+        num_mols (int): number of molecules
+    Returns:
+        rmsd_sq (torch.Tensor): n_refs x num_mols squared RMSDs after alignment
+        aligned (torch.Tensor): n_refs x n_atoms x 3 references rotated onto `xyz`
+    """
+
+    # covariance sum_i y_i x_i^T of each reference and molecule
+    cov = scatter_add(refs.unsqueeze(-1) * xyz.reshape(1, -1, 1, 3), index=mol_idx, dim=1, dim_size=num_mols)
+    trace, rot = kabsch_from_cov(cov, return_rot=True)
+
+    num_atoms = torch.bincount(mol_idx, minlength=num_mols).to(xyz.dtype)
+    xyz_sq = scatter_add((xyz**2).sum(-1), index=mol_idx, dim=0, dim_size=num_mols)
+    ref_sq = scatter_add((refs**2).sum(-1), index=mol_idx, dim=1, dim_size=num_mols)
+    rmsd_sq = ((xyz_sq + ref_sq - 2 * trace) / num_atoms).clamp(min=0)
+
+    aligned = torch.einsum("kiab,kib->kia", rot[:, mol_idx], refs)
+
+    return rmsd_sq, aligned
+
+
+class RMSDReferences:
+    """
+    Stack of reference geometries for RMSD-based biases, e.g. in RMSD
+    metadynamics. References are centered once when they are added, and kept
+    in a preallocated buffer from which the oldest is dropped when it's full.
+    RMSDs to all references, and the gradients of a bias that depends on them,
+    are computed at once with `batched_kabsch`.
+    """
+
+    def __init__(self, mol_idx, max_refs=10, device="cpu", dtype=torch.float64):
+        """
+        Args:
+            mol_idx (torch.LongTensor): molecule index of each atom
+            max_refs (int): maximum number of references
+            device (str): device on which the references are stored
+            dtype (torch.dtype): dtype of the references
+        """
+
+        self.mol_idx = mol_idx.to(device)
+        self.num_mols = int(mol_idx.max()) + 1
+        self.num_atoms = torch.bincount(self.mol_idx, minlength=self.num_mols)
+        self.max_refs = max_refs
+        self.device = device
+        self.dtype = dtype
+
+        self.refs = torch.zeros(max_refs, len(mol_idx), 3, device=device, dtype=dtype)
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def center(self, xyz):
+        xyz = torch.as_tensor(xyz, device=self.device, dtype=self.dtype)
+        com = scatter_add(xyz, index=self.mol_idx, dim=0, dim_size=self.num_mols) / self.num_atoms.reshape(-1, 1)
+        return xyz - com[self.mol_idx]
+
+    def append(self, xyz):
+        """
+        Add a reference, replacing the oldest one if the buffer is full.
+        Args:
+            xyz (torch.Tensor or np.ndarray): n_atoms x 3 coordinates
+        """
+
+        slot = (self.start + self.count) % self.max_refs
+        self.refs[slot] = self.center(xyz)
+        if self.count < self.max_refs:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.max_refs
+
+    def get_slots(self):
+        """Slots of the references in the buffer, from the oldest to the newest."""
+        return (self.start + torch.arange(self.count, device=self.device)) % self.max_refs
+
+    def rmsd(self, xyz):
+        """
+        Args:
+            xyz (torch.Tensor or np.ndarray): n_atoms x 3 coordinates
+        Returns:
+            rmsd (torch.Tensor): n_refs x num_mols RMSDs, from the oldest
+                reference to the newest
+        """
+
+        refs = self.refs[self.get_slots()]
+        rmsd_sq, _ = batched_kabsch(xyz=self.center(xyz), refs=refs, mol_idx=self.mol_idx, num_mols=self.num_mols)
+        return rmsd_sq**0.5
+
+    def gaussian_bias(self, xyz, heights, alpha):
+        """
+        Energy and forces of the bias sum_k h_k exp(-alpha RMSD_k^2). The gradient
+        of each RMSD^2 is 2 / N (x_i - R y_i), since the optimal rotation and
+        translation make the other terms vanish.
+        Args:
+            xyz (torch.Tensor or np.ndarray): n_atoms x 3 coordinates
+            heights (torch.Tensor): n_refs x num_mols heights of the gaussians,
+                from the oldest reference to the newest
+            alpha (float): inverse squared width of the gaussians
+        Returns:
+            energy (torch.Tensor): bias energy of each molecule
+            forces (torch.Tensor): n_atoms x 3 bias forces
+        """
+
+        xyz = self.center(xyz)
+        refs = self.refs[self.get_slots()]
+        rmsd_sq, aligned = batched_kabsch(xyz=xyz, refs=refs, mol_idx=self.mol_idx, num_mols=self.num_mols)
+
+        heights = torch.as_tensor(heights, device=self.device, dtype=self.dtype).expand_as(rmsd_sq)
+        energy = heights * torch.exp(-alpha * rmsd_sq)
+
+        # -dE/dRMSD^2 * dRMSD^2/dx
+        coef = 2 * alpha * energy / self.num_atoms.reshape(1, -1)
+        forces = (coef[:, self.mol_idx].unsqueeze(-1) * (xyz.unsqueeze(0) - aligned)).sum(0)
+
+        return energy.sum(0), forces
@@ -1,14 +1,51 @@
+import threading
+from contextlib import contextmanager
 from itertools import repeat
 
 from torch.autograd import grad
 
+_STATE = threading.local()
 
-def compute_grad(inputs, output, allow_unused=False):
+
+def is_inference_mode():
+    """Whether gradients computed with `compute_grad` are first-order only."""
+    return getattr(_STATE, "inference", False)
+
+
+def set_inference_mode(enabled=True):
+    """Turn the inference mode of `compute_grad` on or off in the current thread.
+
+    In inference mode, forces and stresses come from a first-order backward
+    pass, and no graph is built to differentiate them again. This saves memory
+    and time in MD and geometry optimization, but the gradients can't be used
+    in a loss. Unlike `torch.inference_mode`, autograd itself stays enabled.
+
+    Args:
+        enabled (bool): whether to use the inference mode
+    """
+    _STATE.inference = enabled
+
+
+@contextmanager
+def inference_mode(enabled=True):
+    """Context manager version of `set_inference_mode`."""
+    previous = is_inference_mode()
+    set_inference_mode(enabled)
+    try:
+        yield
+    finally:
+        set_inference_mode(previous)
+
+
+def compute_grad(inputs, output, allow_unused=False, create_graph=None):
     """Compute gradient of the scalar output with respect to inputs.
 
     Args:
         inputs (torch.Tensor): torch tensor, requires_grad=True
         output (torch.Tensor): scalar output
+        allow_unused (bool): whether inputs that don't affect the output are allowed
+        create_graph (bool, optional): whether the gradient can be differentiated
+            again. By default this is True, except in inference mode.
 
     Returns:
         torch.Tensor: gradients with respect to each input component
@@ -16,11 +53,16 @@ def compute_grad(inputs, output, allow_unused=False):
 
     assert inputs.requires_grad
 
+    if create_graph is None:
+        create_graph = not is_inference_mode()
+
+    # the graph is retained because models often take several gradients of it;
+    # it's freed with the outputs
     (gradspred,) = grad(
         output,
         inputs,
         grad_outputs=output.data.new(output.shape).fill_(1),
-        create_graph=True,
+        create_graph=create_graph,
         retain_graph=True,
         allow_unused=allow_unused,
     )
@@ -48,7 +90,9 @@ def gen(src, index, dim=-1, out=None, dim_size=None, fill_value=0):
 
 
 def scatter_add(src, index, dim=-1, out=None, dim_size=None, fill_value=0):
+    in_place = out is not None
     src, out, index, dim = gen(src=src, index=index, dim=dim, out=out, dim_size=dim_size, fill_value=fill_value)
-    output = out.scatter_add_(dim, index, src)
+    # the out-of-place version has a batching rule, so it also works under `torch.func.vmap`
+    output = out.scatter_add_(dim, index, src) if in_place else out.scatter_add(dim, index, src)
 
     return output
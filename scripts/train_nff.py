@@ -8,7 +8,7 @@ import torch
 import yaml
 from torch.utils.data import DataLoader
 
-from nff.data import Dataset, collate_dicts
+from nff.data import Dataset, SizeBatchSampler, collate_dicts
 from nff.data.dataset import to_tensor
 from nff.io.mace import update_mace_init_params
 from nff.nn.models.mace import reduce_foundations
@@ -108,6 +108,19 @@ def build_default_arg_parser() -> argparse.ArgumentParser:
         choices=["MSE", "MAE", "Huber"],  # TODO, build huber loss
     )
     parser.add_argument("--batch_size", help="batch size", type=int, default=16)
+    parser.add_argument(
+        "--max_atoms",
+        help="Maximum number of atoms in a batch. Batches are packed by size instead of having a fixed batch size",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max_edges",
+        help="Maximum number of neighbor list edges in a batch. Batches are packed by size instead of having a "
+        "fixed batch size",
+        type=int,
+        default=None,
+    )
     parser.add_argument("--lr", help="Starting learning rate of optimizer", type=float, default=1e-3)
     parser.add_argument("--min_lr", help="Minimum rate of optimizer", type=float, default=1e-6)
     parser.add_argument("--max_num_epochs", help="Maximum number of epochs", type=int, default=500)
@@ -168,6 +181,8 @@ def main(
     loss_weights: Iterable[float] = [0.05, 1.0],
     criterion: Literal["MSE", "MAE"] = "MSE",
     batch_size: int = 16,
+    max_atoms: int = None,
+    max_edges: int = None,
     lr: float = 1e-3,
     min_lr: float = 1e-6,
     max_num_epochs: int = 200,
@@ -199,6 +214,9 @@ def main(
         loss_weights (Iterable[float], optional): Relative weights of output targets. Defaults to [0.05, 1.0].
         criterion (Literal[&quot;MSE&quot;, &quot;MAE&quot;], optional): Loss function criterion. Defaults to "MSE".
         batch_size (int, optional): Batch size. Defaults to 16.
+        max_atoms (int, optional): Maximum number of atoms in a batch. If this or `max_edges` is given,
+            batches are packed by size instead of having `batch_size` geometries. Defaults to None.
+        max_edges (int, optional): Maximum number of neighbor list edges in a batch. Defaults to None.
         lr (float, optional): Learning rate. Defaults to 1e-3.
         min_lr (float, optional): Minimum LR. Defaults to 1e-6.
         max_num_epochs (int, optional): Max number training epochs. Defaults to 200.
@@ -233,21 +251,38 @@ def main(
     train.to_units("eV")
     val.to_units("eV")
 
-    train_loader = DataLoader(
-        train,
-        batch_size=batch_size,
-        num_workers=num_workers,
-        collate_fn=collate_dicts,
-        pin_memory=pin_memory,
-    )
-
-    val_loader = DataLoader(
-        val,
-        batch_size=batch_size,
-        num_workers=num_workers,
-        collate_fn=collate_dicts,
-        pin_memory=pin_memory,
-    )
+    if max_atoms is not None or max_edges is not None:
+        train_loader = DataLoader(
+            train,
+            batch_sampler=SizeBatchSampler.from_dataset(train, max_atoms=max_atoms, max_edges=max_edges),
+            num_workers=num_workers,
+            collate_fn=collate_dicts,
+            pin_memory=pin_memory,
+        )
+
+        val_loader = DataLoader(
+            val,
+            batch_sampler=SizeBatchSampler.from_dataset(val, shuffle=False, max_atoms=max_atoms, max_edges=max_edges),
+            num_workers=num_workers,
+            collate_fn=collate_dicts,
+            pin_memory=pin_memory,
+        )
+    else:
+        train_loader = DataLoader(
+            train,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            collate_fn=collate_dicts,
+            pin_memory=pin_memory,
+        )
+
+        val_loader = DataLoader(
+            val,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            collate_fn=collate_dicts,
+            pin_memory=pin_memory,
+        )
 
     model_kwargs = {"training": True, "compute_force": True} if "NffScaleMACE" in model_type else {}
 
@@ -393,6 +428,8 @@ if __name__ == "__main__":
         loss_weights=args.loss_weights,
         criterion=args.criterion,
         batch_size=args.batch_size,
+        max_atoms=args.max_atoms,
+        max_edges=args.max_edges,
         lr=args.lr,
         min_lr=args.min_lr,
         max_num_epochs=args.max_num_epochs,